@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+# system libraries
+import os
+from datetime import datetime
+
+# my libs
+from ferenda import util, decorators
+from ferenda import DocumentEntry, Transformer
+
+# compiled stylesheets, keyed on (template, templatedirs, config,
+# documentroot). Kept per process, so that each worker started by
+# ferenda.manager (when the processes config option is > 1) gets its
+# own warm cache after its first document.
+_transformers = {}
+
+
+def stylesheet_stamp(template, templatedirs, config):
+    """Returns the modification times of template, of all files in
+    templatedirs and of the config file, to tell whether a cached
+    Transformer was compiled from the stylesheets as they are now.
+    Directories that don't exist are assumed to be in the ferenda
+    package, and never change."""
+    paths = [template, config]
+    for d in templatedirs:
+        if os.path.isdir(d):
+            paths.extend([os.path.join(d, f) for f in sorted(os.listdir(d))])
+    return tuple([(path, os.path.getmtime(path))
+                  for path in paths if path and os.path.exists(path)])
+
+
+def get_transformer(template, templatedirs, config, documentroot):
+    """Returns a Transformer for template, compiling the stylesheet
+    (and copying all its supporting stylesheets to a temporary
+    directory) only the first time a particular template is requested
+    in this process, or if any of the stylesheets (or config) has
+    changed since."""
+    key = (template, tuple(templatedirs), config, documentroot)
+    stamp = stylesheet_stamp(template, templatedirs, config)
+    if key not in _transformers or _transformers[key][0] != stamp:
+        _transformers[key] = (stamp,
+                              Transformer('XSLT', template, templatedirs,
+                                          config=config,
+                                          documentroot=documentroot))
+    return _transformers[key][1]
+
+
+class CachedTransformMixin(object):
+
+    """Replacement for DocumentRepository.generate that reuses the
+    compiled XSLT stylesheet between documents, instead of creating a
+    new Transformer (which copies all stylesheets to a new temporary
+    directory and compiles them) for each document. The transformer
+    is provided by :py:meth:`generate_transformer`; apart from that it
+    works exactly like the original.
+
+    To generate in parallel, set the ``processes`` config option to
+    the number of worker processes to use.
+
+    """
+
+    def generate_transformer(self):
+        """Returns the Transformer that generate uses."""
+        conffile = os.path.abspath(
+            os.sep.join([self.config.datadir, 'rsrc', 'resources.xml']))
+        return get_transformer(self.xslt_template, ["res/xsl"], conffile,
+                               self.config.datadir)
+
+    @decorators.action
+    def generate(self, basefile, otherrepos=[]):
+        infile = self.store.parsed_path(basefile)
+        annotations = self.store.annotation_path(basefile)
+        if os.path.exists(self.store.dependencies_path(basefile)):
+            deptxt = util.readfile(self.store.dependencies_path(basefile))
+            dependencies = deptxt.strip().split("\n")
+        else:
+            dependencies = []
+        dependencies.extend((infile, annotations))
+
+        outfile = self.store.generated_path(basefile)
+        if ((not self.config.force) and
+                util.outfile_is_newer(dependencies, outfile)):
+            self.log.debug("%s: Skipped", basefile)
+            return
+
+        with util.logtime(self.log.info,
+                          "%(basefile)s: generate OK (%(elapsed).3f sec)",
+                          {'basefile': basefile}):
+            self.log.debug("%s: Starting", basefile)
+            # The annotationfile might be newer than all dependencies
+            # (and thus not need regenerateion) even though the
+            # outfile is older.
+            if (self.config.force or
+                    not util.outfile_is_newer(dependencies, annotations)):
+                with util.logtime(self.log.debug,
+                                  "%(basefile)s: prep_annotation_file (%(elapsed).3f sec)",
+                                  {'basefile': basefile}):
+                    annotation_file = self.prep_annotation_file(basefile)
+            else:
+                annotation_file = annotations
+            params = {}
+            if annotation_file:
+                params['annotationfile'] = annotation_file
+
+            with util.logtime(self.log.debug,
+                              "%(basefile)s: transform (%(elapsed).3f sec)",
+                              {'basefile': basefile}):
+                transformer = self.generate_transformer()
+                urltransform = None
+                if self.config.staticsite:
+                    repos = list(otherrepos)
+                    if self not in repos:
+                        repos.append(self)
+                    urltransform = self.get_url_transform_func(
+                        repos, os.path.dirname(outfile))
+                transformer.transform_file(infile, outfile,
+                                           params, urltransform)
+
+            # make sure the outfile looks newer than its dependencies
+            # even if the transform didn't change it
+            os.utime(outfile, None)
+            now = datetime.now()
+            docentry = DocumentEntry(self.store.documententry_path(basefile))
+            if not docentry.published:
+                docentry.published = now
+            docentry.updated = now
+            docentry.save()
@@ -4,19 +4,29 @@ from __future__ import unicode_literals
 hämtas fran DV:s (ickepublika) FTP-server, eller fran lagen.nu."""
 
 # system libraries (incl six-based renames)
-from datetime import datetime
+from datetime import datetime, date
 from ftplib import FTP
 from time import mktime
+import calendar
 import codecs
+import copy
+import hashlib
 import itertools
+import json
+import multiprocessing
 import os
+import posixpath
 import re
+import shutil
+import threading
 import zipfile
+from io import BytesIO
 from six import text_type as str
 from six.moves.urllib_parse import urljoin
-from six import BytesIO
 import tempfile
 from collections import defaultdict
+from multiprocessing.pool import ThreadPool
+from operator import itemgetter
 
 # 3rdparty libs
 import pkg_resources
@@ -27,10 +37,12 @@ from lxml import etree
 from bs4 import BeautifulSoup, NavigableString
 
 # my libs
+import ferenda
 from ferenda import (Document, DocumentStore, Describer, WordReader, FSMParser,
                      Facet, TocPage, TocPageset)
 from ferenda.decorators import managedparsing, newstate
-from ferenda import util, fulltextindex
+from ferenda import util, fulltextindex, LayeredConfig
+from ferenda.compat import OrderedDict
 from ferenda.sources.legal.se.legalref import LegalRef
 from ferenda.elements import (Body, Paragraph, CompoundElement, OrdinalElement,
                               Heading, Link)
@@ -40,9 +52,17 @@ from ferenda.sources.legal.se import (SwedishLegalSource,
                                       SwedishCitationParser, RPUBL)
 # from swedishlegalsource import (SwedishLegalSource, SwedishCitationParser,
 #                                 RPUBL)
+from cachedtransform import CachedTransformMixin
+from sortkeys import numsortkey
 DCTERMS = Namespace(util.ns['dcterms'])
 PROV = Namespace(util.ns['prov'])
 
+# namespaces used in (simplified) OOXML intermediate files
+OOXML_NSMAP = {'w14': "http://schemas.microsoft.com/office/word/2010/wordml",
+               'w': "http://schemas.openxmlformats.org/wordprocessingml/2006/main",
+               'r': "http://schemas.openxmlformats.org/officeDocument/2006/relationships"}
+WNS = "{%s}" % OOXML_NSMAP['w']
+
 # Objektmodellen för rättsfall:
 #
 # meta:
@@ -94,6 +114,257 @@ class MaxDownloadsReached(Exception):
     pass
 
 
+def replace_file(src, dst):
+    """Renames src to dst, replacing dst if it exists, like os.replace
+    (which python 2 lacks) does. Unlike util.robust_rename, a failed
+    rename is not hidden."""
+    if hasattr(os, 'replace'):
+        os.replace(src, dst)
+    else:
+        if os.name == 'nt' and os.path.isfile(dst):
+            # os.rename won't replace an existing file on windows
+            os.remove(dst)
+        os.rename(src, dst)
+
+
+# the DV instance used by each worker process started by
+# DV.process_all_zipfiles
+_worker_repo = None
+
+
+def _process_zipfile(args):
+    global _worker_repo
+    repoclass, config, zipfilename = args
+    if _worker_repo is None:
+        _worker_repo = repoclass(**config)
+    _worker_repo.log.info("%s: Processing..." % zipfilename)
+    return zipfilename, _worker_repo.process_zipfile(zipfilename)
+
+
+# the compiled simplify-ooxml.xsl, shared by all calls to
+# DV._simplify_ooxml (from both parse and extract_notis) in this
+# process
+_simplify_transform = None
+
+
+def get_simplify_transform():
+    global _simplify_transform
+    if _simplify_transform is None:
+        fp = pkg_resources.resource_stream('ferenda', "res/xsl/simplify-ooxml.xsl")
+        _simplify_transform = etree.XSLT(etree.parse(fp))
+        fp.close()
+    return _simplify_transform
+
+
+# the version of the installed antiword, as reported by itself
+_antiword_version = None
+
+
+def get_antiword_version():
+    global _antiword_version
+    if _antiword_version is None:
+        (ret, stdout, stderr) = util.runcmd("antiword")
+        m = re.search(r"Version: *(\S+)", stdout + stderr)
+        _antiword_version = m.group(1) if m else "unknown"
+    return _antiword_version
+
+
+class ControlCharReader(object):
+    """Wraps a binary file object and replaces the bytes \\xc2\\x81
+    (utf-8 for a control char) with \\xc3\\x85 (utf-8 for "Å") as the
+    file is read. In some rare cases, the former is used where the
+    latter should be."""
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.pending = b""
+        self.replaced = False
+
+    def read(self, size=-1):
+        while True:
+            chunk = self.fp.read(size)
+            data = self.pending + chunk
+            self.pending = b""
+            if chunk and data.endswith(b"\xc2"):
+                # might be the first half of a sequence that continues
+                # in the next chunk
+                self.pending, data = data[-1:], data[:-1]
+                if not data:
+                    continue
+            break
+        if b"\xc2\x81" in data:
+            self.replaced = True
+            data = data.replace(b"\xc2\x81", b"\xc3\x85")
+        return data
+
+
+# parsers built by DV.get_parser, keyed by court
+_parsers = {}
+
+# dates parsed by parse_date, keyed by the string they were parsed
+# from, least recently used first
+_parsed_dates = OrderedDict()
+_parsed_dates_max = 10000
+
+
+def parse_swedish_date(datestr):
+    """Same as SwedishLegalSource.parse_swedish_date, but without
+    needing a repo instance."""
+    day = month = year = None
+    months = SwedishLegalSource.swedish_months
+    if datestr.startswith("vid utgången av"):
+        (x, y, z, month, year) = datestr.split()
+        month = months[month]
+        year = int(year)
+        day = calendar.monthrange(year, month)[1]
+    else:
+        # assume strings on the form "3 februari 2010", "8 dec. 1997"
+        components = datestr.split()
+        year = int(components[-1])
+        if len(components) >= 2:
+            if components[-2].endswith("."):
+                components[-2] = components[-2][:-1]
+            if components[-2] not in months:
+                raise ValueError(datestr)
+            month = months[components[-2]]
+        if len(components) >= 3:
+            day = int(components[-3])
+    if day:
+        return date(year, month, day)
+    if month:
+        return util.gYearMonth(year, month)
+    else:
+        return util.gYear(year)
+
+
+def parse_iso_date(datestr):
+    """Same as SwedishLegalSource.parse_iso_date, but without needing a
+    repo instance."""
+    return datetime.strptime(datestr.replace(" ", ""), "%Y-%m-%d").date()
+
+
+def parse_date(datestr):
+    """Parses datestr as a swedish date or, if that fails, as an ISO
+    date. The most recently used results are cached, so that dates
+    that occur in many documents are only parsed once per process."""
+    try:
+        res = _parsed_dates.pop(datestr)
+    except KeyError:
+        try:
+            res = parse_swedish_date(datestr)
+        except ValueError:
+            res = parse_iso_date(datestr)
+        if len(_parsed_dates) >= _parsed_dates_max:
+            _parsed_dates.popitem(last=False)
+    _parsed_dates[datestr] = res
+    return res
+
+
+re_invalid_xml_chars = re.compile(b"[\x00-\x08\x0b\x0c\x0e-\x1f]")
+re_stray_ampersand = re.compile(b"&(?!(?:#[0-9]+|#x[0-9a-fA-F]+|[A-Za-z][A-Za-z0-9]*);)")
+
+
+def sanitize_xml(data):
+    """Fixes the most common reasons why intermediate files (bytes)
+    are not well-formed: control characters and stray ampersands in
+    the text."""
+    return re_stray_ampersand.sub(b"&amp;", re_invalid_xml_chars.sub(b"", data))
+
+
+def recovering_fromstring(data):
+    """Parses data (bytes) as XML. Intermediate files are not always
+    well-formed, which BeautifulSoup (used before) never complained
+    about. If data can't be parsed strictly, the most common problems
+    (control characters and stray ampersands in the text) are fixed
+    and the result is parsed again. Failing that, as much as possible
+    of it is parsed in recover mode (which drops any entities after
+    the first error). Returns the root element and the syntax error
+    of the first attempt (or None), so that the caller can log it."""
+    try:
+        return etree.fromstring(data), None
+    except etree.XMLSyntaxError as e:
+        error = e
+    data = sanitize_xml(data)
+    try:
+        return etree.fromstring(data), error
+    except etree.XMLSyntaxError:
+        pass
+    root = etree.fromstring(data, etree.XMLParser(recover=True))
+    if root is None:
+        raise error
+    return root, error
+
+
+class WordDocument(object):
+    """An intermediate file (simplified OOXML or antiword's DocBook)
+    parsed with lxml, with the lookups that DV.parse_ooxml and
+    DV.parse_antiword_docbook need. Text nodes returned by
+    find_labels are lxml "smart strings", which know their parent
+    element. If the file isn't well-formed, ``error`` is the
+    XMLSyntaxError that a strict parse raised."""
+
+    def __init__(self, text, nsmap=None):
+        self.root, self.error = recovering_fromstring(text.encode("utf-8"))
+        self.nsmap = nsmap
+
+    def find(self, node, path):
+        """Returns the first node that path (relative to node) selects,
+        or None."""
+        res = node.xpath(path, namespaces=self.nsmap)
+        return res[0] if res else None
+
+    def find_labels(self, re_labels, patterns={}):
+        """Walks over all text nodes once. Returns a dict mapping each
+        label found by re_labels (its first group), and each key of
+        patterns whose regex matches, to the first text node that
+        contains it."""
+        found = {}
+        for textnode in self.root.xpath("//text()"):
+            for m in re_labels.finditer(textnode):
+                if m.group(1) not in found:
+                    found[m.group(1)] = textnode
+            for key, regex in patterns.items():
+                if key not in found and regex.search(textnode):
+                    found[key] = textnode
+        return found
+
+    def container(self, textnode):
+        """Returns the element that textnode is a part of."""
+        if textnode.is_tail:
+            return textnode.getparent().getparent()
+        return textnode.getparent()
+
+    def find_parent(self, textnode, tag):
+        """Returns the closest element named tag that contains
+        textnode."""
+        return self.find(self.container(textnode),
+                         "ancestor-or-self::%s[1]" % tag)
+
+    def find_next(self, node, tag):
+        """Returns the first element named tag after the start of node
+        (an element or a text node) in document order."""
+        if not isinstance(node, etree._Element) and node.is_tail:
+            return self.find(node.getparent(), "following::%s[1]" % tag)
+        if not isinstance(node, etree._Element):
+            node = node.getparent()
+        return self.find(node, "(descendant::%s|following::%s)[1]" % (tag, tag))
+
+    @staticmethod
+    def get_text(node):
+        """The text of node, with each text node stripped."""
+        return "".join([t.strip() for t in node.itertext()])
+
+    @classmethod
+    def string(cls, node):
+        """The single string that node contains, or None if it has
+        several children (or none)."""
+        if len(node) == 0:
+            return node.text
+        if len(node) == 1 and not node.text and not node[0].tail:
+            return cls.string(node[0])
+        return None
+
+
 class DVStore(DocumentStore):
 
     """Customized DocumentStore.
@@ -120,6 +391,9 @@ class DVStore(DocumentStore):
     def intermediate_path(self, basefile, version=None, attachment=None):
         return self.path(basefile, "intermediate", ".xml")
 
+    def zipmanifest_path(self):
+        return self.path("manifest", "downloaded/zips", ".json")
+
     def list_basefiles_for(self, action, basedir=None):
         if not basedir:
             basedir = self.datadir
@@ -179,7 +453,7 @@ class Tillagg(DomElement): pass # dcterms:author <- name
 class Endmeta(DomElement): pass
 
 
-class DV(SwedishLegalSource):
+class DV(CachedTransformMixin, SwedishLegalSource):
     alias = "dv"
     downloaded_suffix = ".zip"
     rdf_type = (RPUBL.Rattsfallsreferat, RPUBL.Rattsfallsnotis)
@@ -238,13 +512,58 @@ class DV(SwedishLegalSource):
             pass
         return super(cls, DV).relate_all_setup(config)
 
+    @classmethod
+    def parse_all_setup(cls, config):
+        # convert_word records every conversion cache lookup in this
+        # file, but only during a full parse run
+        runlog = os.path.sep.join([config.datadir, 'dv', 'wordcache', 'run.log'])
+        if config.wordcache:
+            util.ensure_dir(runlog)
+            util.writefile(runlog, "")
+        return super(cls, DV).parse_all_setup(config)
+
+    @classmethod
+    def parse_all_teardown(cls, config):
+        cachedir = os.path.sep.join([config.datadir, 'dv', 'wordcache'])
+        runlog = cachedir + os.sep + 'run.log'
+        if os.path.exists(runlog):
+            log = cls._setup_logger(cls.alias)
+            stats = {'hit': 0, 'miss': 0}
+            used = set()
+            with open(runlog) as fp:
+                for line in fp:
+                    outcome, key = line.split()
+                    stats[outcome] += 1
+                    used.add(key)
+            util.robust_remove(runlog)
+            evicted = 0
+            if config.force:
+                # every document went through convert_word, so entries
+                # that weren't used are for documents that have changed
+                # or were converted by an older converter
+                for f in util.list_dirs(cachedir, ".xml"):
+                    relpath = f[len(cachedir)+1:]
+                    key = relpath.replace(os.sep, "").split(".")[0]
+                    if key not in used:
+                        util.robust_remove(f)
+                        evicted += 1
+            log.info("Conversion cache: %s hits, %s misses, %s stale entries removed" %
+                     (stats['hit'], stats['miss'], evicted))
+        return super(cls, DV).parse_all_teardown(config)
+
     # def relate(self, basefile, otherrepos): pass
         
     def get_default_options(self):
         opts = super(DV, self).get_default_options()
         opts['ftpuser'] = None
         opts['ftppassword'] = None
+        opts['ftphost'] = 'ftp.dom.se'
+        opts['ftpport'] = 21
+        opts['ftpconnections'] = 4
+        opts['wwwurl'] = 'https://lagen.nu/dv/downloaded/'
+        opts['httpconnections'] = 4
         opts['parsebodyrefs'] = True
+        opts['wordcache'] = True
         return opts
 
     def canonical_uri(self, basefile):
@@ -331,65 +650,234 @@ class DV(SwedishLegalSource):
         except MaxDownloadsReached:  # ok we're done!
             pass
 
-    def download_ftp(self, dirname, recurse, user=None, password=None, connection=None):
-        self.log.debug('Listing contents of %s' % dirname)
-        lines = []
-        if not connection:
-            connection = FTP('ftp.dom.se')
-            connection.login(user, password)
-
-        connection.cwd(dirname)
-        connection.retrlines('LIST', lines.append)
-
-        for line in lines:
-            parts = line.split()
-            filename = parts[-1].strip()
-            if line.startswith('d') and recurse:
-                self.download_ftp(filename, recurse, connection=connection)
-            elif line.startswith('-'):
-                basefile = os.path.splitext(filename)[0]
+    def download_ftp(self, dirname, recurse, user=None, password=None):
+        """Downloads all zip files in dirname (and, if recurse is True,
+        its subdirectories) from the FTP server, using a pool of
+        ``ftpconnections`` persistent connections to list directories
+        and fetch files in parallel. Each zip file is first written to
+        a temporary file which is renamed into place when complete, so
+        an interrupted download never leaves a truncated zip file
+        behind. The zip files are processed in the main thread, in the
+        order they are listed, and recorded in the zip manifest (see
+        process_all_zipfiles)."""
+        local = threading.local()
+        connections = []
+        lock = threading.Lock()
+
+        def connection():
+            # one connection per worker thread, kept for all its jobs
+            if not hasattr(local, 'connection'):
+                conn = FTP()
+                conn.connect(self.config.ftphost, self.config.ftpport)
+                conn.login(user, password)
+                local.connection = conn
+                local.root = conn.pwd()
+                with lock:
+                    connections.append(conn)
+            return local.connection, local.root
+
+        def listdir(dirname):
+            self.log.debug('Listing contents of %s' % dirname)
+            conn, root = connection()
+            lines = []
+            conn.cwd(posixpath.join(root, dirname))
+            conn.retrlines('LIST', lines.append)
+            dirs = []
+            files = []
+            for line in lines:
+                filename = line.split()[-1].strip()
                 if dirname:
-                    basefile = dirname + "/" + basefile
-                # localpath = self.store.downloaded_path(basefile)
-                localpath = self.store.path(basefile, 'downloaded/zips', '.zip')
-                if os.path.exists(localpath) and not self.config.force:
-                    pass  # we already got this
-                else:
-                    util.ensure_dir(localpath)
-                    self.log.debug('Fetching %s to %s' % (filename,
-                                                          localpath))
-                    connection.retrbinary('RETR %s' % filename,
-                                          # FIXME: retrbinary calls .close()?
-                                          open(localpath, 'wb').write)
-                    self.process_zipfile(localpath)
-        connection.cwd('/')
+                    filename = dirname + "/" + filename
+                if line.startswith('d'):
+                    dirs.append(filename)
+                elif line.startswith('-'):
+                    files.append(filename)
+            return dirs, files
+
+        def localpath(filename):
+            basefile = os.path.splitext(filename)[0]
+            return self.store.path(basefile, 'downloaded/zips', '.zip')
+
+        def fetch(filename):
+            conn, root = connection()
+            path = localpath(filename)
+            util.ensure_dir(path)
+            self.log.debug('Fetching %s to %s' % (filename, path))
+            fileno, tmppath = tempfile.mkstemp(suffix=".part",
+                                               dir=os.path.dirname(path))
+            try:
+                with os.fdopen(fileno, "wb") as fp:
+                    conn.retrbinary('RETR %s' % posixpath.join(root, filename),
+                                    fp.write)
+                replace_file(tmppath, path)
+            except:
+                util.robust_remove(tmppath)
+                raise
+            return path
+
+        manifest = self.load_zipmanifest()
+        pool = ThreadPool(self.config.ftpconnections)
+        try:
+            files = []
+            pending = [dirname]
+            while pending:
+                listings = pool.map(listdir, pending)
+                pending = []
+                for dirs, dirfiles in listings:
+                    files.extend(dirfiles)
+                    if recurse:
+                        pending.extend(dirs)
+            files = [f for f in files
+                     if self.config.force or not os.path.exists(localpath(f))]
+            for path in pool.imap(fetch, files):
+                basefiles = self.process_zipfile(path)
+                self.record_zipfile(path, basefiles, manifest)
+        finally:
+            pool.terminate()
+            pool.join()
+            self.save_zipmanifest(manifest)
+            for conn in connections:
+                try:
+                    conn.quit()
+                except Exception:
+                    conn.close()
 
-    def download_www(self, dirname, recurse):
-        url = 'https://lagen.nu/dv/downloaded/%s' % dirname
-        self.log.debug('Listing contents of %s' % url)
-        resp = requests.get(url)
-        iterlinks = lxml.html.document_fromstring(resp.text).iterlinks()
-        for element, attribute, link, pos in iterlinks:
-            if link.startswith("/"):
-                continue
-            elif link.endswith("/") and recurse:
-                self.download_www(link, recurse)
-            elif link.endswith(".zip"):
-                basefile = os.path.splitext(link)[0]
-                if dirname:
-                    basefile = dirname + basefile
+    # size of each chunk read from the HTTP response and written to disk
+    httpchunksize = 64 * 1024
+    re_content_range = re.compile(r'bytes (\d+)-\d+/(\d+|\*)')
+    re_unsatisfied_range = re.compile(r'bytes \*/(\d+)')
 
-                # localpath = self.store.downloaded_path(basefile)
-                localpath = self.store.path(basefile, 'downloaded/zips', '.zip')
-                if os.path.exists(localpath) and not self.config.force:
-                    pass  # we already got this
-                else:
-                    absolute_url = urljoin(url, link)
-                    self.log.debug('Fetching %s to %s' % (link, localpath))
-                    resp = requests.get(absolute_url)
-                    with self.store._open(localpath, "wb") as fp:
-                        fp.write(resp.content)
-                    self.process_zipfile(localpath)
+    def download_www(self, dirname, recurse):
+        """Downloads all zip files linked from the directory listing at
+        ``wwwurl`` + dirname (and, if recurse is True, its
+        subdirectories), using ``httpconnections`` threads (each with
+        its own persistent session) to list directories and fetch files
+        in parallel. Responses are streamed to disk in chunks. A zip
+        file is written to a ``.part`` file next to its final location
+        which is renamed into place when complete. If a ``.part`` file
+        is left over from an interrupted transfer, only the remainder is
+        requested (using a Range header), provided that the remote file
+        is unchanged since (using an If-Range header with the ETag or
+        Last-Modified date of the interrupted transfer, which is kept in
+        a ``.part.validator`` file). The zip files are processed in
+        the main thread, in the order they are listed, and recorded in the
+        zip manifest (see process_all_zipfiles)."""
+        local = threading.local()
+
+        def session():
+            if not hasattr(local, 'session'):
+                local.session = requests.Session()
+            return local.session
+
+        def listdir(dirname):
+            url = urljoin(self.config.wwwurl, dirname)
+            self.log.debug('Listing contents of %s' % url)
+            resp = session().get(url)
+            resp.raise_for_status()
+            dirs = []
+            files = []
+            iterlinks = lxml.html.document_fromstring(resp.text).iterlinks()
+            for element, attribute, link, pos in iterlinks:
+                if link.startswith("/") or "?" in link:
+                    continue
+                elif link.endswith("/"):
+                    dirs.append(dirname + link)
+                elif link.endswith(".zip"):
+                    files.append(dirname + link)
+            return dirs, files
+
+        def localpath(filename):
+            basefile = os.path.splitext(filename)[0]
+            return self.store.path(basefile, 'downloaded/zips', '.zip')
+
+        def remote_size(resp):
+            # the size of the remote file, as stated by a 416 response
+            # or (if it doesn't) by a HEAD request
+            m = self.re_unsatisfied_range.match(
+                resp.headers.get('Content-Range', ''))
+            if m:
+                return int(m.group(1))
+            length = session().head(resp.url).headers.get('Content-Length')
+            return int(length) if length else None
+
+        def fetch(filename):
+            url = urljoin(self.config.wwwurl, filename)
+            path = localpath(filename)
+            partpath = path + ".part"
+            validatorpath = partpath + ".validator"
+            util.ensure_dir(path)
+            headers = {}
+            offset = 0
+            # a part file can only be resumed if we know which version
+            # of the remote file it is the beginning of
+            if os.path.exists(partpath) and os.path.exists(validatorpath):
+                offset = os.path.getsize(partpath)
+                headers['Range'] = 'bytes=%s-' % offset
+                headers['If-Range'] = util.readfile(validatorpath).strip()
+            self.log.debug('Fetching %s to %s' % (url, path))
+            resp = session().get(url, headers=headers, stream=True)
+            try:
+                complete = resume = False
+                if offset and resp.status_code == 416:
+                    # the part file might be complete already
+                    complete = remote_size(resp) == offset
+                elif offset and resp.status_code == 206:
+                    m = self.re_content_range.match(
+                        resp.headers.get('Content-Range', ''))
+                    resume = bool(m) and int(m.group(1)) == offset
+                if resp.status_code in (206, 416) and not (complete or resume):
+                    # the part file doesn't match the remote file
+                    resp.close()
+                    resp = session().get(url, stream=True)
+                if not complete:
+                    # a 200 response means the remote file has changed
+                    # (or the server ignored our Range header)
+                    resp.raise_for_status()
+                    if resume:
+                        self.log.debug('%s: Resuming at %s bytes' %
+                                       (filename, offset))
+                    else:
+                        validator = resp.headers.get('ETag')
+                        if not validator or validator.startswith("W/"):
+                            # weak ETags can't be used with If-Range
+                            validator = resp.headers.get('Last-Modified')
+                        if validator:
+                            util.writefile(validatorpath, validator)
+                        else:
+                            util.robust_remove(validatorpath)
+                    with open(partpath, "ab" if resume else "wb") as fp:
+                        for chunk in resp.iter_content(self.httpchunksize):
+                            fp.write(chunk)
+            finally:
+                resp.close()
+            # unlike util.robust_rename, this doesn't hide a failed
+            # rename (which would leave the previous zip file, or
+            # none at all, to be processed)
+            replace_file(partpath, path)
+            util.robust_remove(validatorpath)
+            return path
+
+        manifest = self.load_zipmanifest()
+        pool = ThreadPool(self.config.httpconnections)
+        try:
+            files = []
+            pending = [dirname]
+            while pending:
+                listings = pool.map(listdir, pending)
+                pending = []
+                for dirs, dirfiles in listings:
+                    files.extend(dirfiles)
+                    if recurse:
+                        pending.extend(dirs)
+            files = [f for f in files
+                     if self.config.force or not os.path.exists(localpath(f))]
+            for path in pool.imap(fetch, files):
+                basefiles = self.process_zipfile(path)
+                self.record_zipfile(path, basefiles, manifest)
+        finally:
+            pool.terminate()
+            pool.join()
+            self.save_zipmanifest(manifest)
 
     # eg. HDO_T3467-96.doc or HDO_T3467-96_1.doc
     re_malnr = re.compile(r'([^_]*)_([^_\.]*)()_?(\d*)(\.docx?)')
@@ -406,13 +894,175 @@ class DV(SwedishLegalSource):
     def process_all_zipfiles(self):
         self.downloadcount = 0
         zippath = self.store.path('', 'downloaded/zips', '')
+        manifest = self.load_zipmanifest()
+        zipfilenames = []
         for zipfilename in util.list_dirs(zippath, suffix=".zip"):
-            self.log.info("%s: Processing..." % zipfilename)
-            self.process_zipfile(zipfilename)
+            if self.config.force or self.zipfile_changed(zipfilename, manifest):
+                zipfilenames.append(zipfilename)
+            else:
+                self.log.debug("%s: Unchanged, skipping" % zipfilename)
+        try:
+            if self.config.processes <= 1 or self.config.downloadmax:
+                # downloadmax needs an exact count over all zip files, so
+                # process them one at a time in this process
+                for zipfilename in zipfilenames:
+                    self.log.info("%s: Processing..." % zipfilename)
+                    basefiles = self.process_zipfile(zipfilename)
+                    self.record_zipfile(zipfilename, basefiles, manifest)
+                return
+            config = dict([(k, LayeredConfig.get(self.config, k))
+                           for k in self.config])
+            pool = multiprocessing.Pool(self.config.processes)
+            try:
+                for batch in self.zipfile_batches(zipfilenames):
+                    for zipfilename, basefiles in pool.map(
+                            _process_zipfile,
+                            [(self.__class__, config, zipfilename)
+                             for zipfilename in batch]):
+                        self.record_zipfile(zipfilename, basefiles, manifest)
+            finally:
+                pool.close()
+                pool.join()
+        finally:
+            self.save_zipmanifest(manifest)
+
+    def load_zipmanifest(self):
+        """Returns the zip manifest, a dict mapping the path (relative
+        to downloaded/zips) of each processed zip file to a dict with
+        its ``size``, ``mtime``, the ``crcs`` of its members and the
+        ``basefiles`` it contained."""
+        path = self.store.zipmanifest_path()
+        if os.path.exists(path):
+            with open(path) as fp:
+                return json.load(fp)
+        return {}
+
+    def save_zipmanifest(self, manifest):
+        util.writefile(self.store.zipmanifest_path(),
+                       json.dumps(manifest, indent=2, sort_keys=True))
+
+    def _zipmanifest_key(self, zipfilename):
+        zippath = self.store.path('', 'downloaded/zips', '')
+        return os.path.relpath(zipfilename, zippath).replace(os.sep, "/")
+
+    def _zipfile_crcs(self, zipfilename):
+        # only reads the central directory, not the members
+        with zipfile.ZipFile(zipfilename, "r") as zipf:
+            return [[self._zipmember_name(zi.filename), zi.CRC]
+                    for zi in zipf.infolist()]
+
+    def zipfile_changed(self, zipfilename, manifest):
+        """Returns False if zipfilename has already been processed and
+        is unchanged since. The size and mtime are checked first; only
+        if the mtime differs (eg. the file has been downloaded again)
+        is the zip file opened to compare its member CRCs."""
+        entry = manifest.get(self._zipmanifest_key(zipfilename))
+        if not entry:
+            return True
+        st = os.stat(zipfilename)
+        if st.st_size != entry['size']:
+            return True
+        if st.st_mtime == entry['mtime']:
+            return False
+        try:
+            if self._zipfile_crcs(zipfilename) != entry['crcs']:
+                return True
+        except zipfile.BadZipfile:
+            return True
+        entry['mtime'] = st.st_mtime
+        return False
+
+    def record_zipfile(self, zipfilename, basefiles, manifest):
+        if basefiles is None:  # not a valid zip file
+            return
+        st = os.stat(zipfilename)
+        manifest[self._zipmanifest_key(zipfilename)] = {
+            'size': st.st_size,
+            'mtime': st.st_mtime,
+            'crcs': self._zipfile_crcs(zipfilename),
+            'basefiles': sorted(set(basefiles))}
+
+    def zipfile_basefiles(self, zipfilename, manifest=None):
+        """Returns the basefiles that were created, replaced or removed
+        by zipfilename, as recorded by process_all_zipfiles."""
+        if manifest is None:
+            manifest = self.load_zipmanifest()
+        entry = manifest.get(self._zipmanifest_key(zipfilename))
+        return entry['basefiles'] if entry else []
+
+    def basefile_zipfiles(self, basefile, manifest=None):
+        """Returns the paths (relative to downloaded/zips) of all zip
+        files that contained basefile, in processing order."""
+        if manifest is None:
+            manifest = self.load_zipmanifest()
+        return [key for key in sorted(manifest.keys())
+                if basefile in manifest[key]['basefiles']]
+
+    def zipfile_batches(self, zipfilenames):
+        """Splits zipfilenames into consecutive batches, in order, such
+        that no two zip files in a batch contain the same document. The
+        zip files in a batch can be processed concurrently, but each
+        batch must be completed before the next one is started (a later
+        zip file might replace or remove a document from an earlier
+        one)."""
+        batches = []
+        seen = set()
+        for zipfilename in zipfilenames:
+            keys = set()
+            try:
+                with zipfile.ZipFile(zipfilename, "r") as zipf:
+                    for bname in zipf.namelist():
+                        keys.add(self.zipmember_key(self._zipmember_name(bname)))
+            except zipfile.BadZipfile:
+                pass  # process_zipfile will complain about this
+            if not batches or keys & seen:
+                batches.append([])
+                seen = set()
+            batches[-1].append(zipfilename)
+            seen.update(keys)
+        return batches
+
+    def _zipmember_name(self, bname):
+        if not isinstance(bname, str):  # py2
+            # Files in the zip file are encoded using codepage 437
+            return bname.decode('cp437')
+        return bname
+
+    def zipmember_key(self, name):
+        """Returns something that identifies the document(s) that the
+        zip member name will create, replace or remove."""
+        if "_notis_" in name:
+            segments = os.path.splitext(name)[0].split("_")
+            return ("notis", segments[0], segments[1])
+        m = self._zipmember_match(os.path.split(name)[1])
+        if m:
+            return self._zipmember_basefile(m)
+        return name
+
+    def _zipmember_match(self, name):
+        if 'BYTUT' in name:
+            return self.re_bytut_malnr.match(name)
+        elif 'TABORT' in name:
+            return self.re_tabort_malnr.match(name)
+        else:
+            return self.re_malnr.match(name)
+
+    def _zipmember_basefile(self, m):
+        (court, malnr, opt_referatnr, referatnr) = (
+            m.group(1), m.group(2), m.group(3), m.group(4))
+        if referatnr:
+            return "%s/%s_%s" % (court, malnr, referatnr)
+        elif opt_referatnr:
+            return "%s/%s_%s" % (court, malnr, opt_referatnr)
+        else:
+            return "%s/%s" % (court, malnr)
 
     def process_zipfile(self, zipfilename):
-        """Extract a named zipfile into appropriate documents"""
+        """Extract a named zipfile into appropriate documents. Returns
+        the list of basefiles that the zip file contained (or None, if
+        it isn't a valid zip file)."""
         removed = replaced = created = untouched = 0
+        basefiles = []
         if not hasattr(self, 'downloadcount'):
             self.downloadcount = 0
         try:
@@ -421,11 +1071,7 @@ class DV(SwedishLegalSource):
             self.log.error("%s is not a valid zip file: %s" % (zipfilename,e))
             return 
         for bname in zipf.namelist():
-            if not isinstance(bname, str):  # py2
-                # Files in the zip file are encoded using codepage 437
-                name = bname.decode('cp437')
-            else:
-                name = bname
+            name = self._zipmember_name(bname)
             if "_notis_" in name:
                 base, suffix = os.path.splitext(name)
                 segments = base.split("_")
@@ -435,33 +1081,23 @@ class DV(SwedishLegalSource):
                 # extract_notis extract individual parts of this file
                 # to individual basefiles
                 fp = tempfile.NamedTemporaryFile("wb", suffix=suffix, delete=False)
-                filebytes = zipf.read(bname)
-                fp.write(filebytes)
+                with zipf.open(bname) as member:
+                    shutil.copyfileobj(member, fp)
                 fp.close()
                 tempname = fp.name
-                r = self.extract_notis(tempname, year, coll)
+                r = self.extract_notis(tempname, year, coll, basefiles)
                 created += r[0]
                 untouched += r[1]
                 os.unlink(tempname)
             else:
                 name = os.path.split(name)[1]
-                if 'BYTUT' in name:
-                    m = self.re_bytut_malnr.match(name)
-                elif 'TABORT' in name:
-                    m = self.re_tabort_malnr.match(name)
-                else:
-                    m = self.re_malnr.match(name)
+                m = self._zipmember_match(name)
                 if m:
-                    (court, malnr, opt_referatnr, referatnr, suffix) = (
-                        m.group(1), m.group(2), m.group(3), m.group(4), m.group(5))
+                    suffix = m.group(5)
                     assert ((suffix == ".doc") or (suffix == ".docx")
                             ), "Unknown suffix %s in %r" % (suffix, name)
-                    if referatnr:
-                        basefile = "%s/%s_%s" % (court, malnr, referatnr)
-                    elif opt_referatnr:
-                        basefile = "%s/%s_%s" % (court, malnr, opt_referatnr)
-                    else:
-                        basefile = "%s/%s" % (court, malnr)
+                    basefile = self._zipmember_basefile(m)
+                    basefiles.append(basefile)
 
                     outfile = self.store.path(basefile, 'downloaded', suffix)
 
@@ -487,9 +1123,11 @@ class DV(SwedishLegalSource):
                         else:
                             created += 1
                     if not "TABORT" in name:
-                        data = zipf.read(bname)
-                        with self.store.open(basefile, "downloaded", suffix, "wb") as fp:
-                            fp.write(data)
+                        # copy the member in chunks instead of reading
+                        # it all into memory
+                        with zipf.open(bname) as member:
+                            with self.store.open(basefile, "downloaded", suffix, "wb") as fp:
+                                shutil.copyfileobj(member, fp)
 
                         # Make the unzipped files have correct timestamp
                         zi = zipf.getinfo(bname)
@@ -505,9 +1143,10 @@ class DV(SwedishLegalSource):
                                      (name, os.path.relpath(zipfilename)))
         self.log.debug('Processed %s, created %s, replaced %s, removed %s, untouched %s files' %
                        (os.path.relpath(zipfilename), created, replaced, removed, untouched))
+        return basefiles
 
 
-    def extract_notis(self, docfile, year, coll="HDO"):
+    def extract_notis(self, docfile, year, coll="HDO", basefiles=None):
         def find_month_in_previous(basefile):
             # The big word file with all notises might not
             # start with a month name -- try to find out
@@ -521,14 +1160,43 @@ class DV(SwedishLegalSource):
             prev_path = self.store.intermediate_path(prev_basefile)
             avd_p = None
             if os.path.exists(prev_path):
-                soup = BeautifulSoup(util.readfile(prev_path))
-                tmp = soup.find(["w:p", "para"])
-                if re_avdstart.match(tmp.get_text().strip()):
+                with open(prev_path, "rb") as fp:
+                    root, error = recovering_fromstring(fp.read())
+                self.log_recovered(prev_basefile, error)
+                tmp = next(root.iter(WNS + "p", "para"), None)
+                if (tmp is not None and
+                        re_avdstart.match("".join(tmp.itertext()).strip())):
                     avd_p = tmp
-            if not avd_p:
+            if avd_p is None:
                 raise RuntimeError("Cannot find value for month in %s (looked in %s" % (basefile, prev_path))
             return avd_p
 
+        def write_notis(basefile, body):
+            # The notis files are written exactly as they always have
+            # been (parse_not depends on the whitespace): OOXML ones
+            # pretty-printed (as _simplify_ooxml does), docbook ones
+            # with one paragraph per line, as set up below.
+            path = self.store.intermediate_path(basefile)
+            util.ensure_dir(path)
+            with open(path, "wb") as fp:
+                if filetype == "docx":
+                    fp.write(etree.tostring(body, pretty_print=True,
+                                            encoding="utf-8"))
+                else:
+                    fp.write(etree.tostring(body, encoding="utf-8") + b"\n")
+
+        def append_p(body, p, tail):
+            p = copy.deepcopy(p)
+            if filetype == "docx":
+                p.tail = None
+            else:
+                p.tail = tail
+                # write empty elements as <para></para>, not <para/>
+                for e in p.iter():
+                    if e.text is None and len(e) == 0:
+                        e.text = ""
+            body.append(p)
+
         # Given a word document containing a set of "notisfall" from
         # either HD or HFD (earlier RegR), spit out a intermediate XML
         # file for each notis.
@@ -543,81 +1211,107 @@ class DV(SwedishLegalSource):
         r = WordReader()
         intermediatefile, filetype = r.read(docfile, intermediatefile)
         if filetype == "docx":
+            # the whole file is simplified once, here. The paragraphs
+            # written to each notis file are therefore already
+            # simplified and merged.
             self._simplify_ooxml(intermediatefile, pretty_print=False)
-            soup = BeautifulSoup(util.readfile(intermediatefile))
-            soup = self._merge_ooxml(soup)
-            p_tag = "w:p"
-            xmlns = ' xmlns:w14="http://schemas.microsoft.com/office/word/2010/wordml" xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main" xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships"'
+            p_tag = WNS + "p"
+            # parsed, to keep the namespace declarations in this order
+            bodytemplate = '<body %s/>' % " ".join(
+                ['xmlns:%s="%s"' % (prefix, OOXML_NSMAP[prefix])
+                 for prefix in ('w14', 'w', 'r')])
         else:
-            soup = BeautifulSoup(util.readfile(intermediatefile))
             p_tag = "para"
-            xmlns = ''
-        iterator = soup.find_all(p_tag)
-        basefile = None
-        fp = None
-        avd_p = None
-        day = None
-        for p in iterator:
-            t = p.get_text().strip()
-            if re_avdstart:
-                # keep track of current month, store that in avd_p
-                m = re_avdstart.match(t)
-                if m:
-                    avd_p = p
-                    continue
+            bodytemplate = '<body>\n</body>'
+
+        def extract(events):
+            # iterate over the paragraphs as they're parsed, writing
+            # each notis as soon as the start of the next is found
+            created = 0
+            basefile = None
+            body = None
+            avd_p = None
+            day = None
+            for event, p in events:
+                if filetype == "docx":
+                    self._merge_ooxml_runs(p)
+                    # notis files have never kept any formatting
+                    # (parse_not doesn't expect it)
+                    for e in list(p.iter(WNS + "pPr", WNS + "rPr")):
+                        e.getparent().remove(e)
+                t = "".join(p.itertext()).strip()
+                if re_avdstart:
+                    # keep track of current month, store that in avd_p
+                    m = re_avdstart.match(t)
+                    if m:
+                        avd_p = copy.deepcopy(p)
+                        p.clear()
+                        continue
 
-            m = re_notisstart.match(t)
-            if m:
-                ordinal = m.group("ordinal")
-                try:
-                    if m.group("day"):
-                        day = m.group("day")
-                    else:
-                        # inject current day in the first text node of
-                        # p (which should inside of a <emphasis
-                        # role="bold" or equivalent).
-                        subnode = None
-                        # FIXME: is this a deprecated method?
-                        for c in p.recursiveChildGenerator():
-                            if isinstance(c, NavigableString):
-                                c.string.replace_with(day + str(c.string))
-                                break
-                except IndexError:
-                    pass
-
-                previous_basefile = basefile
-                basefile = "%(coll)s/%(year)s_not_%(ordinal)s" % locals()
-                self.log.info("%s: Extracting from %s file" % (basefile, filetype))
-                created += 1
-                downloaded_path = self.store.path(basefile, 'downloaded', '.'+filetype)
-                with self.store._open(downloaded_path, "w"): 
-                    pass # just create an empty placeholder file
-                if fp:
-                    fp.write("</body>\n")
-                    fp.close()
-                    if filetype == "docx":
-                        self._simplify_ooxml(self.store.intermediate_path(previous_basefile))
-                util.ensure_dir(self.store.intermediate_path(basefile))
-                fp = codecs.open(self.store.intermediate_path(basefile), "w", encoding="utf-8")
-                fp.write('<body%s>' % xmlns)
-                if filetype != "docx":
-                    fp.write("\n")
-                if coll == "HDO" and not avd_p:
-                    avd_p = find_month_in_previous(basefile)
-                if avd_p:
-                    fp.write(str(avd_p))
-            if fp:
-                fp.write(str(p))
-                if filetype != "docx":
-                    fp.write("\n")
-        if fp: # should always be the case
-            fp.write("</body>\n")
-            fp.close()
-            if filetype == "docx":
-                self._simplify_ooxml(self.store.intermediate_path(basefile))
-        else:
-            self.log.error("%s/%s: No notis were extracted (%s)" %
-                           (coll,year,docfile))
+                m = re_notisstart.match(t)
+                if m:
+                    ordinal = m.group("ordinal")
+                    try:
+                        if m.group("day"):
+                            day = m.group("day")
+                        else:
+                            # inject current day in the first text node of
+                            # p (which should inside of a <emphasis
+                            # role="bold" or equivalent).
+                            for c in p.xpath("(.//text())[1]"):
+                                if c.is_tail:
+                                    c.getparent().tail = day + str(c)
+                                else:
+                                    c.getparent().text = day + str(c)
+                    except IndexError:
+                        pass
+
+                    if body is not None:
+                        write_notis(basefile, body)
+                    basefile = "%(coll)s/%(year)s_not_%(ordinal)s" % locals()
+                    if basefiles is not None:
+                        basefiles.append(basefile)
+                    self.log.info("%s: Extracting from %s file" % (basefile, filetype))
+                    created += 1
+                    downloaded_path = self.store.path(basefile, 'downloaded', '.'+filetype)
+                    with self.store._open(downloaded_path, "w"):
+                        pass # just create an empty placeholder file
+                    body = etree.fromstring(bodytemplate)
+                    if coll == "HDO" and avd_p is None:
+                        avd_p = find_month_in_previous(basefile)
+                    if avd_p is not None:
+                        append_p(body, avd_p, None)
+                if body is not None:
+                    append_p(body, p, "\n")
+                p.clear()
+            if body is not None: # should always be the case
+                write_notis(basefile, body)
+            else:
+                self.log.error("%s/%s: No notis were extracted (%s)" %
+                               (coll,year,docfile))
+            return created
+
+        values = {'docfile': os.path.basename(docfile),
+                  'created': 0}
+        with util.logtime(self.log.info,
+                          "%(docfile)s: extracted %(created)s notis (%(elapsed).3f sec)",
+                          values):
+            found = len(basefiles) if basefiles is not None else 0
+            try:
+                created = extract(etree.iterparse(intermediatefile,
+                                                  tag=p_tag))
+            except etree.XMLSyntaxError as e:
+                # start over, extracting what can be extracted from the
+                # cleaned up file (the notis files written so far are
+                # written again)
+                self.log_recovered(docfile, e)
+                if basefiles is not None:
+                    del basefiles[found:]
+                with open(intermediatefile, "rb") as fp:
+                    data = sanitize_xml(fp.read())
+                created = extract(etree.iterparse(BytesIO(data), tag=p_tag,
+                                                  recover=True))
+            values['created'] = created
         return created, untouched
 
     re_delimSplit = re.compile("[;,] ?").split
@@ -702,8 +1396,7 @@ class DV(SwedishLegalSource):
         docfile = self.store.downloaded_path(doc.basefile)
 
         intermediatefile = self.store.intermediate_path(doc.basefile)
-        r = WordReader()
-        intermediatefile, filetype = r.read(docfile, intermediatefile)
+        intermediatefile, filetype = self.convert_word(docfile, intermediatefile)
 
         if filetype == "docx":
             self._simplify_ooxml(intermediatefile)
@@ -711,24 +1404,18 @@ class DV(SwedishLegalSource):
         with codecs.open(intermediatefile, encoding="utf-8") as fp:
             patchedtext, patchdesc = self.patch_if_needed(doc.basefile,
                                                           fp.read())
+        if filetype == "docx":
+            patchedtext = self._merge_ooxml(patchedtext, doc.basefile)
         # The second step is to mangle the crappy XML produced by
         # antiword (docbook) or Word 2007 (OOXML) into a nice pair of
         # structures. rawhead is a simple dict that we'll later transform
         # into a rdflib Graph. rawbody is a list of plaintext strings, each
         # representing a paragraph.
         #
-        # long-term FIXME: WordReader should expose a unified
-        # interface for handling both kinds of word files so that we
-        # wouldn't need both parse_ooxml() and
-        # parse_antiword_docbook(). This might require some other tool
+        # long-term FIXME: It might be better to use some other tool
         # than antiword for old .doc files, as this throws away a LOT
         # of info.
-        if "not" in doc.basefile:
-            rawhead, rawbody = self.parse_not(patchedtext, doc.basefile, filetype)
-        elif filetype == "docx":
-            rawhead, rawbody = self.parse_ooxml(patchedtext, doc.basefile)
-        else:
-            rawhead, rawbody = self.parse_antiword_docbook(patchedtext, doc.basefile)
+        rawhead, rawbody = self.parse_word(patchedtext, doc.basefile, filetype)
         sanitized_head = self.sanitize_metadata(rawhead, doc.basefile)
         doc.uri = self.polish_metadata(sanitized_head, doc)
         if patchdesc:
@@ -739,6 +1426,62 @@ class DV(SwedishLegalSource):
         return True
 
 
+    def wordcache_key(self, docfile):
+        """Returns a key for the conversion of docfile, based on its
+        contents and the version of the converter that WordReader uses
+        for it."""
+        if docfile.endswith("docx"):
+            converter = "ooxml"
+        else:
+            converter = "antiword %s" % get_antiword_version()
+        h = hashlib.sha1(("%s/ferenda %s\n" % (converter, ferenda.__version__)).encode("utf-8"))
+        with open(docfile, "rb") as fp:
+            for chunk in iter(lambda: fp.read(64 * 1024), b""):
+                h.update(chunk)
+        return h.hexdigest()
+
+    def wordcache_path(self, key, filetype):
+        return self.store.path(key[:2] + "/" + key[2:], "wordcache",
+                               ".%s.xml" % filetype)
+
+    def wordcache_record(self, outcome, key):
+        # parse_all_teardown summarizes these lines. The run log only
+        # exists during a full parse run. Several worker processes
+        # may append to it, which is safe for writes this small.
+        runlog = self.store.datadir + os.sep + "wordcache" + os.sep + "run.log"
+        if os.path.exists(runlog):
+            with open(runlog, "a") as fp:
+                fp.write("%s %s\n" % (outcome, key))
+
+    def convert_word(self, docfile, intermediatefile):
+        """Like WordReader.read, but if the ``wordcache`` option is set,
+        a document that has been converted before (with the same
+        converter version) is copied from the conversion cache instead
+        of being converted again."""
+        if (not self.config.wordcache) or os.path.getsize(docfile) == 0:
+            # notis have empty placeholder files, their intermediate
+            # files are created by extract_notis
+            return WordReader().read(docfile, intermediatefile)
+        key = self.wordcache_key(docfile)
+        for filetype in ("docx", "doc"):
+            cachefile = self.wordcache_path(key, filetype)
+            if os.path.exists(cachefile):
+                self.log.debug("%s: conversion cache hit" % docfile)
+                self.wordcache_record("hit", key)
+                util.ensure_dir(intermediatefile)
+                shutil.copy2(cachefile, intermediatefile)
+                return intermediatefile, filetype
+        self.log.debug("%s: conversion cache miss" % docfile)
+        self.wordcache_record("miss", key)
+        # WordReader reuses any existing intermediate file, which might
+        # have been converted from an earlier version of docfile
+        util.robust_remove(intermediatefile)
+        intermediatefile, filetype = WordReader().read(docfile, intermediatefile)
+        cachefile = self.wordcache_path(key, filetype)
+        util.ensure_dir(cachefile)
+        shutil.copy2(intermediatefile, cachefile)
+        return intermediatefile, filetype
+
     def parse_not(self, text, basefile, filetype):
         basefile_regex = re.compile("(?P<type>\w+)/(?P<year>\d+)_not_(?P<ordinal>\d+)")
         referat_templ = {'REG': 'RÅ %(year)s not %(ordinal)s',
@@ -755,7 +1498,6 @@ class DV(SwedishLegalSource):
         soup = BeautifulSoup(text)
         if filetype == "docx":
             ptag = "w:p"
-            soup = self._merge_ooxml(soup)
         else:
             ptag = "para"
 
@@ -868,30 +1610,59 @@ class DV(SwedishLegalSource):
                 body.append(line)
         return head, body
         
-    def parse_ooxml(self, text, basefile):
-        soup = BeautifulSoup(text)
-        soup = self._merge_ooxml(soup)
+    # all labels that parse_ooxml and parse_antiword_docbook look
+    # for, in a single regex
+    re_word_labels = re.compile(
+        "(%s):" % "|".join([re.escape(key) for key in
+                            list(labels) + ["Lagrum", "Rättsfall", "Sökord"]]),
+        flags=re.UNICODE)
+    re_litteratur = re.compile('^\s*Litteratur:\s*$', flags=re.UNICODE)
+    re_eferat = re.compile('EFERAT')
+    re_referat = re.compile('REFERAT')
+
+    def parse_word(self, text, basefile, filetype):
+        """Extracts metadata and body text from the (patched)
+        intermediate file of a Word document, no matter what kind of
+        Word document it was. Returns a (head, body) tuple, where head
+        is a dict of metadata fields and body a list of paragraphs."""
+        if "not" in basefile:
+            return self.parse_not(text, basefile, filetype)
+        elif filetype == "docx":
+            return self.parse_ooxml(text, basefile)
+        else:
+            return self.parse_antiword_docbook(text, basefile)
+
+    def log_recovered(self, basefile, error):
+        if error is not None:
+            self.log.warning("%s: Intermediate file is not well-formed (%s), "
+                             "parsing what can be parsed" % (basefile, error))
 
+    def parse_ooxml(self, text, basefile):
+        doc = WordDocument(text, {'w': OOXML_NSMAP['w']})
+        self.log_recovered(basefile, doc.error)
+        nodes = doc.find_labels(self.re_word_labels,
+                                {'EFERAT': self.re_eferat,
+                                 'Litteratur': self.re_litteratur})
         head = {}
         
         # Högst uppe på varje domslut står domstolsnamnet ("Högsta
         # domstolen") följt av referatnumret ("NJA 1987
         # s. 113").
-        firstfield = soup.find("w:t")
+        firstfield = next(doc.root.iter(WNS + "t"))
         # Ibland ärdomstolsnamnet uppsplittat på två
         # w:r-element. Bäst att gå på all text i
         # föräldra-w:tc-cellen
-        firstfield = firstfield.find_parent("w:tc")
-        head['Domstol'] = firstfield.get_text(strip=True)
+        firstfield = doc.find(firstfield, "ancestor::w:tc[1]")
+        head['Domstol'] = doc.get_text(firstfield)
 
-        nextfield = firstfield.find_next("w:tc")
-        head['Referat'] = nextfield.get_text(strip=True)
+        nextfield = doc.find_next(firstfield, "w:tc")
+        head['Referat'] = doc.get_text(nextfield)
         # Hitta övriga enkla metadatafält i sidhuvudet
         for key in self.labels:
             if key in head:
                 continue
-            node = soup.find(text=re.compile(key + ':'))
-            if not node:
+            node = nodes.get(key)
+            if node is None:
                 # Sometimes these text fields are broken up
                 # (eg "<w:t>Avgörand</w:t>...<w:t>a</w:t>...<w:t>tum</w:t>")
                 # Use (ridiculous) fallback method
@@ -899,20 +1670,22 @@ class DV(SwedishLegalSource):
                     self.log.warning("%s: Couldn't find field %r" % (basefile, key))
                 continue
 
-            txt = node.find_next("w:t").find_parent("w:p").get_text(strip=True)
+            txt = doc.get_text(doc.find(doc.find_next(node, "w:t"),
+                                        "ancestor::w:p[1]"))
             if txt:  # skippa fält med tomma strängen-värden
                 head[key] = txt
 
         # Hitta sammansatta metadata i sidhuvudet
         for key in ["Lagrum", "Rättsfall"]:
-            node = soup.find(text=re.compile(key + ':'))
-            if node:
-                textnodes = node.find_parent('w:tc').find_next_sibling('w:tc')
-                if not textnodes:
+            node = nodes.get(key)
+            if node is not None:
+                textnodes = doc.find(doc.find_parent(node, "w:tc"),
+                                     "following-sibling::w:tc[1]")
+                if textnodes is None:
                     continue
                 items = []
-                for textnode in textnodes.find_all('w:t'):
-                    t = textnode.get_text(strip=True)
+                for textnode in textnodes.iter(WNS + "t"):
+                    t = doc.get_text(textnode)
                     if t:
                         items.append(t)
                 if items:
@@ -920,32 +1693,45 @@ class DV(SwedishLegalSource):
 
         # The main text body of the verdict
         body = []
-        for p in soup.find(text=re.compile('EFERAT')).find_parent('w:tr').find_next_sibling('w:tr').find_all('w:p'):
-            ptext = ''
-            for e in p.find_all("w:t"):
-                ptext += e.string
-            body.append(ptext)
+        tr = doc.find_parent(nodes['EFERAT'], "w:tr")
+        for p in doc.find(tr, "following-sibling::w:tr[1]").iter(WNS + "p"):
+            body.append("".join([t.text or "" for t in p.iter(WNS + "t")]))
 
         # Finally, some more metadata in the footer
-        if soup.find(text=re.compile(r'Sökord:')):
-            head['Sökord'] = soup.find(
-                text=re.compile(r'Sökord:')).find_next('w:t').get_text(strip=True)
+        if 'Sökord' in nodes:
+            head['Sökord'] = doc.get_text(doc.find_next(nodes['Sökord'], "w:t"))
 
-        if soup.find(text=re.compile('^\s*Litteratur:\s*$')):
-            n = soup.find(text=re.compile('^\s*Litteratur:\s*$'))
-            head['Litteratur'] = n.findNext('w:t').get_text(strip=True)
+        if 'Litteratur' in nodes:
+            head['Litteratur'] = doc.get_text(doc.find_next(nodes['Litteratur'], "w:t"))
         return head, body
 
     def parse_antiword_docbook(self, text, basefile):
-        soup = BeautifulSoup(text)
+        doc = WordDocument(text)
+        self.log_recovered(basefile, doc.error)
+        nodes = doc.find_labels(self.re_word_labels,
+                                {'REFERAT': self.re_referat,
+                                 'Litteratur': self.re_litteratur})
+
+        def next_next_sibling_text(node):
+            # the text of node.next_sibling.next_sibling, where the
+            # tail text of an element counts as a sibling
+            if node.tail:
+                node = node.getnext()
+            else:
+                node = node.getnext()
+                if node.tail:
+                    return node.tail.strip()
+                node = node.getnext()
+            return doc.get_text(node)
+
         head = {}
-        header_elements = soup.find("para")
-        header_text = ''
-        for el in header_elements.contents:
-            if hasattr(el, 'name') and el.name == "informaltable":
+        header_elements = next(doc.root.iter("para"))
+        header_text = header_elements.text or ''
+        for el in header_elements:
+            if el.tag == "informaltable":
                 break
             else:
-                header_text += el.string
+                header_text += (doc.string(el) or '') + (el.tail or '')
 
         # Högst uppe på varje domslut står domstolsnamnet ("Högsta
         # domstolen") följt av referatnumret ("NJA 1987
@@ -959,40 +1745,45 @@ class DV(SwedishLegalSource):
             head['Referat'] = parts[1]
         else:
             # alternativ står de på första raden i en informaltable
-            row = soup.find("informaltable").tgroup.tbody.row.find_all('entry')
-            head['Domstol'] = row[0].get_text(strip=True)
-            head['Referat'] = row[1].get_text(strip=True)
+            row = doc.find(doc.root, "(//informaltable)[1]/descendant::tgroup[1]"
+                           "/descendant::tbody[1]/descendant::row[1]")
+            row = list(row.iter("entry"))
+            head['Domstol'] = doc.get_text(row[0])
+            head['Referat'] = doc.get_text(row[1])
 
         # Hitta övriga enkla metadatafält i sidhuvudet
         for key in self.labels:
-            node = soup.find(text=re.compile(key + ':'))
-            if node:
-                txt = node.find_parent('entry').find_next_sibling('entry').get_text(strip=True)
+            node = nodes.get(key)
+            if node is not None:
+                txt = doc.get_text(doc.find(doc.find_parent(node, 'entry'),
+                                            "following-sibling::entry[1]"))
                 if txt:
                     head[key] = txt
 
         # Hitta sammansatta metadata i sidhuvudet
         for key in ["Lagrum", "Rättsfall"]:
-            node = soup.find(text=re.compile(key + ':'))
-            if node:
+            node = nodes.get(key)
+            if node is not None:
                 head[key] = []
-                textchunk = node.find_parent(
-                    'entry').find_next_sibling('entry').string
+                textchunk = doc.string(doc.find(doc.find_parent(node, 'entry'),
+                                                "following-sibling::entry[1]"))
                 for line in [util.normalize_space(x) for x in textchunk.split("\n\n")]:
                     if line:
                         head[key].append(line)
 
         body = []
-        for p in soup.find(text=re.compile('REFERAT')).find_parent('tgroup').find_next_sibling('tgroup').find('entry').get_text(strip=True).split("\n\n"):
+        tgroup = doc.find(doc.find_parent(nodes['REFERAT'], 'tgroup'),
+                          "following-sibling::tgroup[1]")
+        for p in doc.get_text(next(tgroup.iter("entry"))).split("\n\n"):
             body.append(p)
 
         # Hitta sammansatta metadata i sidfoten
-        head['Sökord'] = soup.find(text=re.compile('Sökord:')).find_parent(
-            'entry').next_sibling.next_sibling.get_text(strip=True)
+        head['Sökord'] = next_next_sibling_text(
+            doc.find_parent(nodes['Sökord'], 'entry'))
 
-        if soup.find(text=re.compile('^\s*Litteratur:\s*$')):
-            n = soup.find(text=re.compile('^\s*Litteratur:\s*$')).find_parent(
-                'entry').next_sibling.next_sibling.get_text(strip=True)
+        if 'Litteratur' in nodes:
+            n = next_next_sibling_text(
+                doc.find_parent(nodes['Litteratur'], 'entry'))
             head['Litteratur'] = n
         return head, body
 
@@ -1304,6 +2095,21 @@ class DV(SwedishLegalSource):
 
     @staticmethod
     def get_parser(basefile):
+        """Returns the FSMParser for the court of basefile (eg "HDO"),
+        ready to parse a new document. The parser, with its compiled
+        matchers, is built once per court and process and then
+        reused."""
+        court = basefile.split("/")[0]
+        if court not in _parsers:
+            _parsers[court] = DV.make_parser(court)
+        p = _parsers[court]
+        # set by make_instans for the previously parsed document
+        if hasattr(p, 'current_instans'):
+            del p.current_instans
+        return p
+
+    @staticmethod
+    def make_parser(court):
         re_courtname = re.compile("^(Högsta domstolen|Hovrätten (över|för) [A-ZÅÄÖa-zåäö ]+|([A-ZÅÄÖ][a-zåäö]+ )(tingsrätt|hovrätt))(|, mark- och miljödomstolen|, Mark- och miljööverdomstolen)$")
 
 #         productions = {'karande': '..',
@@ -1320,60 +2126,71 @@ class DV(SwedishLegalSource):
                    'Högsta förvaltningsdomstolen) \((?P<date>\d+-\d+-\d+), '
                    '(?P<constitution>[\w\.\- ,]+)\)',
              'method': 'match',
+             'keywords': ('rätten i ', 'Högsta förvaltningsdomstolen'),
              'type': ('dom',),
              'court': ('REG', 'HFD', 'MIG')},
             {'name': 'tr-dom',
              're': '(?P<court>TR:n|Tingsrätten|HovR:n|Hovrätten|Mark- och miljödomstolen) \((?P<constitution>[\w\.\- ,]+)\) (anförde|fastställde|stadfäste|meddelade) (följande i |i beslut i |i |)(dom|beslut) (d\.|d|den) (?P<date>\d+ \w+\.? \d+)',
              'method': 'match',
+             'keywords': ('anförde', 'fastställde', 'stadfäste', 'meddelade'),
              'type': ('dom',),
              'court': ('HDO', 'HGO', 'HNN', 'HON', 'HSB', 'HSV', 'HVS')},
             {'name': 'hd-dom',
              're': 'Målet avgjordes efter huvudförhandling (av|i) (?P<court>HD) \((?P<constitution>[\w:\.\- ,]+)\),? som',
              'method': 'match',
+             'keywords': ('Målet avgjordes efter huvudförhandling',),
              'type': ('dom',),
              'court': ('HDO',)},
             {'name': 'hd-dom2',
              're': '(?P<court>HD) \((?P<constitution>[\w:\.\- ,]+)\) meddelade den (?P<date>\d+ \w+ \d+) följande',
              'method': 'match',
+             'keywords': ('meddelade den',),
              'type': ('dom',),
              'court': ('HDO',)},
             {'name': 'hd-fastst',
              're': '(?P<court>HD) \((?P<constitution>[\w:\.\- ,]+)\) (beslöt|fattade (slutligt|följande slutliga) beslut)',
              'method': 'match',
+             'keywords': ('beslöt', 'fattade'),
              'type': ('dom',)},
 
             {'name': 'mig-dom',
              're': '(?P<court>Kammarrätten i Stockholm, Migrationsöverdomstolen)  \((?P<date>\d+-\d+-\d+), (?P<constitution>[\w\.\- ,]+)\)',
              'method': 'match',
+             'keywords': ('Migrationsöverdomstolen',),
              'type': ('dom',),
              'court': ('MIG',)},
             {'name': 'mig-dom-alt',
              're': 'I sin dom avslog (?P<court>Förvaltningsrätten i Stockholm, migrationsdomstolen) \((?P<date>\d+- ?\d+-\d+), (?P<constitution>[\w\.\- ,]+)\)',
              'method': 'match',
+             'keywords': ('I sin dom avslog',),
              'type': ('dom',),
              'court': ('MIG',)},
             {'name': 'allm-åkl',
              're': 'Allmän åklagare yrkade (.*)vid (?P<court>(([A-ZÅÄÖ]'
                    '[a-zåäö]+ )+)(TR|tingsrätt))',
              'method': 'match',
+             'keywords': ('Allmän åklagare yrkade',),
              'type': ('instans',),
              'court': ('HDO', 'HGO', 'HNN', 'HON', 'HSB', 'HSV', 'HVS')},
             {'name': 'stämning',
              're': 'stämning å (?P<svarande>.*) vid (?P<court>(([A-ZÅÄÖ]'
                    '[a-zåäö]+ )+)(TR|tingsrätt))',
              'method': 'search',
+             'keywords': ('stämning å',),
              'type': ('instans',),
              'court': ('HDO', 'HGO', 'HNN', 'HON', 'HSB', 'HSV', 'HVS')},
             {'name': 'ansökan',
              're': 'ansökte vid (?P<court>(([A-ZÅÄÖ][a-zåäö]+ )+)'
                    '(TR|tingsrätt)) om ',
              'method': 'search',
+             'keywords': ('ansökte vid',),
              'type': ('instans',),
              'court': ('HDO', 'HGO', 'HNN', 'HON', 'HSB', 'HSV', 'HVS')},
             {'name': 'riksåkl',
              're': 'Riksåklagaren väckte i (?P<court>HD|HovR:n (över|för) '
                    '([A-ZÅÄÖ][a-zåäö]+ )+|[A-ZÅÄÖ][a-zåäö]+ HovR) åtal',
                    'method': 'match',
+                   'keywords': ('Riksåklagaren väckte i',),
              'type': ('instans',),
              'court': ('HDO', 'HGO', 'HNN', 'HON', 'HSB', 'HSV', 'HVS')},
             {'name': 'tr-överkl',
@@ -1382,44 +2199,52 @@ class DV(SwedishLegalSource):
                    '(över|för) (Skåne och Blekinge|Västra Sverige|Nedre '
                    'Norrland|Övre Norrland)|(Svea|Göta) (HovR|hovrätt))',
                    'method': 'match',
+                   'keywords': ('fullföljde talan', 'överklagade'),
              'type': ('instans',),
              'court': ('HDO', 'HGO', 'HNN', 'HON', 'HSB', 'HSV', 'HVS')},
             {'name': 'fullfölj-överkl',
              're': '(?P<karanden>[\w\.\(\)\- ]+) fullföljde sin talan$',
              'method': 'match',
+             'keywords': ('fullföljde sin talan',),
              'type': ('instans',)},
             {'name': 'myndighetsansökan',
              're': 'I (ansökan|en ansökan|besvär) hos (?P<court>\w+) '
                    '(om förhandsbesked|yrkade)',
              'method': 'match',
+             'keywords': ('om förhandsbesked', 'yrkade'),
              'type': ('instans',),
              'court': ('REG', 'HFD')},
             {'name': 'myndighetsbeslut',
              're': '(?P<court>\w+) beslutade (därefter |)(den (?P<date>\d+ \w+ \d+)|'
                    '[\w ]+) att',
              'method': 'match',
+             'keywords': (' beslutade ',),
              'type': ('instans',),
              'court': ('REG', 'HFD', 'MIG')},
             {'name': 'myndighetsbeslut2',
              're': '(?P<court>[\w ]+) (bedömde|vägrade) i (bistånds|)beslut'
                    ' (|den (?P<date>\d+ \w+ \d+))',
              'method': 'match',
+             'keywords': ('bedömde i ', 'vägrade i '),
              'type': ('instans',),
              'court': ('REG', 'HFD')},
             {'name': 'hd-revision',
              're': '(?P<karanden>[\w\.\(\)\- ]+) sökte revision och yrkade(,'
                    'i första hand,|,|) att (?P<court>HD|)',
              'method': 'match',
+             'keywords': ('sökte revision och yrkade',),
              'type': ('instans',),
              'court': ('HDO',)},
             {'name': 'hd-revision2',
              're': '(?P<karanden>[\w\.\(\)\- ]+) sökte revision$',
              'method': 'match',
+             'keywords': ('sökte revision',),
              'type': ('instans',),
              'court': 'HDO'},
             {'name': 'hd-revision3',
              're': '(?P<karanden>[\w\.\(\)\- ]+) sökte revision och framställde samma yrkanden',
              'method': 'match',
+             'keywords': ('sökte revision och framställde samma yrkanden',),
              'type': ('instans',),
              'court': 'HDO'},
             {'name': 'överklag-bifall',
@@ -1427,6 +2252,7 @@ class DV(SwedishLegalSource):
                    'överklagade) och yrkade bifall till (sin talan i '
                    '(?P<prevcourt>HovR:n|TR:n)|)',
              'method': 'match',
+             'keywords': ('och yrkade bifall till',),
              'type': ('instans',),
              'court': ('HDO', 'HGO', 'HNN', 'HON', 'HSB', 'HSV', 'HVS')},
             {'name': 'överklag-2',
@@ -1434,65 +2260,121 @@ class DV(SwedishLegalSource):
                    '(för egen del |)och yrkade (i själva saken |)att '
                    '(?P<court>HD|HovR:n|kammarrätten|Regeringsrätten|)',
              'method': 'match',
+             'keywords': (' överklagade ',),
              'type': ('instans',)},
             {'name': 'överklag-3',
              're': '(?P<karanden>[\w\.\(\)\- ]+) överklagade (?P<prevcourt>'
                    '\w+)s (beslut|dom)( i ersättningsfrågan|) (hos|till) '
                    '(?P<court>[\w\, ]+)( och|, som)',
              'method': 'match',
+             'keywords': (' överklagade ',),
              'type': ('instans',)},
             {'name': 'överklag-4',
              're': '(?P<karanden>[\w\.\(\)\- ]+) överklagade (beslutet|'
                    'domen)( och|$)',
              'method': 'match',
+             'keywords': (' överklagade ',),
              'type': ('instans',)},
             {'name': 'hd-ansokan',
              're': '(?P<karanden>[\w\.\(\)\- ]+) anhöll i ansökan som inkom '
                    'till (?P<court>HD) d \d+ \w+ \d+',
              'method': 'match',
+             'keywords': (' anhöll i ansökan som inkom till HD d ',),
              'type': ('instans',),
              'court': ('HDO',)},
             {'name': 'hd-skrivelse',
              're': '(?P<karanden>[\w\.\(\)\- ]+) anförde i en till '
                    '(?P<court>HD) den \d+ \w+ \d+ ställd',
              'method': 'match',
+             'keywords': (' anförde i en till HD den ',),
              'type': ('instans',),
              'court': ('HDO',)},
             {'name': 'överklag-5',
              're': '(?P<karanden>[\w\.\(\)\- ]+) överklagade '
                    '(?P<prevcourt>\w+)s (dom|domar)',
              'method': 'match',
+             'keywords': (' överklagade ',),
              'type': ('instans',)},
             {'name': 'överklag-6',
              're': '(?P<karanden>[\w\.\(\)\- ]+) överklagade domen till '
                    '(?P<court>\w+)($| och yrkade)',
              'method': 'match',
+             'keywords': (' överklagade domen till ',),
              'type': ('instans',)},
             {'name': 'myndighetsbeslut3',
              're': 'I sitt beslut den (?P<date>\d+ \w+ \d+) avslog '
                    '(?P<court>\w+)',
              'method': 'match',
+             'keywords': ('I sitt beslut den ',),
              'type': ('instans',),
              'court': ('REG', 'HFD', 'MIG')}
         )
-        court = basefile.split("/")[0]
         matchers = defaultdict(list)
         matchersname = defaultdict(list)
+        # A pattern with keywords can only match a sentence that
+        # contains at least one of them. For each type, map each
+        # keyword to the positions (in matchers[t]) of the patterns
+        # that require it, so that only those patterns (and the ones
+        # without keywords) need to be tried for a sentence.
+        keywordindex = defaultdict(lambda: defaultdict(set))
+        unindexed = defaultdict(set)
         for pat in rx:
             if 'court' not in pat or court in pat['court']:
                 for t in pat['type']:
                     # print("Adding pattern %s to %s" %  (pat['name'], t))
+                    idx = len(matchers[t])
                     matchers[t].append(getattr(re.compile(pat['re'], re.UNICODE), pat['method']))
                     matchersname[t].append(pat['name'])
-            
-            
+                    if 'keywords' in pat:
+                        for keyword in pat['keywords']:
+                            keywordindex[t][keyword].add(idx)
+                    else:
+                        unindexed[t].add(idx)
+
+        def candidate_matchers(t, sentence):
+            # returns (matcher, name) for all patterns of type t that
+            # might match sentence, in the order they're defined in rx
+            idxs = set(unindexed[t])
+            for keyword, keywordidxs in keywordindex[t].items():
+                if keyword in sentence:
+                    idxs.update(keywordidxs)
+            return [(matchers[t][i], matchersname[t][i]) for i in sorted(idxs)]
+
+        # Turns out, this is really difficult if you consider
+        # abbreviations.  This particular heuristic splits on periods
+        # only (Sentences ending with ? or ! are rare in legal text)
+        # and only if followed by a capital letter (ie next sentence)
+        # or EOF. Does not handle things like "Mr. Smith" but that's
+        # also rare in swedish text.
+        def split_sentences(normalized):
+            return re.split("\. (?=[A-ZÅÄÖ]|$)", normalized + " ")
+
+        # Each chunk is examined by several recognizers (and then by
+        # its constructor) before the parser moves on. Compute what
+        # they need from it once, and keep it until another chunk is
+        # examined.
+        lastfeatures = [None, None]
+
+        def chunk_features(chunk):
+            if lastfeatures[0] is chunk:
+                return lastfeatures[1]
+            text = str(chunk)
+            normalized = util.normalize_space(text)
+            features = {'text': text,
+                        'normalized': normalized,
+                        'sentences': split_sentences(normalized),
+                        'firstword': text.split(" ", 1)[0],
+                        'length': len(text)}
+            lastfeatures[:] = [chunk, features]
+            return features
+
         def is_delmal(parser):
             # should handle "IV" and "I (UM1001-08)"
-            strchunk = str(parser.reader.peek())
-            if (len(strchunk) < 20 and
-                not strchunk.endswith(".") and
-                strchunk.split(" ",1)[0] in ("I", "II", "III", "IV")):
-                return {'id': strchunk.split(" ",1)[0]}
+            f = chunk_features(parser.reader.peek())
+            if (f['length'] < 20 and
+                not f['text'].endswith(".") and
+                f['firstword'] in ("I", "II", "III", "IV")):
+                return {'id': f['firstword']}
             else:
                 return {}
                 
@@ -1500,9 +2382,7 @@ class DV(SwedishLegalSource):
             """Determines whether the current position starts a new instans part of the report.
 
             """
-            chunk = parser.reader.peek()
-            strchunk = str(chunk)
-            res = analyze_instans(strchunk)
+            res = analyze_instans(chunk_features(parser.reader.peek()))
             if res:
                 # in some referats, two subsequent chunks both matches
                 # analyze_instans, even though they refer to the _same_
@@ -1544,63 +2424,52 @@ class DV(SwedishLegalSource):
                 return courtname.replace("HD", "Högsta domstolen").replace("HovR", "Hovrätt")
 
         def is_heading(parser):
-            chunk = parser.reader.peek()
-            strchunk = str(chunk)
+            f = chunk_features(parser.reader.peek())
+            strchunk = f['text']
             # a heading is reasonably short and does not end with a
             # period (or other sentence ending typography)
-            return len(strchunk) < 140 and not (strchunk.endswith(".") or
-                                                strchunk.endswith(":") or
-                                                strchunk.startswith("”"))
+            return f['length'] < 140 and not (strchunk.endswith(".") or
+                                              strchunk.endswith(":") or
+                                              strchunk.startswith("”"))
                                             
 
         def is_betankande(parser):
-            strchunk = str(parser.reader.peek())
+            strchunk = chunk_features(parser.reader.peek())['text']
             return strchunk == "Målet avgjordes efter föredragning."
             
         def is_dom(parser):
-            strchunk = str(parser.reader.peek())
-            res = analyze_dom(strchunk)
+            res = analyze_dom(chunk_features(parser.reader.peek()))
             return res
 
         def is_domskal(parser):
-            strchunk = str(parser.reader.peek())
+            strchunk = chunk_features(parser.reader.peek())['text']
             if re.match("(Skäl|Domskäl|HovR:ns domskäl|Hovrättens domskäl)(\. |$)", strchunk):
                 return True
             if re.match("(Tingsrätten|TR[:\.]n|Hovrätten|HD|Högsta förvaltningsdomstolen) \([^)]*\) (meddelade|anförde|fastställde|yttrade)", strchunk):
                 return True
 
         def is_domslut(parser):
-            strchunk = str(parser.reader.peek())
+            strchunk = chunk_features(parser.reader.peek())['text']
             return strchunk in ("Domslut", "Hovrättens avgörande", "HD:s avgörande", "Högsta förvaltningsdomstolens avgörande")
             
         def is_skiljaktig(parser):
-            strchunk = str(parser.reader.peek())
+            strchunk = chunk_features(parser.reader.peek())['text']
             return re.match("(Justitie|Kammarrätts)råde[nt] ([^\.]*) var (skiljaktig|av skiljaktig mening)", strchunk)
 
         def is_tillagg(parser):
-            strchunk = str(parser.reader.peek())
+            strchunk = chunk_features(parser.reader.peek())['text']
             return re.match("Justitieråde[nt] ([^\.]*) (tillade för egen del|gjorde för egen del ett tillägg)", strchunk)
 
         def is_endmeta(parser):
-            strchunk = str(parser.reader.peek())
+            strchunk = chunk_features(parser.reader.peek())['text']
             return re.match("HD:s (beslut|dom) meddela(de|d|t): den", strchunk)
 
         def is_paragraph(parser):
             return True
 
-        # Turns out, this is really difficult if you consider
-        # abbreviations.  This particular heuristic splits on periods
-        # only (Sentences ending with ? or ! are rare in legal text)
-        # and only if followed by a capital letter (ie next sentence)
-        # or EOF. Does not handle things like "Mr. Smith" but that's
-        # also rare in swedish text.
-        def split_sentences(text):
-            text = util.normalize_space(text)
-            text += " "
-            return re.split("\. (?=[A-ZÅÄÖ]|$)", text)
-
-        def analyze_instans(strchunk):
+        def analyze_instans(features):
             res = {}
+            strchunk = features['text']
             # Case 1: Fixed headings indicating new instance
             if re_courtname.match(strchunk):
                 res['court'] = strchunk
@@ -1618,8 +2487,8 @@ class DV(SwedishLegalSource):
                 # (occassionally 3rd), searching more yields risk of
                 # false positives.
                 
-                for sentence in split_sentences(strchunk)[:3]:
-                    for (r, rname) in zip(matchers['instans'], matchersname['instans']):
+                for sentence in features['sentences'][:3]:
+                    for (r, rname) in candidate_matchers('instans', sentence):
                         m = r(sentence)
                         if m:
                             # print("Matcher '%s' succeeded on '%s'" % (rname, sentence))
@@ -1631,23 +2500,18 @@ class DV(SwedishLegalSource):
                             #if 'prevcourt' in mg and mg['prevcourt']:
                             #    res['prevcourt'] = mg['prevcourt'].strip()
                             if 'date' in mg and mg['date']:
-                                parse_swed = DV().parse_swedish_date
-                                parse_iso = DV().parse_iso_date
-                                try:
-                                    res['date'] = parse_swed(mg['date'])
-                                except ValueError:
-                                    res['date'] = parse_iso(mg['date'])
+                                res['date'] = parse_date(mg['date'])
                             return res
             return res
 
-        def analyze_dom(strchunk):
+        def analyze_dom(features):
             res = {}
             # special case for "referat" who are nothing but straight verdict documents.
-            if strchunk.strip() == "SAKEN":
+            if features['normalized'] == "SAKEN":
                 return {'court': True}
             # probably only the 1st sentence is interesting
-            for sentence in split_sentences(strchunk)[:1]:
-                for (r, rname) in zip(matchers['dom'], matchersname['dom']):
+            for sentence in features['sentences'][:1]:
+                for (r, rname) in candidate_matchers('dom', sentence):
                     m = r(sentence)
                     if m:
                         # print("Matcher '%s' succeeded on '%s'" % (rname, sentence))
@@ -1655,12 +2519,7 @@ class DV(SwedishLegalSource):
                         if 'court' in mg and mg['court']:
                             res['court'] = mg['court'].strip()
                         if 'date' in mg and mg['date']:
-                            parse_swed = DV().parse_swedish_date
-                            parse_iso = DV().parse_iso_date
-                            try:
-                                res['date'] = parse_swed(mg['date'])
-                            except ValueError:
-                                res['date'] = parse_iso(mg['date'])
+                            res['date'] = parse_date(mg['date'])
                         #if 'constitution' in mg:
                         #    res['constitution'] = parse_constitution(mg['constitution'])
                         return res
@@ -1705,8 +2564,9 @@ class DV(SwedishLegalSource):
         @newstate('instans')
         def make_instans(parser):
             chunk = parser.reader.next()
-            strchunk = str(chunk)
-            idata = analyze_instans(strchunk)
+            features = chunk_features(chunk)
+            strchunk = features['text']
+            idata = analyze_instans(features)
             # idata may be {} if the special toplevel rule in is_instans applied
             # assert idata
             if 'complete' in idata:
@@ -1734,7 +2594,7 @@ class DV(SwedishLegalSource):
         def make_dom(parser):
             # fix date, constitution etc. Note peek() instead of read() --
             # this is so is_domskal can have a chance at the same data
-            ddata = analyze_dom(str(parser.reader.peek()))
+            ddata = analyze_dom(chunk_features(parser.reader.peek()))
             d = Dom(avgorandedatum=ddata.get('date'),
                     malnr=ddata.get('caseid'))
             return parser.make_children(d)
@@ -1769,7 +2629,7 @@ class DV(SwedishLegalSource):
             
         def make_paragraph(parser):
             chunk = parser.reader.next()
-            strchunk = str(chunk)
+            strchunk = chunk_features(chunk)['text']
             if ordered(strchunk):
                 # FIXME: Cut the ordinal from chunk somehow
                 if isinstance(chunk, Paragraph):
@@ -1877,51 +2737,43 @@ class DV(SwedishLegalSource):
     def _simplify_ooxml(self, filename, pretty_print=True):
         # simplify the horrendous mess that is OOXML through simplify-ooxml.xsl
         with open(filename, "rb") as fp:
-            data = fp.read()
-            # in some rare cases, the value \xc2\x81 (utf-8 for
-            # control char) is used where "Å" (\xc3\x85) should be
-            # used.
-            if b"\xc2\x81" in data:
-                self.log.warning("Working around control char x81 in text data")
-                data = data.replace(b"\xc2\x81", b"\xc3\x85")
-            intree = etree.parse(BytesIO(data))
-            # intree = etree.parse(fp)
-        fp = pkg_resources.resource_stream('ferenda', "res/xsl/simplify-ooxml.xsl")
-        transform = etree.XSLT(etree.parse(fp))
-        fp.close()
-        resulttree = transform(intree)
+            reader = ControlCharReader(fp)
+            intree = etree.parse(reader)
+        if reader.replaced:
+            self.log.warning("Working around control char x81 in text data")
+        resulttree = get_simplify_transform()(intree)
         with open(filename, "wb") as fp:
             fp.write(etree.tostring(resulttree, pretty_print=pretty_print, encoding="utf-8"))
 
+    def _merge_ooxml(self, text, basefile=None):
+        # The simplified OOXML often contains unneccessarily
+        # splitted runs (eg "<w:t>Avgörand</w:t>...<w:t>a</w:t>...
+        # <w:t>tum</w:t>"). Join these. This is done on the patched
+        # text (not as part of _simplify_ooxml), since patches are
+        # made against the unmerged intermediate file.
+        root, error = recovering_fromstring(text.encode("utf-8"))
+        self.log_recovered(basefile, error)
+        for p in root.iter(WNS + "p"):
+            self._merge_ooxml_runs(p)
+        return etree.tostring(root, encoding="utf-8").decode("utf-8")
+
+    def _merge_ooxml_runs(self, p):
+        # joins adjacent w:r elements in a single w:p element if their
+        # formatting instructions (bold, italic) are identical
+        current_r = current_rpr = None
+        for r in list(p.iter(WNS + "r")):
+            rpr = r.find(WNS + "rPr")
+            if rpr is not None:
+                rpr = etree.tostring(rpr, with_tail=False)
+            if current_r is not None and current_rpr == rpr:
+                ts = current_r.findall(WNS + "t")
+                assert len(ts) == 1, "w:r should not contain exactly one w:t"
+                ts[0].text = (ts[0].text or "") + (r.findtext(WNS + "t") or "")
+                r.getparent().remove(r)
+            else:
+                current_r, current_rpr = r, rpr
+        return p
 
-    def _merge_ooxml(self, soup):
-        # this is a similar step to _simplify_ooxml, but merges w:p
-        # elements in a BeautifulSoup tree. This step probably should
-        # be performed through XSL and be put in _simplify_ooxml as
-        # well.
-                # The soup now contains a simplified version of OOXML where
-        # lot's of nonessential tags has been stripped. However, the
-        # central w:p tag often contains unneccessarily splitted
-        # subtags (eg "<w:t>Avgörand</w:t>...<w:t>a</w:t>...
-        # <w:t>tum</w:t>"). Attempt to join these
-        #
-        # FIXME: This could be a part of simplify_ooxml instead.
-        for p in soup.find_all("w:p"):
-            current_r = None
-            for r in p.find_all("w:r"):
-                # find out if formatting instructions (bold, italic)
-                # are identical
-                if current_r and current_r.find("w:rpr") == r.find("w:rpr"):
-                    # ok, merge
-                    ts = list(current_r.find_all("w:t"))
-                    assert len(ts) == 1, "w:r should not contain exactly one w:t"
-                    ns = ts[0].string
-                    ns.replace_with(str(ns) + r.find("w:t").string)
-                    r.decompose()
-                else:
-                    current_r = r
-        return soup
-    
     def facets(self):
         # NOTE: it's important that RPUBL.rattsfallspublikation is the
         # first facet (toc_pagesets depend on it)
@@ -1978,6 +2830,11 @@ class DV(SwedishLegalSource):
                                          value=value))
         return list(pagesetdict.values())
 
+    def toc_sortkey(self, row):
+        # "NJA 2009 s. 95" < "NJA 2009 s. 695": compare the numeric
+        # parts of the identifier as numbers
+        return (numsortkey(row.get('dcterms_identifier', '')), row['uri'])
+
     def toc_select_for_pages(self, data, pagesets, facets):
         facet = facets[0]
         res = {}
@@ -1986,17 +2843,117 @@ class DV(SwedishLegalSource):
             key = facet.selector(row, None)
             if key not in documents:
                 documents[key] = []
-            documents[key].append(row)
+            documents[key].append((self.toc_sortkey(row), row))
         pagesetdict = {}
         for pageset in pagesets:
             pagesetdict[util.uri_leaf(pageset.predicate)] = pageset
+        # remember a digest of the rows making up each page, so that
+        # toc_generate_pages can tell which pages have changed
+        self._toc_digests = {}
         for (binding, value) in sorted(documents.keys()):
             pageset = pagesetdict[binding]
-            s = sorted(documents[(binding, value)])
+            rows = [row for (sortkey, row) in
+                    sorted(documents[(binding, value)], key=itemgetter(0))]
             res[(binding, value)] = [self.toc_item(binding, row)
-                                     for row in s]
+                                     for row in rows]
+            self._toc_digests["%s/%s" % (binding, value)] = hashlib.sha1(
+                json.dumps([[row['uri'],
+                             row.get('dcterms_identifier'),
+                             row.get('rpubl_referatrubrik')] for row in rows]
+                           ).encode('utf-8')).hexdigest()
         return res
 
+    # the template and template dirs that
+    # DocumentRepository.toc_generate_page passes to Transformer
+    toc_template = "res/xsl/toc.xsl"
+    toc_templatedirs = ["res/xsl"]
+
+    def toc_stylesheets(self):
+        """Returns a dict mapping the file name of each stylesheet that
+        the Transformer used by toc_generate_page compiles to its
+        absolute path. Like Transformer, later template dirs override
+        earlier ones, and template dirs that don't exist are taken
+        from the ferenda package."""
+        stylesheets = {}
+        for d in self.toc_templatedirs:
+            if not os.path.isdir(d):
+                d = pkg_resources.resource_filename('ferenda', d)
+            d = os.path.abspath(d)
+            if os.path.isdir(d):
+                for f in os.listdir(d):
+                    stylesheets[f] = d + os.sep + f
+        name = os.path.basename(self.toc_template)
+        if name not in stylesheets and os.path.exists(self.toc_template):
+            stylesheets[name] = os.path.abspath(self.toc_template)
+        return stylesheets
+
+    def toc_stylesheet_digest(self):
+        """Returns a digest of everything besides the documents
+        themselves that goes into a TOC page: the stylesheets (see
+        toc_stylesheets) and the site configuration
+        (resources.xml). Only file names and contents are digested, so
+        the same stylesheets give the same digest wherever they are."""
+        h = hashlib.sha1()
+        files = sorted(self.toc_stylesheets().items())
+        files.append(('resources.xml',
+                      os.path.abspath(os.sep.join([self.config.datadir,
+                                                   'rsrc',
+                                                   'resources.xml']))))
+        for name, f in files:
+            if os.path.isfile(f):
+                h.update(name.encode('utf-8'))
+                with open(f, "rb") as fp:
+                    h.update(fp.read())
+        return h.hexdigest()
+
+    def toc_generate_pages(self, pagecontent, pagesets, otherrepos=[]):
+        # Only regenerate pages whose documents have changed since the
+        # last run, as recorded in toc/buckets.json. Since every page
+        # links to all other pages, all pages are regenerated if the
+        # set of pages has changed. The same goes for changes to the
+        # stylesheets or site configuration.
+        manifestfile = self.store.resourcepath("toc/buckets.json")
+        if os.path.exists(manifestfile):
+            with open(manifestfile) as fp:
+                manifest = json.load(fp)
+        else:
+            manifest = {'pages': [], 'buckets': {}}
+        pages = sorted(self._toc_digests.keys())
+        stylesheets = self.toc_stylesheet_digest()
+        regenerate_all = (self.config.force or
+                          pages != manifest['pages'] or
+                          stylesheets != manifest.get('stylesheets'))
+        paths = []
+        self._toc_changed = set()
+        for (binding, value), documents in sorted(pagecontent.items()):
+            page = "%s/%s" % (binding, value)
+            outfile = self.store.resourcepath("toc/%s.html" % page)
+            if (regenerate_all or
+                    manifest['buckets'].get(page) != self._toc_digests[page] or
+                    not os.path.exists(outfile)):
+                self._toc_changed.add((binding, value))
+                paths.append(self.toc_generate_page(
+                    binding, value, documents, pagesets, None, otherrepos))
+        self.log.debug("toc: regenerated %s of %s pages" %
+                       (len(self._toc_changed), len(pagecontent)))
+        util.writefile(manifestfile, json.dumps({'pages': pages,
+                                                 'stylesheets': stylesheets,
+                                                 'buckets': self._toc_digests},
+                                                indent=2, sort_keys=True))
+        return paths
+
+    def toc_generate_first_page(self, pagecontent, pagesets, otherrepos=[]):
+        firstpage = pagesets[0].pages[0]
+        tocindex = self.store.resourcepath("toc/index.html")
+        if ((firstpage.binding, firstpage.value) not in self._toc_changed and
+                os.path.exists(tocindex)):
+            # toc() uses the timestamp of index.html to see if the
+            # TOC is up to date
+            os.utime(tocindex, None)
+            return tocindex
+        return super(DV, self).toc_generate_first_page(pagecontent, pagesets,
+                                                      otherrepos)
+
     def toc_item(self, binding, row):
         r = [Strong([Link(row['dcterms_identifier'],
                           uri=row['uri'])])]
@@ -2017,3 +2974,65 @@ class DV(SwedishLegalSource):
             'http://rinfo.lagrummet.se/ref/rff/mod': 'Miljööverdomstolen'
             }
 
+
+
+if __name__ == '__main__':
+    # Microbenchmarks:
+    #
+    # "python dv.py simplify FILE..." simplifies each of the given raw
+    # OOXML files (eg. word/document.xml from a downloaded .docx file)
+    # first with a newly compiled stylesheet per document, as
+    # _simplify_ooxml used to do, then with the shared compiled one.
+    #
+    # "python dv.py dates" parses the body of a synthetic, date-heavy
+    # REG decision, then parses the dates found in it with a new DV
+    # instance per date (as the body parser used to do) and with
+    # parse_date.
+    import sys
+    from time import time
+    if sys.argv[1:2] == ["simplify"]:
+        filenames = sys.argv[2:]
+        repo = DV()
+        tmpdir = tempfile.mkdtemp()
+        tmpfile = os.path.join(tmpdir, "document.xml")
+        try:
+            for label, cached in (("new stylesheet per document", False),
+                                  ("shared stylesheet", True)):
+                get_simplify_transform()
+                start = time()
+                for filename in filenames:
+                    if not cached:
+                        _simplify_transform = None
+                    shutil.copy(filename, tmpfile)
+                    repo._simplify_ooxml(tmpfile)
+                elapsed = time() - start
+                print("%s: %s documents in %.3f sec (%.2f ms/document)" %
+                      (label, len(filenames), elapsed,
+                       elapsed * 1000 / max(1, len(filenames))))
+        finally:
+            shutil.rmtree(tmpdir)
+    elif sys.argv[1:2] == ["dates"]:
+        months = sorted(DV.swedish_months)
+        dates = ["%s %s %s" % (day, months[day % len(months)], 1990 + day % 20)
+                 for day in range(1, 29)]
+        paras = []
+        for i in range(50):
+            for d in dates:
+                paras.append("Skatteverket beslutade den %s att inte "
+                             "medge avdrag." % d)
+                paras.append("Bolaget överklagade beslutet.")
+        start = time()
+        DV.get_parser("REG/1").parse(paras)
+        print("parsed %s paragraphs in %.3f sec" % (len(paras), time() - start))
+        sample = dates * 50
+        for label, func in (("new DV() per date",
+                             lambda d: DV().parse_swedish_date(d)),
+                            ("parse_date", parse_date)):
+            start = time()
+            for d in sample:
+                func(d)
+            elapsed = time() - start
+            print("%s: %s dates in %.3f sec (%.3f ms/date)" %
+                  (label, len(sample), elapsed, elapsed * 1000 / len(sample)))
+    else:
+        print("usage: python dv.py simplify FILE... | dates")
@@ -19,6 +19,8 @@ from ferenda import util
 from ferenda import DocumentRepository, TripleStore, DocumentStore, Describer
 from ferenda.decorators import managedparsing
 from ferenda.elements import Body
+from storeselect import StoreSelectMixin
+from cachedtransform import CachedTransformMixin
 
 MW_NS = "{http://www.mediawiki.org/xml/export-0.3/}"
 
@@ -33,7 +35,7 @@ class KeywordStore(DocumentStore):
         return basefile
 
 
-class Keyword(DocumentRepository):
+class Keyword(StoreSelectMixin, CachedTransformMixin, DocumentRepository):
 
     """Implements support for 'keyword hubs', conceptual resources which
        themselves aren't related to any document, but to which other
@@ -62,6 +64,7 @@ class Keyword(DocumentRepository):
         # The API endpoint URLs change with MW language
         opts['mediawikiexport'] = 'http://localhost/wiki/Special:Export/%s(basefile)'
         opts['wikipediatitles'] = 'http://download.wikimedia.org/svwiki/latest/svwiki-latest-all-titles-in-ns0.gz'
+        opts['annotationbatchsize'] = 1
         return opts
 
     def download(self, basefile=None):
@@ -158,50 +161,17 @@ class Keyword(DocumentRepository):
 
     re_tagstrip = re.compile(r'<[^>]*>')
 
-    # FIXME: This is copied verbatim from sfs.py -- maybe it could go
-    # into DocumentRepository or util? (or possibly triplestore?)
-    def store_select(self, store, query_template, uri, context=None):
-        if os.path.exists(query_template):
-            fp = open(query_template, 'rb')
-        elif pkg_resources.resource_exists('ferenda', query_template):
-            fp = pkg_resources.resource_stream('ferenda', query_template)
-        else:
-            raise ValueError("query template %s not found" % query_template)
-        params = {'uri': uri,
-                  'context': context}
-        sq = fp.read().decode('utf-8') % params
-        fp.close()
-        # FIXME: Only FusekiStore.select supports (or needs) uniongraph
-        if context:
-            uniongraph = False
-        else:
-            uniongraph = True
-        return store.select(sq, "python", uniongraph=uniongraph)
-
-    def time_store_select(self, store, query_template, basefile, context=None, label="things"):
-        values = {'basefile': basefile,
-                  'label': label,
-                  'count': None}
-        uri = self.canonical_uri(basefile)
-        msg = ("%(basefile)s: selected %(count)s %(label)s "
-               "(%(elapsed).3f sec)")
-        with util.logtime(self.log.debug,
-                          msg,
-                          values):
-            result = self.store_select(store,
-                                       query_template,
-                                       uri,
-                                       context)
-            values['count'] = len(result)
-        return result
-        
-            
+    def annotation_queries(self):
+        return [("res/sparql/keyword_subjects.rq",
+                 None,
+                 "descriptions")]
 
     # FIXME: translate this to be consistent with construct_annotations
     # (e.g. return a RDF graph through one or a few SPARQL queries),
     # not a XML monstrosity
 
     def prep_annotation_file(self, basefile):
+        self.prefetch_annotation_batch(basefile)
         uri = self.canonical_uri(basefile)
         keyword = basefile
         store = TripleStore.connect(self.config.storetype,
@@ -33,6 +33,13 @@ class LNKeyword(Keyword):
         else:
             return super(LNKeyword, self).basefile_from_uri(uri)
         
+    def annotation_queries(self):
+        dvdataset = self.config.url + "dataset/dv"
+        sfsdataset = self.config.url + "dataset/sfs"
+        return super(LNKeyword, self).annotation_queries() + [
+            ("res/sparql/keyword_sfs.rq", sfsdataset, "legaldefs"),
+            ("res/sparql/keyword_dv.rq", dvdataset, "legalcases")]
+
     def prep_annotation_file_termsets(self, basefile, main_node):
         dvdataset = self.config.url + "dataset/dv"
         sfsdataset = self.config.url + "dataset/sfs"
@@ -32,11 +32,18 @@
 
   <xsl:variable name="documenturi" select="//xhtml:body/@about"/>
   <xsl:variable name="sfsannotations" select="document($annotationfile)/rdf:RDF"/>
+  <!-- index of the annotations for each law, chapter, section and
+       stycke. NB: key() only searches the document that contains the
+       context node, so it must be called with a node from
+       $sfsannotations as context -->
+  <xsl:key name="sfsannotation" match="rdf:RDF/rdf:Description" use="@rdf:about"/>
 
   <xsl:template name="pagetitle">
     <xsl:message>pagetitle <xsl:value-of select="$documenturi"/></xsl:message>
-    <xsl:variable name="rattsfall" select="$sfsannotations/rdf:Description[@rdf:about=$documenturi]/rpubl:isLagrumFor/rdf:Description"/>
-    <xsl:variable name="kommentar" select="$sfsannotations/rdf:Description[@rdf:about=$documenturi]/dcterms:description/xhtml:div/*"/>
+    <!-- only done once per document, so no need for the key -->
+    <xsl:variable name="annotation" select="$sfsannotations/rdf:Description[@rdf:about=$documenturi]"/>
+    <xsl:variable name="rattsfall" select="$annotation/rpubl:isLagrumFor/rdf:Description"/>
+    <xsl:variable name="kommentar" select="$annotation/dcterms:description/xhtml:div/*"/>
     <div class="section-wrapper toplevel">
       <section id="top">
 	<h1><xsl:value-of select="../xhtml:head/xhtml:title"/></h1>
@@ -133,13 +140,24 @@
 
   <xsl:template name="aside-annotations">
     <xsl:param name="uri"/>
+    <!-- switch context to the annotation file so that key() finds
+         the annotations for $uri there -->
+    <xsl:for-each select="$sfsannotations">
+      <xsl:call-template name="aside-annotations-for">
+	<xsl:with-param name="annotation" select="key('sfsannotation', $uri)"/>
+      </xsl:call-template>
+    </xsl:for-each>
+  </xsl:template>
+
+  <xsl:template name="aside-annotations-for">
+    <xsl:param name="annotation"/>
     <!-- plocka fram referenser kring/till denna paragraf -->
-    <xsl:variable name="rattsfall" select="$sfsannotations/rdf:Description[@rdf:about=$uri]/rpubl:isLagrumFor/rdf:Description"/>
-    <xsl:variable name="inbound" select="$sfsannotations/rdf:Description[@rdf:about=$uri]/dcterms:references"/>
-    <xsl:variable name="kommentar" select="$sfsannotations/rdf:Description[@rdf:about=$uri]/dcterms:description/xhtml:div/*"/>
-    <xsl:variable name="inford" select="$sfsannotations/rdf:Description[@rdf:about=$uri]/rpubl:isEnactedBy"/>
-    <xsl:variable name="andrad" select="$sfsannotations/rdf:Description[@rdf:about=$uri]/rpubl:isChangedBy"/>
-    <xsl:variable name="upphavd" select="$sfsannotations/rdf:Description[@rdf:about=$uri]/rpubl:isRemovedBy"/>
+    <xsl:variable name="rattsfall" select="$annotation/rpubl:isLagrumFor/rdf:Description"/>
+    <xsl:variable name="inbound" select="$annotation/dcterms:references"/>
+    <xsl:variable name="kommentar" select="$annotation/dcterms:description/xhtml:div/*"/>
+    <xsl:variable name="inford" select="$annotation/rpubl:isEnactedBy"/>
+    <xsl:variable name="andrad" select="$annotation/rpubl:isChangedBy"/>
+    <xsl:variable name="upphavd" select="$annotation/rpubl:isRemovedBy"/>
 
     <xsl:if test="$kommentar">
       <aside class="annotations kommentarer">
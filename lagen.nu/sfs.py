@@ -8,16 +8,19 @@ rättsdatabaser.
 # system libraries (+ six)
 from collections import defaultdict
 from datetime import datetime, date
+from multiprocessing.pool import ThreadPool
+from operator import itemgetter
 from tempfile import mktemp
 from time import time, sleep
-import cgi
 import codecs
 import difflib
+import json
 import logging
 import os
 import re
 import sys
 import shutil
+import threading
 
 from six.moves import html_parser
 from six.moves.urllib_parse import quote, unquote
@@ -36,10 +39,11 @@ import requests
 from ferenda.sources.legal.se import Trips
 # from trips import Trips
 from ferenda import DocumentEntry, DocumentStore, TripleStore
-from ferenda import TextReader, Describer
+from ferenda import TextReader, Describer, Transformer
 from ferenda import decorators
 from ferenda.sources.legal.se import legaluri
 from ferenda import util, LayeredConfig
+from ferenda.elements import Body, Link, ListItem, Paragraph, UnorderedList
 from ferenda.elements import CompoundElement
 from ferenda.elements import OrdinalElement
 from ferenda.elements import TemporalElement
@@ -47,6 +51,9 @@ from ferenda.elements import UnicodeElement
 from ferenda.errors import DocumentRemovedError, ParseError
 from ferenda.sources.legal.se.legalref import LegalRef, LinkSubject
 from ferenda.sources.legal.se import SwedishCitationParser
+from storeselect import StoreSelectMixin
+from cachedtransform import CachedTransformMixin
+from sortkeys import numsortkey
 RPUBL = Namespace('http://rinfo.lagrummet.se/ns/2008/11/rinfo/publ#')
 
 
@@ -312,9 +319,12 @@ class SFSDocumentStore(DocumentStore):
     def intermediate_path(self, basefile):
         return self.path(basefile, "intermediate", ".txt")
 
+    def changes_path(self, basefile):
+        return self.path(basefile, "changes", ".json")
+
     
 
-class SFS(Trips):
+class SFS(StoreSelectMixin, CachedTransformMixin, Trips):
 
     """Documentation to come.
 
@@ -460,6 +470,8 @@ class SFS(Trips):
         opts = super(SFS, self).get_default_options()
         opts['keepexpired'] = False
         opts['revisit'] = list
+        opts['annotationbatchsize'] = 1
+        opts['incrementalannotations'] = False
         return opts
     
     def canonical_uri(self, basefile, konsolidering=False):
@@ -1007,8 +1019,62 @@ class SFS(Trips):
                 rp.append(obs[uri])
 
         doc.body.append(reg)
+        self._write_changes(doc.basefile,
+                            doc.meta.value(URIRef(doc.uri),
+                                           self.ns['dcterms'].title),
+                            reg.as_xhtml(doc.uri))
         return True
 
+    def _write_changes(self, basefile, title, register):
+        """Saves what _build_newspages needs to know about every change
+        act in register (the rendered Register of basefile), so that it
+        can create news entries without re-reading the parsed
+        documents. This is what it used to find in the parsed document
+        for the element with id L<change>: the text of its dcterms:title
+        property and its dl child (as rendered by
+        _element_to_string)."""
+        changes = {}
+        for post in register:
+            postid = post.get('id')
+            if post.get('class') != 'registerpost' or not postid:
+                continue
+            changetitle = None
+            if post.get('property') == 'dcterms:title':
+                changetitle = post.get('content')
+            for e in post.iter():
+                if (self.re_qname.match(e.tag).group(2) == 'dd' and
+                        e.get('property') == 'dcterms:title'):
+                    changetitle = e.text
+            content = None
+            for node in post:
+                if self.re_qname.match(node.tag).group(2) == 'dl':
+                    content = self._element_to_string(node)
+            changes[postid[1:]] = {'title': changetitle,
+                                   'content': content}
+        util.writefile(self.store.changes_path(basefile),
+                       json.dumps({'title': str(title) if title else None,
+                                   'changes': changes},
+                                  indent=2, sort_keys=True))
+
+    def _read_changes(self, basefile):
+        """Returns what _write_changes saved for basefile. Laws parsed
+        before _write_changes existed have no such file, so it is
+        created from their parsed document the first time it is
+        needed. Returns None if there is no parsed document either."""
+        changefile = self.store.changes_path(basefile)
+        if not os.path.exists(changefile):
+            parsedfile = self.store.parsed_path(basefile)
+            if not os.path.exists(parsedfile):
+                return None
+            tree = etree.parse(parsedfile)
+            titles = tree.xpath("//*[local-name()='title']")
+            registers = tree.xpath("//*[local-name()='div'][@class='register']")
+            self._write_changes(basefile,
+                                titles[0].text if titles else None,
+                                registers[0] if registers else [])
+        with open(changefile) as fp:
+            return json.load(fp)
+
     def _forfattningstyp(self, forfattningsrubrik):
         if (forfattningsrubrik.startswith('Lag ') or
             (forfattningsrubrik.endswith('lag') and not forfattningsrubrik.startswith('Förordning')) or
@@ -2581,73 +2647,237 @@ class SFS(Trips):
 
     _document_name_cache = {}
 
-    def store_select(self, store, query_template, uri, context=None):
-        if os.path.exists(query_template):
-            fp = open(query_template, 'rb')
-        elif pkg_resources.resource_exists('ferenda', query_template):
-            fp = pkg_resources.resource_stream('ferenda', query_template)
-        else:
-            raise ValueError("query template %s not found" % query_template)
-        params = {'uri': uri,
-                  'context': context}
-        sq = fp.read().decode('utf-8') % params
-        fp.close()
-        # FIXME: Only FusekiStore.select supports (or needs) uniongraph
-        if context:
-            uniongraph = False
-        else:
-            uniongraph = True
-        return store.select(sq, "python", uniongraph=uniongraph)
-
-    # FIXME: Copied verbatim from keyword.py
-    def time_store_select(self, store, query_template, basefile,
-                          context=None, label="things"):
-        values = {'basefile': basefile,
-                  'label': label,
-                  'count': None}
-        uri = self.canonical_uri(basefile)
-        msg = ("%(basefile)s: selected %(count)s %(label)s "
-               "(%(elapsed).3f sec)")
-        with util.logtime(self.log.debug,
-                          msg,
-                          values):
-            result = self.store_select(store,
-                                       query_template,
-                                       uri,
-                                       context)
-            values['count'] = len(result)
-        return result
+    def annotation_queries(self):
+        sfsdataset = self.dataset_uri()
+        # Putting togeher a (non-normalized) RDF/XML file, suitable
+        # for XSLT inclusion in six easy steps
+        #
+        # 1. all rpubl:Rattsfallsreferat that has baseuri as a
+        # rpubl:lagrum, either directly or through a chain of
+        # dcterms:isPartOf statements
+        # 2. all law sections that has a dcterms:references that
+        # matches this (using dcterms:isPartOf).
+        # 3. all wikientries that dcterms:description this
+        # (4. eurlex.nu data (mapping CELEX ids to titles))
+        # (5. Propositionstitlar)
+        # 6. change entries for each section
+        # NOTE: The SFS RDF data does not yet contain change entries,
+        # this query always returns 0 rows
+        return [("res/sparql/sfs_rattsfallsref.rq",
+                 None,  # query uses both dv and sfs datasets
+                 "legal cases"),
+                ("res/sparql/sfs_inboundlinks.rq",
+                 sfsdataset,
+                 "law references"),
+                ("res/sparql/sfs_wikientries.rq",
+                 None,  # need both mediawiki and sfs contexts
+                 "wiki comments"),
+                ("res/sparql/sfs_changes.rq",
+                 sfsdataset,
+                 "change annotations")]
+
+    def annotation_sources(self, rows):
+        # Records the title of every law that links here (as
+        # display_title puts it in the annotation file), the identifier
+        # of every legal case and change, and the lagrum described by
+        # each wiki comment
+        sources = {}
+        for row in rows["res/sparql/sfs_rattsfallsref.rq"]:
+            sources[row['uri']] = row['id']
+        for row in rows["res/sparql/sfs_inboundlinks.rq"]:
+            sources[row['uri']] = self.display_title(row['uri'])
+        for row in rows["res/sparql/sfs_wikientries.rq"]:
+            sources[row['lagrum']] = "wiki"
+        for row in rows["res/sparql/sfs_changes.rq"]:
+            sources[row['change']] = row['id']
+        return sources
+
+    def annotation_basefile_from_uri(self, uri):
+        # canonical_uri in reverse (ignoring fragments and
+        # consolidated versions). Only SFS numbers are basefiles.
+        prefix = self.config.url + self.config.urlpath
+        if uri.startswith(prefix):
+            basefile = uri[len(prefix):].split("#")[0].split("/")[0]
+            if re.match(r"\d{4}:", basefile):
+                return basefile.replace("_", " ")
+
+    @decorators.action
+    def generate(self, basefile, otherrepos=[]):
+        # The default generate only rebuilds the annotation file if
+        # the parsed file is newer than it. With incrementalannotations
+        # we also rebuild it if any legal case, inbound link, wiki
+        # comment or change that feeds it has changed since it was
+        # written (see StoreSelectMixin.annotations_to_rebuild, which
+        # is run once, for all laws, on the first call). The new
+        # annotation file is then newer than the generated file, which
+        # is therefore regenerated as well.
+        if (self.config.incrementalannotations and
+                not self.config.force and
+                os.path.exists(self.store.parsed_path(basefile))):
+            if not hasattr(self, '_annotations_to_rebuild'):
+                self._annotations_to_rebuild = self.annotations_to_rebuild(
+                    list(otherrepos) + [self])
+            if basefile in self._annotations_to_rebuild:
+                self.log.debug("%s: Annotation sources changed" % basefile)
+                self.prep_annotation_file(basefile)
+        return super(SFS, self).generate(basefile, otherrepos)
 
     def prep_annotation_file(self, basefile):
-        sfsdataset = self.dataset_uri()
-        assert "sfs" in sfsdataset
-        dvdataset = sfsdataset.replace("sfs", "dv")
-        wikidataset = sfsdataset.replace("sfs", "mediawiki")
-        
         # this is old legacy code. The new nice way would be to create
         # one giant SPARQL CONSTRUCT query file and just set
         # self.sparql_annotations to that file. But you know, this works.
         uri = self.canonical_uri(basefile)
         baseuri = uri
-        store = TripleStore.connect(self.config.storetype,
-                                    self.config.storelocation,
-                                    self.config.storerepository)
-        # Putting togeher a (non-normalized) RDF/XML file, suitable
-        # for XSLT inclusion in six easy steps
-        stuff = {}
-        # 1. all rpubl:Rattsfallsreferat that has baseuri as a
-        # rpubl:lagrum, either directly or through a chain of
-        # dcterms:isPartOf statements
-        rattsfall = self.time_store_select(store,
-                                           "res/sparql/sfs_rattsfallsref.rq",
-                                           basefile,
-                                           None,  # query uses both dv and sfs datasets
-                                           "legal cases")
+        rows = self.annotation_rows(basefile)
+        rattsfall = rows["res/sparql/sfs_rattsfallsref.rq"]
+        inboundlinks = rows["res/sparql/sfs_inboundlinks.rq"]
+        wikidesc = rows["res/sparql/sfs_wikientries.rq"]
+        changes = rows["res/sparql/sfs_changes.rq"]
+
+        stuff = self._aggregate_annotations(baseuri, rattsfall, inboundlinks,
+                                            wikidesc, changes)
 
+        # then, construct a single de-normalized rdf/xml dump, sorted
+        # by root/chapter/section/paragraph URI:s. We do this using
+        # raw XML, not RDFlib, to avoid normalizing the graph -- we
+        # need repetition in order to make the XSLT processing simple.
+        #
+        # The RDF dump looks something like:
+        #
+        # <rdf:RDF>
+        # <rdf:Description about="http://rinfo.lagrummet.se/publ/sfs/1998:204#P1">
+        #     <rpubl:isLagrumFor>
+        #       <rdf:Description about="http://rinfo.lagrummet.se/publ/dom/rh/2004:51">
+        #           <dcterms:identifier>RH 2004:51</dcterms:identifier>
+        #           <dcterms:description>Hemsida på Internet. Fråga om...</dcterms:description>
+        #       </rdf:Description>
+        #     </rpubl:isLagrumFor>
+        #     <dcterms:description>Personuppgiftslagens syfte är att skydda...</dcterms:description>
+        #     <rpubl:isChangedBy>
+        #        <rdf:Description about="http://rinfo.lagrummet.se/publ/sfs/2003:104">
+        #           <dcterms:identifier>SFS 2003:104</dcterms:identifier>
+        #           <rpubl:proposition>
+        #             <rdf:Description about="http://rinfo.lagrummet.se/publ/prop/2002/03:123">
+        #               <dcterms:title>Översyn av personuppgiftslagen</dcterms:title>
+        #               <dcterms:identifier>Prop. 2002/03:123</dcterms:identifier>
+        #             </rdf:Description>
+        #           </rpubl:proposition>
+        #        </rdf:Description>
+        #     </rpubl:isChangedBy>
+        #   </rdf:Description>
+        # </rdf:RDF>
+
+        # The dump is written incrementally, one rdf:Description at a
+        # time, so that we never hold the entire tree for heavily
+        # cited laws (RB, BrB...) in memory.
+        #
+        # compatibility hack to enable lxml to process qnames for namespaces 
+        def ns(string):
+            if ":" in string:
+                prefix, tag = string.split(":", 1)
+                return "{%s}%s" % (str(self.ns[prefix]), tag)
+
+        def write_text(xf, tag, text):
+            with xf.element(ns(tag)):
+                if text:
+                    xf.write(text)
+
+        def write_description(xf, lagrum, annotations):
+            # Group inbound links into dcterms:references nodes, one for
+            # each run of links from the same law. A group of links from
+            # the law we're generating is placed first, before everything
+            # else (including rpubl:isLagrumFor).
+            first_references = []
+            last_references = []
+            inbound = annotations.get('inboundlinks', [])
+            inboundlen = len(inbound)
+            prev_uri = None
+            for i in range(inboundlen):
+                if "#" in inbound[i]['uri']:
+                    (uri, fragment) = inbound[i]['uri'].split("#")
+                else:
+                    (uri, fragment) = (inbound[i]['uri'], None)
+
+                # 1) if the baseuri differs from the previous one,
+                # create a new dcterms:references node
+                if uri != prev_uri:
+                    references = []
+                    # 1.1) if the baseuri is the same as the uri
+                    # for the law we're generating, place it first
+                    if uri == baseuri:
+                        first_references.insert(0, references)
+                    else:
+                        last_references.append(references)
+                # Find out the next uri safely
+                if (i + 1 < inboundlen):
+                    next_uri = inbound[i + 1]['uri'].split("#")[0]
+                else:
+                    next_uri = None
+
+                # If uri is the same as the next one OR uri is the
+                # same as baseuri, use relative form for creating
+                # dcterms:identifier
+                if (uri == next_uri) or (uri == baseuri):
+                    form = "relative"
+                else:
+                    form = "absolute"
+                references.append((inbound[i]['uri'],
+                                   self.display_title(inbound[i]['uri'], form)))
+                prev_uri = uri
+
+            def write_references(references):
+                with xf.element(ns("dcterms:references")):
+                    for (uri, title) in references:
+                        with xf.element(ns("rdf:Description"),
+                                        {ns("rdf:about"): uri}):
+                            write_text(xf, "dcterms:identifier", title)
+
+            with xf.element(ns("rdf:Description"), {ns("rdf:about"): lagrum}):
+                for references in first_references:
+                    write_references(references)
+                if 'rattsfall' in annotations:
+                    for r in annotations['rattsfall']:
+                        with xf.element(ns("rpubl:isLagrumFor")):
+                            with xf.element(ns("rdf:Description"),
+                                            {ns("rdf:about"): r['uri']}):
+                                write_text(xf, "dcterms:identifier", r['id'])
+                                write_text(xf, "dcterms:description", r['desc'])
+                for references in last_references:
+                    write_references(references)
+                if 'changes' in annotations:
+                    for r in annotations['changes']:
+                        with xf.element(ns("rpubl:isChangedBy")):
+                            write_text(xf, "rpubl:fsNummer", r['id'])
+                if 'desc' in annotations:
+                    with xf.element(ns("dcterms:description")):
+                        xhtmlstr = "<div xmlns='http://www.w3.org/1999/xhtml'>%s</div>" % annotations['desc']
+                        xf.write(etree.fromstring(xhtmlstr.encode('utf-8')))
+
+        with self.store.open_annotation(basefile, mode="wb") as fp:
+            with etree.xmlfile(fp, encoding="utf-8") as xf:
+                xf.write_declaration()
+                with xf.element(ns("rdf:RDF"), nsmap=self.ns):
+                    xf.write("\n")
+                    for l in sorted(list(stuff.keys()), key=numsortkey):
+                        write_description(xf, l, stuff[l])
+                        xf.write("\n")
+        self.write_annotation_manifest(basefile, rows)
+        return self.store.annotation_path(basefile)
+
+    @staticmethod
+    def _aggregate_annotations(baseuri, rattsfall, inboundlinks, wikidesc,
+                               changes):
+        """Groups the rows from the annotation queries by the lagrum
+        (law, chapter or section URI) they annotate. Returns a dict
+        lagrum => {'rattsfall': [...], 'inboundlinks': [...], 'desc':
+        ..., 'changes': [...]}, where the lists are in the order of
+        the query results."""
+        stuff = {}
         stuff[baseuri] = {}
         stuff[baseuri]['rattsfall'] = []
 
-        specifics = {}
+        specifics = set()
+        seen = set()
         for row in rattsfall:
             if 'lagrum' not in row:
                 lagrum = baseuri
@@ -2657,7 +2887,7 @@ class SFS(Trips):
                     lagrum = row['lagrum'][:row['lagrum'].index("S")]
                 else:
                     lagrum = row['lagrum']
-                specifics[row['id']] = True
+                specifics.add(row['id'])
             # we COULD use a tricky defaultdict for stuff instead of
             # this initializing code, but defauldicts don't pprint
             # so pretty...
@@ -2666,75 +2896,48 @@ class SFS(Trips):
             if not 'rattsfall' in stuff[lagrum]:
                 stuff[lagrum]['rattsfall'] = []
 
-            record = {'id': row['id'],
-                      'desc': row['desc'],
-                      'uri': row['uri']}
-
             # if one case references two or more paragraphs in a
             # particular section (ie "6 kap 1 \xa7 1 st. och 6 kap 1 \xa7 2
             # st.") we will get duplicates that we can't (easily)
             # filter out in the SPARQL query. Filter them out here
-            # instead.
-            if not record in stuff[lagrum]['rattsfall']:
-                stuff[lagrum]['rattsfall'].append(record)
+            # instead (keeping the first occurrence).
+            key = (lagrum, row['id'], row['desc'], row['uri'])
+            if key in seen:
+                continue
+            seen.add(key)
+            stuff[lagrum]['rattsfall'].append({'id': row['id'],
+                                               'desc': row['desc'],
+                                               'uri': row['uri']})
 
         # remove cases that refer to the law itself and a specific
         # paragraph (ie only keep cases that only refer to the law
         # itself)
-        filtered = []
-        for r in stuff[baseuri]['rattsfall']:
-            if r['id'] not in specifics:
-                filtered.append(r)
-        stuff[baseuri]['rattsfall'] = filtered
-
-        # 2. all law sections that has a dcterms:references that matches this (using dcterms:isPartOf).
-        inboundlinks = self.time_store_select(store,
-                                              "res/sparql/sfs_inboundlinks.rq",
-                                              basefile,
-                                              sfsdataset,
-                                              "law references")
-        stuff[baseuri]['inboundlinks'] = []
+        stuff[baseuri]['rattsfall'] = [r for r in stuff[baseuri]['rattsfall']
+                                       if r['id'] not in specifics]
 
+        stuff[baseuri]['inboundlinks'] = []
         # mapping <http://rinfo.lagrummet.se/publ/sfs/1999:175> =>
         # "Rättsinformationsförordning (1999:175)"
-        specifics = {}
+        specifics = set()
         for row in inboundlinks:
             if 'lagrum' not in row:
                 lagrum = baseuri
             else:
-                # truncate 1998:204#P7S2 to just 1998:204#P7
-                if "S" in row['lagrum']:
-                    lagrum = row['lagrum'][:row['lagrum'].index("S")]
-                else:
-                    lagrum = row['lagrum']
+                # NOTE: unlike legal cases, inbound links are kept
+                # at the level of the specific stycke (1998:204#P7S2)
                 lagrum = row['lagrum']
-                specifics[row['uri']] = True
-            # we COULD use a tricky defaultdict for stuff instead of
-            # this initializing code, but defauldicts don't pprint
-            # so pretty...
+                specifics.add(row['uri'])
             if not lagrum in stuff:
                 stuff[lagrum] = {}
             if not 'inboundlinks' in stuff[lagrum]:
                 stuff[lagrum]['inboundlinks'] = []
-            # print "adding %s under %s" % (row['id'],lagrum)
             stuff[lagrum]['inboundlinks'].append({'uri': row['uri']})
 
         # remove inbound links that refer to the law itself plus at
         # least one specific paragraph (ie only keep cases that only
         # refer to the law itself)
-        filtered = []
-        for r in stuff[baseuri]['inboundlinks']:
-            if r['uri'] not in specifics:
-                filtered.append(r)
-        stuff[baseuri]['inboundlinks'] = filtered
-
-        # pprint (stuff)
-        # 3. all wikientries that dcterms:description this
-        wikidesc = self.time_store_select(store,
-                                          "res/sparql/sfs_wikientries.rq",
-                                          basefile,
-                                          None, # need both mediawiki and sfs contexts
-                                          "wiki comments")
+        stuff[baseuri]['inboundlinks'] = [r for r in stuff[baseuri]['inboundlinks']
+                                          if r['uri'] not in specifics]
 
         for row in wikidesc:
             if not 'lagrum' in row:
@@ -2746,17 +2949,6 @@ class SFS(Trips):
                 stuff[lagrum] = {}
             stuff[lagrum]['desc'] = row['desc']
 
-        # pprint(wikidesc)
-        # (4. eurlex.nu data (mapping CELEX ids to titles))
-        # (5. Propositionstitlar)
-        # 6. change entries for each section
-        # NOTE: The SFS RDF data does not yet contain change entries, this query always returns 0 rows
-        changes = self.time_store_select(store,
-                                         "res/sparql/sfs_changes.rq",
-                                         basefile,
-                                         sfsdataset,
-                                         "change annotations")
-
         for row in changes:
             lagrum = row['lagrum']
             if not lagrum in stuff:
@@ -2765,127 +2957,7 @@ class SFS(Trips):
                 stuff[lagrum]['changes'] = []
             stuff[lagrum]['changes'].append({'uri': row['change'],
                                              'id': row['id']})
-
-        import json
-        print(json.dumps(stuff, indent=4))
-        
-
-        # then, construct a single de-normalized rdf/xml dump, sorted
-        # by root/chapter/section/paragraph URI:s. We do this using
-        # raw XML, not RDFlib, to avoid normalizing the graph -- we
-        # need repetition in order to make the XSLT processing simple.
-        #
-        # The RDF dump looks something like:
-        #
-        # <rdf:RDF>
-        # <rdf:Description about="http://rinfo.lagrummet.se/publ/sfs/1998:204#P1">
-        #     <rpubl:isLagrumFor>
-        #       <rdf:Description about="http://rinfo.lagrummet.se/publ/dom/rh/2004:51">
-        #           <dcterms:identifier>RH 2004:51</dcterms:identifier>
-        #           <dcterms:description>Hemsida på Internet. Fråga om...</dcterms:description>
-        #       </rdf:Description>
-        #     </rpubl:isLagrumFor>
-        #     <dcterms:description>Personuppgiftslagens syfte är att skydda...</dcterms:description>
-        #     <rpubl:isChangedBy>
-        #        <rdf:Description about="http://rinfo.lagrummet.se/publ/sfs/2003:104">
-        #           <dcterms:identifier>SFS 2003:104</dcterms:identifier>
-        #           <rpubl:proposition>
-        #             <rdf:Description about="http://rinfo.lagrummet.se/publ/prop/2002/03:123">
-        #               <dcterms:title>Översyn av personuppgiftslagen</dcterms:title>
-        #               <dcterms:identifier>Prop. 2002/03:123</dcterms:identifier>
-        #             </rdf:Description>
-        #           </rpubl:proposition>
-        #        </rdf:Description>
-        #     </rpubl:isChangedBy>
-        #   </rdf:Description>
-        # </rdf:RDF>
-
-        start = time()
-        # compatibility hack to enable lxml to process qnames for namespaces 
-        def ns(string):
-            if ":" in string:
-                prefix, tag = string.split(":", 1)
-                return "{%s}%s" % (str(self.ns[prefix]), tag)
-        root_node = etree.Element(ns("rdf:RDF"), nsmap=self.ns)
-        for l in sorted(list(stuff.keys()), cmp=util.numcmp):
-            lagrum_node = etree.SubElement(root_node, ns("rdf:Description"))
-            lagrum_node.set(ns("rdf:about"), l)
-            if 'rattsfall' in stuff[l]:
-                for r in stuff[l]['rattsfall']:
-                    islagrumfor_node = etree.SubElement(
-                        lagrum_node, ns("rpubl:isLagrumFor"))
-                    rattsfall_node = etree.SubElement(
-                        islagrumfor_node, ns("rdf:Description"))
-                    rattsfall_node.set(ns("rdf:about"), r['uri'])
-                    id_node = etree.SubElement(rattsfall_node, ns("dcterms:identifier"))
-                    id_node.text = r['id']
-                    desc_node = etree.SubElement(
-                        rattsfall_node, ns("dcterms:description"))
-                    desc_node.text = r['desc']
-            if 'inboundlinks' in stuff[l]:
-                inbound = stuff[l]['inboundlinks']
-                inboundlen = len(inbound)
-                prev_uri = None
-                for i in range(inboundlen):
-                    if "#" in inbound[i]['uri']:
-                        (uri, fragment) = inbound[i]['uri'].split("#")
-                    else:
-                        (uri, fragment) = (inbound[i]['uri'], None)
-
-                    # 1) if the baseuri differs from the previous one,
-                    # create a new dcterms:references node
-                    if uri != prev_uri:
-                        references_node = etree.Element(ns("dcterms:references"))
-                        # 1.1) if the baseuri is the same as the uri
-                        # for the law we're generating, place it first
-                        if uri == baseuri:
-                            # If the uri is the same as baseuri (the law
-                            # we're generating), place it first.
-                            lagrum_node.insert(0, references_node)
-                        else:
-                            lagrum_node.append(references_node)
-                    # Find out the next uri safely
-                    if (i + 1 < inboundlen):
-                        next_uri = inbound[i + 1]['uri'].split("#")[0]
-                    else:
-                        next_uri = None
-
-                    # If uri is the same as the next one OR uri is the
-                    # same as baseuri, use relative form for creating
-                    # dcterms:identifier
-                    # print "uri: %s, next_uri: %s, baseuri: %s" %
-                    # (uri[35:],next_uri[35:],baseuri[35:])
-                    if (uri == next_uri) or (uri == baseuri):
-                        form = "relative"
-                    else:
-                        form = "absolute"
-
-                    inbound_node = etree.SubElement(
-                        references_node, ns("rdf:Description"))
-                    inbound_node.set(ns("rdf:about"), inbound[i]['uri'])
-                    id_node = etree.SubElement(inbound_node, ns("dcterms:identifier"))
-                    id_node.text = self.display_title(inbound[i]['uri'], form)
-
-                    prev_uri = uri
-
-            if 'changes' in stuff[l]:
-                for r in stuff[l]['changes']:
-                    ischanged_node = etree.SubElement(
-                        lagrum_node, ns("rpubl:isChangedBy"))
-                    #rattsfall_node = etree.SubElement(islagrumfor_node, "rdf:Description")
-                    # rattsfall_node.set("rdf:about",r['uri'])
-                    id_node = etree.SubElement(ischanged_node, ns("rpubl:fsNummer"))
-                    id_node.text = r['id']
-            if 'desc' in stuff[l]:
-                desc_node = etree.SubElement(lagrum_node, ns("dcterms:description"))
-                xhtmlstr = "<div xmlns='http://www.w3.org/1999/xhtml'>%s</div>" % stuff[l]['desc']
-                desc_node.append(etree.fromstring(xhtmlstr.encode('utf-8')))
-
-        # tree = etree.ElementTree(root_node)
-        treestring = etree.tostring(root_node, encoding="utf-8", pretty_print=True)
-        with self.store.open_annotation(basefile, mode="wb") as fp:
-            fp.write(treestring)
-        return self.store.annotation_path(basefile)
+        return stuff
 
     def _unlocalize_uri(self, uri):
         # may need to munge https://lagen.nu/2010:1770#K1P2S1 back to
@@ -2947,18 +3019,18 @@ class SFS(Trips):
 
     def _indexpages_predicates(self):
         return [util.ns['dcterms'] + "title",
-                util.ns['rinfo'] + 'fsNummer',
+                RPUBL.fsNummer,
                 util.ns['rdf'] + 'type',
-                util.ns['rinfo'] + 'KonsolideradGrundforfattning']
+                RPUBL.KonsolideradGrundforfattning]
 
     def _build_indexpages(self, by_pred_obj, by_subj_pred):
         documents = defaultdict(lambda: defaultdict(list))
         pagetitles = {}
         pagelabels = {}
-        fsnr_pred = util.ns['rinfo'] + 'fsNummer'
+        fsnr_pred = RPUBL.fsNummer
         title_pred = util.ns['dcterms'] + 'title'
         type_pred = util.ns['rdf'] + 'type'
-        type_obj = util.ns['rinfo'] + 'KonsolideradGrundforfattning'
+        type_obj = RPUBL.KonsolideradGrundforfattning
         year_lbl = 'Ordnade efter utgivningsår'
         title_lbl = 'Ordnade efter titel'
         # construct the 404 page - we should really do this in the
@@ -2990,9 +3062,8 @@ class SFS(Trips):
             fsnr = by_subj_pred[subj][fsnr_pred]
             title = by_subj_pred[subj][title_pred]
 
-            sorttitle = re.sub(r'Kungl\. Maj:ts ', '', title)
-            sorttitle = re.sub(
-                r'^(Lag|Förordning|Tillkännagivande|[kK]ungörelse) ?\([^\)]+\) ?(av|om|med|angående) ', '', sorttitle)
+            sorttitle = self.re_kungl.sub('', title)
+            sorttitle = self.re_sorttitle.sub('', sorttitle)
             year = fsnr.split(':')[0]
             letter = sorttitle[0].lower()
 
@@ -3013,32 +3084,133 @@ class SFS(Trips):
         # FIXME: port the 'Nyckelbegrepp' code from 1.0
         #        import the old etiketter data and make a tag cloud or something
 
+        # sort each page once: year pages in natural order of SFS
+        # numbers, letter pages by the lowercased sort titles computed
+        # above
+        pages = []
         for category in list(documents.keys()):
+            if category == year_lbl:
+                sortkey = lambda doc: numsortkey(doc['sortkey'])
+            else:
+                sortkey = itemgetter('sortkey')
             for pageid in list(documents[category].keys()):
-                outfile = "%s/%s/generated/index/%s.html" % (
-                    self.config.datadir, self.alias, pageid)
-                title = pagetitles[pageid]
-                if category == year_lbl:
-                    self._render_indexpage(
-                        outfile, title, documents, pagelabels, category, pageid, docsorter=util.numcmp)
+                documents[category][pageid].sort(key=sortkey)
+                pages.append((category, pageid))
+
+        conffile = os.path.abspath(
+            os.sep.join([self.config.datadir, 'rsrc', 'resources.xml']))
+        if not os.path.exists(conffile):
+            conffile = None
+        # toc.xsl and the templates it includes come with ferenda,
+        # our own res/xsl is layered on top of them.
+        templatedirs = [pkg_resources.resource_filename('ferenda', 'res/xsl'),
+                        "res/xsl"]
+
+        def make_transformer():
+            return Transformer('XSLT', "res/xsl/toc.xsl", templatedirs,
+                               config=conffile)
+
+        # a compiled stylesheet shouldn't be applied from several
+        # threads at once, so each thread gets a transformer of its
+        # own. The depth-adjusted configuration file that they share
+        # is written once, up front, since all index pages are at the
+        # same depth.
+        local = threading.local()
+        local.transformer = make_transformer()
+        if conffile:
+            local.transformer.t.getconfig(conffile, self.indexpage_depth)
+
+        def render(page):
+            (category, pageid) = page
+            outfile = "%s/%s/generated/index/%s.html" % (
+                self.config.datadir, self.alias, pageid)
+            if not hasattr(local, 'transformer'):
+                local.transformer = make_transformer()
+            with util.logtime(self.log.debug,
+                              "index page %(pageid)s: rendered (%(elapsed).3f sec)",
+                              {'pageid': pageid}):
+                self._render_indexpage(outfile, pagetitles[pageid], documents,
+                                       pagelabels, category, pageid,
+                                       local.transformer)
+            return outfile
+
+        # the pages are independent of each other, and most of the
+        # work is done by lxml (which releases the GIL), so render
+        # them using a pool of threads.
+        pool = ThreadPool(max(1, self.config.processes))
+        try:
+            outfiles = pool.map(render, pages)
+        finally:
+            pool.close()
+            pool.join()
+        if (title_lbl, 'a') in pages:
+            # make index.html, which is just a copy of a.html
+            shutil.copy2(outfiles[pages.index((title_lbl, 'a'))],
+                         "%s/%s/generated/index/index.html" % (
+                             self.config.datadir, self.alias))
+
+    # the number of path segments of an index page relative to the
+    # repo datadir (generated/index/a.html), calculated the same
+    # (naive) way as in toc_generate_page
+    indexpage_depth = 3
+
+    def _render_indexpage(self, outfile, title, documents, pagelabels,
+                          category, page, transformer):
+        """Renders a single index page (listing the already sorted
+        documents in ``documents[category][page]``, preceded by links
+        to all other index pages) using toc.xsl, in the same way as
+        toc_generate_page does for the generic TOC pages."""
+        doc = self.make_document()
+        doc.uri = "%s%s/index/%s.html" % (self.config.url,
+                                           self.config.urlpath.rstrip("/"),
+                                           page)
+        d = Describer(doc.meta, doc.uri)
+        d.value(self.ns['dcterms'].title, title)
+        nav = UnorderedList(role='navigation')
+        for cat in sorted(documents.keys()):
+            sublist = UnorderedList()
+            for pageid in sorted(documents[cat].keys(), key=numsortkey):
+                if (cat, pageid) == (category, page):
+                    sublist.append(ListItem([pagelabels[pageid]]))
                 else:
-                    self._render_indexpage(outfile, title, documents,
-                                           pagelabels, category, pageid)
-                    if pageid == 'a':  # make index.html
-                        outfile = "%s/%s/generated/index/index.html" % (
-                            self.config.datadir, self.alias)
-                        self._render_indexpage(outfile, title, documents,
-                                               pagelabels, category, pageid)
-
+                    sublist.append(ListItem([Link(pagelabels[pageid],
+                                                  href="%s.html" % pageid)]))
+            nav.append(ListItem([Paragraph([cat]), sublist]))
+        items = []
+        for entry in documents[category][page]:
+            link = Link(entry['title'], href=entry['uri'])
+            if entry.get('leader'):
+                items.append(ListItem([entry['leader'], link]))
+            else:
+                items.append(ListItem([link]))
+        doc.body = Body([nav, UnorderedList(items, role='main')])
+
+        tree = transformer.transform(self.render_xhtml_tree(doc),
+                                     self.indexpage_depth)
+        fixed = transformer.t.html5_doctype_workaround(etree.tostring(tree))
+        util.ensure_dir(outfile)
+        with open(outfile, "wb") as fp:
+            fp.write(fixed)
+        self.log.info("Created %s" % outfile)
+
+    re_kungl = re.compile(r'Kungl\. Maj:ts ')
+    re_sorttitle = re.compile(
+        r'^(Lag|Förordning|Tillkännagivande|[kK]ungörelse) ?\([^\)]+\) ?(av|om|med|angående) ')
     re_message = re.compile(r'(\d+:\d+) \[([^\]]*)\]')
     re_qname = re.compile(r'(\{.*\})(\w+)')
     re_sfsnr = re.compile(r'\s*(\(\d+:\d+\))')
 
     def _build_newspages(self, messages):
+        # Titles and descriptions of each change are written by parse
+        # (see _write_changes), so we only need to read one small JSON
+        # file per changed law. For laws parsed before that, the file
+        # is created from the parsed document by _read_changes (run
+        # "parse --all --force" once to create all of them up front).
         changes = {}
         all_entries = []
         lag_entries = []
         ovr_entries = []
+        changefiles = {}
         for (timestamp, message) in messages:
             m = self.re_message.match(message)
             change = m.group(1)
@@ -3046,39 +3218,32 @@ class SFS(Trips):
                 continue
             changes[change] = True
             bases = m.group(2).split(", ")
-            basefile = "%s/%s/parsed/%s.xht2" % (
-                self.config.datadir, self.alias, self.store.basefile_to_pathfrag(bases[0]))
-            # print "opening %s" % basefile
-            if not os.path.exists(basefile):
+            if bases[0] not in changefiles:
+                changefiles[bases[0]] = self._read_changes(bases[0])
+            metadata = changefiles[bases[0]]
+            if metadata is None:
                 # om inte den parseade filen finns kan det bero på att
                 # författningen är upphävd _eller_ att det blev något
                 # fel vid parseandet.
-                self.log.warning("File %s not found" % basefile)
+                self.log.warning("File %s not found" % self.store.parsed_path(bases[0]))
                 continue
-            tree, ids = etree.XMLID(open(basefile).read())
 
-            if (change != bases[0]) and (not 'L' + change in ids):
-                self.log.warning(
-                    "ID %s not found in %s" % ('L' + change, basefile))
+            if change not in metadata['changes']:
+                self.log.warning("Change %s not found in %s" % (change, bases[0]))
                 continue
 
             if change != bases[0]:
-                for e in ids['L' + change].findall(".//{http://www.w3.org/2002/06/xhtml2/}dd"):
-                    if 'property' in e.attrib and e.attrib['property'] == 'dcterms:title':
-                        title = e.text
+                title = metadata['changes'][change]['title']
             else:
-                title = tree.find(
-                    ".//{http://www.w3.org/2002/06/xhtml2/}title").text
+                title = metadata['title']
+            if not title:
+                title = "SFS %s" % change
+            content = metadata['changes'][change]['content'] or ''
 
             # use relative, non-rinfo uri:s here - since the atom
             # transform wont go through xslt and use uri.xslt
             uri = '/%s' % bases[0]
 
-            for node in ids['L' + change]:
-                m = self.re_qname.match(node.tag)
-                if m.group(2) == 'dl':
-                    content = self._element_to_string(node)
-
             entry = {'title': title,
                      'timestamp': timestamp,
                      'id': change,
@@ -3116,30 +3281,45 @@ class SFS(Trips):
         self._render_newspage(
             htmlfile, atomfile, 'Nya och ändrade förordningar och övriga författningar', 'De senaste 30 dagarna', ovr_entries)
 
-    def _element_to_string(self, e):
+    @classmethod
+    def _element_to_string(cls, e):
         """Creates a XHTML1 string from a elementtree.Element,
         removing namespaces and rel/propery attributes"""
-        m = self.re_qname.match(e.tag)
-        tag = m.group(2)
-
-        if list(e.attrib.keys()):
-            attributestr = " " + \
-                " ".join([x + '="' + e.attrib[x].replace('"', '&quot;') +
-                         '"' for x in list(e.attrib.keys()) if x not in ['rel', 'property']])
-        else:
-            attributestr = ""
-
-        childstr = ''
-        for child in e:
-            childstr += self._element_to_string(child)
-
-        text = ''
-        tail = ''
-        if e.text:
-            text = cgi.escape(e.text)
-        if e.tail:
-            tail = cgi.escape(e.tail)
-        return "<%s%s>%s%s%s</%s>" % (tag, attributestr, text, childstr, tail, tag)
+        # NB: For compatibility with older output, the tail of each
+        # element is placed *inside* its end tag. Text and tails are
+        # escaped like cgi.escape does (&, < and >, but not quotes),
+        # and attribute values only have their quotes escaped.
+        def escape(s):
+            return s.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+        tags = {}
+        res = []
+        # iterative depth-first walk, so that deeply nested trees
+        # don't hit the recursion limit. Each element is pushed twice:
+        # once to emit its start tag, text and children, and once
+        # (after all children) to emit its tail and end tag.
+        stack = [(e, False)]
+        while stack:
+            node, end = stack.pop()
+            if node.tag not in tags:
+                tags[node.tag] = cls.re_qname.match(node.tag).group(2)
+            tag = tags[node.tag]
+            if end:
+                if node.tail:
+                    res.append(escape(node.tail))
+                res.append("</%s>" % tag)
+                continue
+            res.append("<" + tag)
+            if node.attrib:
+                res.append(" " + " ".join(
+                    [x + '="' + node.attrib[x].replace('"', '&quot;') + '"'
+                     for x in node.attrib.keys() if x not in ('rel', 'property')]))
+            res.append(">")
+            if node.text:
+                res.append(escape(node.text))
+            stack.append((node, True))
+            stack.extend([(child, False) for child in reversed(node)])
+        return "".join(res)
 
 
     templ = [
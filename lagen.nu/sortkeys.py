@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+# system libraries
+import re
+
+re_numsplit = re.compile(r'(\d+)', re.UNICODE).split
+_numsortkey_cache = {}
+
+
+def numsortkey(s):
+    """Returns a key for sorting strings in the same 'natural' order as
+    util.numcmp, ie "K1P2" < "K1P10", without having to re-split both
+    strings for every comparison. Keys are cached, since the same
+    fragment URIs are sorted over and over again.
+
+    >>> sorted(["K1P10", "K1P2", "K1P2a", "K10"], key=numsortkey)
+    ['K1P2', 'K1P2a', 'K1P10', 'K10']
+
+    """
+    try:
+        return _numsortkey_cache[s]
+    except KeyError:
+        # re.split with a capturing group always yields
+        # str, digits, str, digits, ..., str -- convert the digit
+        # segments to ints so that they compare numerically
+        key = tuple([int(x) if i % 2 else x
+                     for i, x in enumerate(re_numsplit(s))])
+        if len(_numsortkey_cache) > 500000:
+            _numsortkey_cache.clear()
+        _numsortkey_cache[s] = key
+        return key
@@ -0,0 +1,365 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+# system libraries
+from collections import deque
+import json
+import os
+
+# 3rdparty libs
+import pkg_resources
+from rdflib import Graph, URIRef
+
+# my libs
+from ferenda import util, LayeredConfig, TripleStore
+
+
+class StoreSelectMixin(object):
+
+    """Runs the SPARQL SELECT queries that prep_annotation_file
+    implementations use to gather data for annotation files.
+
+    Query templates are plain SPARQL with python string interpolation
+    for ``%(uri)s`` (the URI of the document being annotated),
+    ``%(uris)s`` (a space separated list of ``<uri>`` terms, meant to
+    be used in a ``VALUES ?docuri { ... }`` block) and
+    ``%(context)s``. Templates that bind ``?docuri`` through a VALUES
+    block can be run for many documents at once: if the
+    ``annotationbatchsize`` config option is larger than 1 and
+    generate runs over all basefiles in a single process,
+    :py:meth:`prefetch_annotations` runs each query returned by
+    :py:meth:`annotation_queries` once for a batch of basefiles and
+    splits the result per document. Subsequent calls to
+    :py:meth:`time_store_select` for a basefile in that batch are then
+    answered from the prefetched rows instead of querying the store.
+
+    Next to each annotation file, an annotation manifest (a small JSON
+    file) records the documents that contributed to it. With the
+    ``incrementalannotations`` config option,
+    :py:meth:`annotations_to_rebuild` turns the manifests into a
+    reverse index from each source document to the annotation files it
+    contributed to. Together with the distilled files of all source
+    documents that changed (or were added) since, and the source
+    documents that no longer exist, this determines which annotation
+    files need to be rebuilt, without querying the store for any of
+    the others. To know which documents exist, a source index (see
+    :py:meth:`annotation_source_index_path`) records the document URIs
+    found in each distilled file, so that only new or changed
+    distilled files need to be read.
+
+    """
+
+    def annotation_queries(self):
+        """Returns a list of (query_template, context, label) tuples for
+        all queries that prep_annotation_file will run through
+        time_store_select. Only these queries are batched."""
+        return []
+
+    def store_select(self, store, query_template, uri, context=None):
+        if os.path.exists(query_template):
+            fp = open(query_template, 'rb')
+        elif pkg_resources.resource_exists('ferenda', query_template):
+            fp = pkg_resources.resource_stream('ferenda', query_template)
+        else:
+            raise ValueError("query template %s not found" % query_template)
+        if isinstance(uri, (list, tuple)):
+            uris = uri
+        else:
+            uris = [uri]
+        params = {'uri': uris[0],
+                  'uris': " ".join(["<%s>" % u for u in uris]),
+                  'context': context}
+        sq = fp.read().decode('utf-8') % params
+        fp.close()
+        # FIXME: Only FusekiStore.select supports (or needs) uniongraph
+        if context:
+            uniongraph = False
+        else:
+            uniongraph = True
+        return store.select(sq, "python", uniongraph=uniongraph)
+
+    def time_store_select(self, store, query_template, basefile,
+                          context=None, label="things"):
+        prefetched = getattr(self, '_prefetched_rows', {})
+        if (query_template, basefile) in prefetched:
+            return prefetched.pop((query_template, basefile))
+        values = {'basefile': basefile,
+                  'label': label,
+                  'count': None}
+        uri = self.canonical_uri(basefile)
+        msg = ("%(basefile)s: selected %(count)s %(label)s "
+               "(%(elapsed).3f sec)")
+        with util.logtime(self.log.debug,
+                          msg,
+                          values):
+            result = self.store_select(store,
+                                       query_template,
+                                       uri,
+                                       context)
+            values['count'] = len(result)
+        return result
+
+    def time_store_select_batch(self, store, query_template, basefiles,
+                                context=None, label="things"):
+        """Like time_store_select, but runs query_template once for all
+        basefiles. Returns a dict mapping each basefile to the list of
+        rows whose ``docuri`` binding is the canonical URI of that
+        basefile (in the order the store returned them)."""
+        values = {'basefiles': len(basefiles),
+                  'label': label,
+                  'count': None}
+        uris = [self.canonical_uri(basefile) for basefile in basefiles]
+        msg = ("%(basefiles)s basefiles: selected %(count)s %(label)s "
+               "(%(elapsed).3f sec)")
+        with util.logtime(self.log.debug,
+                          msg,
+                          values):
+            result = self.store_select(store,
+                                       query_template,
+                                       uris,
+                                       context)
+            values['count'] = len(result)
+        res = dict([(basefile, []) for basefile in basefiles])
+        uri_to_basefile = dict(zip(uris, basefiles))
+        for row in result:
+            res[uri_to_basefile[row['docuri']]].append(row)
+        return res
+
+    def prefetch_annotations(self, basefiles):
+        """Runs all queries from annotation_queries for basefiles in a
+        single round trip per query, and keeps the per-document results
+        around for time_store_select."""
+        if not hasattr(self, '_prefetched_rows'):
+            self._prefetched_rows = {}
+        store = TripleStore.connect(self.config.storetype,
+                                    self.config.storelocation,
+                                    self.config.storerepository)
+        for (query_template, context, label) in self.annotation_queries():
+            res = self.time_store_select_batch(store, query_template,
+                                               basefiles, context, label)
+            for basefile, rows in res.items():
+                self._prefetched_rows[(query_template, basefile)] = rows
+
+    def annotation_batching(self):
+        """Returns True if annotation data should be prefetched in
+        batches. This only pays off if this process generates all
+        basefiles (``generate --all`` with a single process), as
+        otherwise most of each batch would be fetched for nothing."""
+        return (self.config.annotationbatchsize > 1 and
+                LayeredConfig.get(self.config, 'all', False) and
+                self.config.processes <= 1 and
+                not LayeredConfig.get(self.config, 'buildserver') and
+                not LayeredConfig.get(self.config, 'buildqueue'))
+
+    def queue_annotation_batches(self, basefiles):
+        """Sets the basefiles (in the order generate processes them)
+        that annotation_batch takes its batches from."""
+        basefiles = list(basefiles)
+        self._annotation_queue = deque(basefiles)
+        self._annotation_pending = set(basefiles)
+
+    def annotation_batch(self, basefile):
+        """Returns basefile and the following annotationbatchsize - 1
+        queued basefiles. Queued basefiles before basefile have been
+        skipped by generate, and are dropped."""
+        if not hasattr(self, '_annotation_queue'):
+            self.queue_annotation_batches(
+                self.store.list_basefiles_for("generate"))
+        if basefile not in self._annotation_pending:
+            return [basefile]
+        batch = []
+        while (self._annotation_queue and
+               len(batch) < self.config.annotationbatchsize):
+            queued = self._annotation_queue.popleft()
+            self._annotation_pending.discard(queued)
+            if batch or queued == basefile:
+                batch.append(queued)
+        return batch
+
+    def prefetch_annotation_batch(self, basefile):
+        """Called at the start of prep_annotation_file. If batching is
+        enabled and nothing is prefetched for basefile, prefetch
+        annotation data for the batch that annotation_batch returns."""
+        if not self.annotation_batching():
+            return
+        prefetched = getattr(self, '_prefetched_rows', {})
+        for (query_template, context, label) in self.annotation_queries():
+            if (query_template, basefile) in prefetched:
+                return
+        # rows that were prefetched but never asked for (eg because
+        # generate decided that those files were up-to-date) are
+        # stale by now
+        self._prefetched_rows = {}
+        self.prefetch_annotations(self.annotation_batch(basefile))
+
+    def annotation_rows(self, basefile):
+        """Runs all queries from annotation_queries for basefile (using
+        prefetched rows if available). Returns a dict mapping each
+        query template to its list of rows."""
+        self.prefetch_annotation_batch(basefile)
+        store = TripleStore.connect(self.config.storetype,
+                                    self.config.storelocation,
+                                    self.config.storerepository)
+        rows = {}
+        for (query_template, context, label) in self.annotation_queries():
+            rows[query_template] = self.time_store_select(store,
+                                                          query_template,
+                                                          basefile,
+                                                          context,
+                                                          label)
+        return rows
+
+    def annotation_sources(self, rows):
+        """Returns a dict mapping the URI of each document that
+        contributed to rows (as returned by annotation_rows) to a short
+        human readable label for it. The default implementation uses
+        the ``uri`` and ``id`` bindings of each row, if present."""
+        sources = {}
+        for result in rows.values():
+            for row in result:
+                if 'uri' in row:
+                    sources[row['uri']] = row.get('id', '')
+        return sources
+
+    def annotation_manifest_path(self, basefile):
+        return self.store.path(basefile, 'annotations', '.deps.json',
+                               storage_policy="file")
+
+    def write_annotation_manifest(self, basefile, rows):
+        """Records the sources of rows for the annotation file of
+        basefile. Should be called by prep_annotation_file after the
+        annotation file is written."""
+        manifest = {'sources': self.annotation_sources(rows)}
+        path = self.annotation_manifest_path(basefile)
+        util.ensure_dir(path)
+        with open(path, "w") as fp:
+            fp.write(json.dumps(manifest, indent=2, sort_keys=True))
+
+    def read_annotation_manifest(self, basefile):
+        """Returns the manifest written by write_annotation_manifest for
+        basefile, or None if there is none."""
+        path = self.annotation_manifest_path(basefile)
+        if not os.path.exists(path):
+            return None
+        with open(path) as fp:
+            return json.load(fp)
+
+    def annotation_source_document(self, uri):
+        """Returns the URI of the document that uri (as recorded by
+        annotation_sources, possibly pointing into a document) is part
+        of."""
+        return uri.split("#")[0]
+
+    def annotation_basefile_from_uri(self, uri):
+        """Returns the basefile in this repo that uri refers to (or a
+        part of), or None."""
+        return self.basefile_from_uri(uri)
+
+    def annotation_source_index_path(self):
+        return self.store.path("sources", "annotations", ".json",
+                               storage_policy="file")
+
+    def read_annotation_source_index(self):
+        """Returns the source index written by annotations_to_rebuild: a
+        dict mapping the alias of each source repo to a dict mapping
+        each of its basefiles to the mtime of its distilled file and
+        the document URIs found in it."""
+        path = self.annotation_source_index_path()
+        if not os.path.exists(path):
+            return {}
+        with open(path) as fp:
+            return json.load(fp)
+
+    def write_annotation_source_index(self, sourceindex):
+        path = self.annotation_source_index_path()
+        util.ensure_dir(path)
+        # several generate processes may write this at the same time
+        tmppath = "%s.%s" % (path, os.getpid())
+        with open(tmppath, "w") as fp:
+            fp.write(json.dumps(sourceindex, sort_keys=True))
+        util.robust_rename(tmppath, path)
+
+    def annotations_to_rebuild(self, repos):
+        """Returns the set of basefiles whose annotation files are out of
+        date: either they have no manifest, or one of the documents in
+        repos that contributed to them (according to the manifest) or
+        that now refers to them has a distilled file that is newer than
+        the annotation file, or one of the documents that contributed
+        to them no longer exists in any of repos."""
+        basefiles = list(self.store.list_basefiles_for("generate"))
+        rebuild = set()
+        written = {}
+        # source document URI -> basefiles whose annotations it
+        # contributed to
+        index = {}
+        for basefile in basefiles:
+            manifest = self.read_annotation_manifest(basefile)
+            annotations = self.store.annotation_path(basefile)
+            if manifest is None or not os.path.exists(annotations):
+                rebuild.add(basefile)
+                continue
+            written[basefile] = os.path.getmtime(annotations)
+            for uri in manifest['sources']:
+                doc = self.annotation_source_document(uri)
+                index.setdefault(doc, set()).add(basefile)
+        since = min(written.values()) if written else None
+        oldsourceindex = self.read_annotation_source_index()
+        sourceindex = {}
+        # URIs of all documents that exist in repos
+        existing = set()
+        for repo in repos:
+            if repo.alias in sourceindex:
+                continue
+            known = oldsourceindex.get(repo.alias, {})
+            sources = sourceindex[repo.alias] = {}
+            for srcbasefile in repo.store.list_basefiles_for("relate"):
+                mtime = os.path.getmtime(
+                    repo.store.distilled_path(srcbasefile))
+                changed = since is not None and mtime > since
+                if (srcbasefile in known and known[srcbasefile][0] == mtime
+                        and not changed):
+                    sources[srcbasefile] = known[srcbasefile]
+                    existing.update(known[srcbasefile][1])
+                    continue
+                graph = Graph()
+                with repo.store.open_distilled(srcbasefile) as fp:
+                    graph.parse(fp, format="xml")
+                docs = self.annotation_documents(graph)
+                sources[srcbasefile] = [mtime, sorted(docs)]
+                existing.update(docs)
+                if changed:
+                    for basefile in self.annotations_affected_by(graph,
+                                                                 index):
+                        if basefile in written and mtime > written[basefile]:
+                            rebuild.add(basefile)
+        for doc in set(index) - existing:
+            self.log.debug("Annotation source %s no longer exists" % doc)
+            rebuild.update(index[doc])
+        self.write_annotation_source_index(sourceindex)
+        self.log.debug("%s of %s annotation files need to be rebuilt" %
+                       (len(rebuild), len(basefiles)))
+        # make annotation_batch batch only those
+        self.queue_annotation_batches([b for b in basefiles if b in rebuild])
+        return rebuild
+
+    def annotation_documents(self, graph):
+        """Returns the set of source document URIs described by graph
+        (the distilled data of a document)."""
+        return set([self.annotation_source_document(str(subject))
+                    for subject in graph.subjects()
+                    if isinstance(subject, URIRef)])
+
+    def annotations_affected_by(self, graph, index):
+        """Returns the basefiles whose annotations are affected by a
+        change in the document whose distilled data is graph: those
+        that it contributed to according to index (see
+        annotations_to_rebuild) and those that it refers to now."""
+        affected = set()
+        for doc in self.annotation_documents(graph):
+            affected.update(index.get(doc, ()))
+        for node in set(graph.subjects()) | set(graph.objects()):
+            if isinstance(node, URIRef):
+                target = self.annotation_basefile_from_uri(str(node))
+                if target:
+                    affected.add(target)
+        return affected
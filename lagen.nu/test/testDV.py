@@ -3,13 +3,30 @@ from __future__ import unicode_literals
 
 from ferenda.testutil import RepoTester, parametrize_repotester
 from ferenda.testutil import Py23DocChecker
+import codecs
 import doctest
+import email.utils
+import logging
+import os
+import shutil
+import tempfile
+import threading
 import unittest
+import zipfile
 from datetime import date
+from six.moves import BaseHTTPServer, SimpleHTTPServer
+from six.moves.urllib_parse import unquote
+from lxml import etree
+try:
+    from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.handlers import FTPHandler
+    from pyftpdlib.servers import FTPServer
+except ImportError:
+    FTPServer = None
 
 # SUT
 import dv
-from ferenda import fsmparser
+from ferenda import fsmparser, util
 
 
 class TestDV(RepoTester):
@@ -22,7 +39,9 @@ class TestDVParserBase(unittest.TestCase):
     maxDiff = None
     method = "none"
     def t(self, want, testdata, basefile="HDO/T1-14"):
-        p = dv.DV.get_parser(basefile)
+        # a parser of our own, since the one get_parser caches per
+        # court is shared with everything else in this process
+        p = dv.DV.make_parser(basefile.split("/")[0])
         p.reader = fsmparser.Peekable([testdata])
         p._state_stack = ["notbody"] # to avoid the special fallback rule in is_instans
         for f in p.recognizers:
@@ -474,3 +493,845 @@ class TestDelmal(TestDVParserBase):
     def test_with_malnr(self):
         self.t({'id': 'I'}, "I (UM1001-08)")
         
+
+
+@unittest.skipIf(FTPServer is None, "pyftpdlib not installed")
+class TestDownloadFTP(unittest.TestCase):
+
+    def setUp(self):
+        self.datadir = tempfile.mkdtemp()
+        self.ftproot = tempfile.mkdtemp()
+        for path, data in (("HDO/a.zip", b"A"),
+                           ("HDO/b.zip", b"B"),
+                           ("HFD/c.zip", b"C")):
+            path = os.path.join(self.ftproot, path)
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, "wb") as fp:
+                fp.write(data)
+        authorizer = DummyAuthorizer()
+        authorizer.add_user("user", "secret", self.ftproot)
+
+        class Handler(FTPHandler):
+            pass
+        Handler.authorizer = authorizer
+        self.server = FTPServer(("127.0.0.1", 0), Handler)
+        self.serving = True
+
+        def serve():
+            while self.serving:
+                self.server.serve_forever(timeout=0.1, blocking=False)
+            self.server.close_all()
+        self.thread = threading.Thread(target=serve)
+        self.thread.start()
+        processed = self.processed = []
+
+        class TestableDV(dv.DV):
+            def process_zipfile(self, zipfilename):
+                processed.append(zipfilename)
+        self.repo = TestableDV(datadir=self.datadir,
+                               ftphost="127.0.0.1",
+                               ftpport=self.server.address[1],
+                               ftpconnections=2)
+
+    def tearDown(self):
+        self.serving = False
+        self.thread.join()
+        shutil.rmtree(self.datadir)
+        shutil.rmtree(self.ftproot)
+
+    def test_download(self):
+        self.repo.download_ftp("", True, "user", "secret")
+        zips = self.repo.store.path('', 'downloaded/zips', '')
+        self.assertEqual([os.path.join(zips, "HDO", "a.zip"),
+                          os.path.join(zips, "HDO", "b.zip"),
+                          os.path.join(zips, "HFD", "c.zip")],
+                         sorted(self.processed))
+        with open(os.path.join(zips, "HFD", "c.zip"), "rb") as fp:
+            self.assertEqual(b"C", fp.read())
+        # no temporary files left behind
+        self.assertEqual(["a.zip", "b.zip"],
+                         sorted(os.listdir(os.path.join(zips, "HDO"))))
+        # nothing new to fetch the second time around
+        del self.processed[:]
+        self.repo.download_ftp("", True, "user", "secret")
+        self.assertEqual([], self.processed)
+
+
+class RangeHTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    # serves files below root, and supports open-ended Range requests
+    # ("bytes=N-") for files, with an optional If-Range header
+    # containing the Last-Modified date of the file
+    root = None
+    ranges = []
+    requests = []
+
+    def translate_path(self, path):
+        path = unquote(path.split("?")[0])
+        return os.path.join(self.root, *[p for p in path.split("/") if p])
+
+    def send_head(self):
+        path = self.translate_path(self.path)
+        self.requests.append((self.command, self.path))
+        rangeheader = self.headers.get("Range")
+        if not (rangeheader and os.path.isfile(path)):
+            return SimpleHTTPServer.SimpleHTTPRequestHandler.send_head(self)
+        ifrange = self.headers.get("If-Range")
+        if ifrange and ifrange != self.date_time_string(os.path.getmtime(path)):
+            # changed since, send all of it
+            return SimpleHTTPServer.SimpleHTTPRequestHandler.send_head(self)
+        self.ranges.append((self.path, rangeheader))
+        offset = int(rangeheader.split("=")[1].rstrip("-"))
+        size = os.path.getsize(path)
+        if offset >= size:
+            self.send_response(416)
+            self.send_header("Content-Range", "bytes */%s" % size)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return None
+        fp = open(path, "rb")
+        fp.seek(offset)
+        self.send_response(206)
+        self.send_header("Content-Type", "application/zip")
+        self.send_header("Content-Range", "bytes %s-%s/%s" % (offset, size - 1, size))
+        self.send_header("Content-Length", str(size - offset))
+        self.end_headers()
+        return fp
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestDownloadWWW(unittest.TestCase):
+
+    def setUp(self):
+        self.datadir = tempfile.mkdtemp()
+        self.wwwroot = tempfile.mkdtemp()
+        for path, data in (("HDO/a.zip", b"AAAABBBB"),
+                           ("HDO/b.zip", b"B"),
+                           ("HFD/c.zip", b"C" * 200000)):
+            path = os.path.join(self.wwwroot, path)
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, "wb") as fp:
+                fp.write(data)
+
+        class Handler(RangeHTTPRequestHandler):
+            root = self.wwwroot
+            ranges = []
+            requests = []
+        self.handler = Handler
+        self.server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        processed = self.processed = []
+
+        class TestableDV(dv.DV):
+            def process_zipfile(self, zipfilename):
+                processed.append(zipfilename)
+        self.repo = TestableDV(datadir=self.datadir,
+                               wwwurl="http://127.0.0.1:%s/" % self.server.server_address[1],
+                               httpconnections=2)
+        self.zips = self.repo.store.path('', 'downloaded/zips', '')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+        shutil.rmtree(self.datadir)
+        shutil.rmtree(self.wwwroot)
+
+    def test_download(self):
+        self.repo.download_www("", True)
+        self.assertEqual([os.path.join(self.zips, "HDO", "a.zip"),
+                          os.path.join(self.zips, "HDO", "b.zip"),
+                          os.path.join(self.zips, "HFD", "c.zip")],
+                         sorted(self.processed))
+        with open(os.path.join(self.zips, "HFD", "c.zip"), "rb") as fp:
+            self.assertEqual(b"C" * 200000, fp.read())
+        # no part files left behind
+        self.assertEqual(["a.zip", "b.zip"],
+                         sorted(os.listdir(os.path.join(self.zips, "HDO"))))
+        # nothing new to fetch the second time around
+        del self.processed[:]
+        self.repo.download_www("", True)
+        self.assertEqual([], self.processed)
+
+    def partfile(self, data, mtime):
+        # an interrupted transfer of HDO/a.zip, when its Last-Modified
+        # date was mtime
+        path = os.path.join(self.zips, "HDO", "a.zip.part")
+        util.ensure_dir(path)
+        with open(path, "wb") as fp:
+            fp.write(data)
+        util.writefile(path + ".validator",
+                       email.utils.formatdate(mtime, usegmt=True))
+
+    def downloaded_a(self):
+        with open(os.path.join(self.zips, "HDO", "a.zip"), "rb") as fp:
+            return fp.read()
+
+    def test_resume(self):
+        self.partfile(b"AAAA", os.path.getmtime(
+            os.path.join(self.wwwroot, "HDO", "a.zip")))
+        self.repo.download_www("HDO/", False)
+        self.assertEqual([("/HDO/a.zip", "bytes=4-")], self.handler.ranges)
+        self.assertEqual(b"AAAABBBB", self.downloaded_a())
+        self.assertEqual(["a.zip", "b.zip"],
+                         sorted(os.listdir(os.path.join(self.zips, "HDO"))))
+
+    def test_resume_changed(self):
+        # the remote file has been replaced since the transfer was
+        # interrupted, so the part file must not be resumed
+        self.partfile(b"XXXX", os.path.getmtime(
+            os.path.join(self.wwwroot, "HDO", "a.zip")) - 3600)
+        self.repo.download_www("HDO/", False)
+        self.assertEqual([], self.handler.ranges)
+        self.assertEqual(b"AAAABBBB", self.downloaded_a())
+
+    def test_resume_unknown_version(self):
+        self.partfile(b"XXXX", 0)
+        os.unlink(os.path.join(self.zips, "HDO", "a.zip.part.validator"))
+        self.repo.download_www("HDO/", False)
+        self.assertEqual([], self.handler.ranges)
+        self.assertEqual(b"AAAABBBB", self.downloaded_a())
+
+    def test_resume_complete(self):
+        # the transfer was interrupted after the last byte was written
+        self.partfile(b"AAAABBBB", os.path.getmtime(
+            os.path.join(self.wwwroot, "HDO", "a.zip")))
+        self.repo.download_www("HDO/", False)
+        self.assertEqual([("GET", "/HDO/a.zip")],
+                         [r for r in self.handler.requests
+                          if r[1] == "/HDO/a.zip"])
+        self.assertEqual(b"AAAABBBB", self.downloaded_a())
+        self.assertEqual(["a.zip", "b.zip"],
+                         sorted(os.listdir(os.path.join(self.zips, "HDO"))))
+
+    def test_replace_existing(self):
+        util.writefile(os.path.join(self.zips, "HDO", "a.zip"), "old")
+        self.repo.config.force = True
+        self.repo.download_www("HDO/", False)
+        self.assertEqual(b"AAAABBBB", self.downloaded_a())
+
+    def test_manifest(self):
+        for name, member in (("a.zip", "HDO_T1-01.doc"),
+                             ("b.zip", "HDO_T2-01.doc")):
+            with zipfile.ZipFile(os.path.join(self.wwwroot, "HDO", name),
+                                 "w") as zipf:
+                zipf.writestr(member, b"data")
+        processed = []
+
+        class CountingDV(dv.DV):
+            def process_zipfile(self, zipfilename):
+                processed.append(os.path.basename(zipfilename))
+                return super(CountingDV, self).process_zipfile(zipfilename)
+        repo = CountingDV(datadir=self.datadir, wwwurl=self.repo.config.wwwurl,
+                          httpconnections=2, downloadmax=None)
+        repo.download_www("HDO/", False)
+        self.assertEqual(["a.zip", "b.zip"], sorted(processed))
+        self.assertEqual(["HDO/T1-01"], repo.zipfile_basefiles(
+            os.path.join(self.zips, "HDO", "a.zip")))
+        # the downloaded zip files have already been processed
+        del processed[:]
+        repo.process_all_zipfiles()
+        self.assertEqual([], processed)
+
+    def test_rename_failure(self):
+        # something in the way of the downloaded file
+        os.makedirs(os.path.join(self.zips, "HDO", "b.zip", "x"))
+        self.repo.config.force = True
+        with self.assertRaises(OSError):
+            self.repo.download_www("HDO/", False)
+        self.assertNotIn(os.path.join(self.zips, "HDO", "b.zip"),
+                         self.processed)
+
+
+class FailingDV(dv.DV):
+    # module level, so that it can be sent to the worker processes
+    def process_zipfile(self, zipfilename):
+        if zipfilename.endswith("c.zip"):
+            raise ValueError("%s is broken" % zipfilename)
+        return super(FailingDV, self).process_zipfile(zipfilename)
+
+
+class TestZipfilesBase(unittest.TestCase):
+
+    def setUp(self):
+        self.datadir = tempfile.mkdtemp()
+        self.repo = dv.DV(datadir=self.datadir, processes=2,
+                          downloadmax=None)
+        self.zips = self.repo.store.path('', 'downloaded/zips', '')
+
+    def tearDown(self):
+        shutil.rmtree(self.datadir)
+
+    def makezip(self, name, members):
+        path = os.path.join(self.zips, "HDO", name)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with zipfile.ZipFile(path, "w") as zipf:
+            for membername, data in members:
+                zipf.writestr(membername, data)
+        return path
+
+    def downloaded(self, basefile):
+        with open(self.repo.store.path(basefile, "downloaded", ".doc"),
+                  "rb") as fp:
+            return fp.read()
+
+
+class TestZipfiles(TestZipfilesBase):
+
+    def test_batches(self):
+        a = self.makezip("a.zip", [("HDO_T1-01.doc", b"1"),
+                                   ("HDO_T2-01.doc", b"2")])
+        # replaces a document from a.zip, so it can't be processed
+        # at the same time as a.zip
+        b = self.makezip("b.zip", [("HDO_T1-01_BYTUT_2010-03-17.doc", b"1b")])
+        c = self.makezip("c.zip", [("HDO_T3-01.doc", b"3")])
+        d = self.makezip("d.zip", [("HDO_T2-01_TABORT_2010-03-18.doc", b""),
+                                   ("HDO_T3-01_BYTUT_2010-03-18.doc", b"3d")])
+        self.assertEqual([[a], [b, c], [d]],
+                         self.repo.zipfile_batches([a, b, c, d]))
+
+    def test_later_overrides_earlier(self):
+        self.makezip("a.zip", [("HDO_T1-01.doc", b"old"),
+                               ("HDO_T2-01.doc", b"2")])
+        self.makezip("b.zip", [("HDO_T1-01_BYTUT_2010-03-17.doc", b"newer")])
+        self.makezip("c.zip", [("HDO_T3-01.doc", b"3")])
+        self.makezip("d.zip", [("HDO_T1-01_BYTUT_2010-03-18.doc", b"newest"),
+                               ("HDO_T3-01_TABORT_2010-03-18.doc", b"")])
+        self.repo.process_all_zipfiles()
+        self.assertEqual(b"newest", self.downloaded("HDO/T1-01"))
+        self.assertEqual(b"2", self.downloaded("HDO/T2-01"))
+        self.assertFalse(os.path.exists(
+            self.repo.store.path("HDO/T3-01", "downloaded", ".doc")))
+
+    def test_worker_error(self):
+        self.makezip("a.zip", [("HDO_T1-01.doc", b"1")])
+        self.makezip("b.zip", [("HDO_T1-01_BYTUT_2010-03-17.doc", b"1b")])
+        self.makezip("c.zip", [("HDO_T2-01.doc", b"2")])
+        self.makezip("d.zip", [("HDO_T2-01_BYTUT_2010-03-17.doc", b"2d")])
+        repo = FailingDV(datadir=self.datadir, processes=2,
+                         downloadmax=None)
+        with self.assertRaises(ValueError):
+            repo.process_all_zipfiles()
+        # the zip file processed before the failing batch is recorded
+        # in the manifest, but nothing from the failing batch or after
+        self.assertEqual(["HDO/a.zip"], sorted(repo.load_zipmanifest()))
+
+
+class TestZipManifest(TestZipfilesBase):
+
+    def setUp(self):
+        super(TestZipManifest, self).setUp()
+        processed = self.processed = []
+
+        class CountingDV(dv.DV):
+            def process_zipfile(self, zipfilename):
+                processed.append(os.path.basename(zipfilename))
+                return super(CountingDV, self).process_zipfile(zipfilename)
+        self.repo = CountingDV(datadir=self.datadir, processes=1,
+                               downloadmax=None)
+        self.a = self.makezip("a.zip", [("HDO_T1-01.doc", b"1"),
+                                        ("HDO_T2-01.doc", b"2")])
+        self.b = self.makezip("b.zip", [("HDO_T1-01_BYTUT_2010-03-17.doc", b"1b")])
+        self.repo.process_all_zipfiles()
+        self.assertEqual(["a.zip", "b.zip"], self.processed)
+        del self.processed[:]
+
+    def test_unchanged(self):
+        self.repo.process_all_zipfiles()
+        self.assertEqual([], self.processed)
+
+    def test_changed_size(self):
+        self.makezip("b.zip", [("HDO_T1-01_BYTUT_2010-03-17.doc", b"1bb")])
+        self.repo.process_all_zipfiles()
+        self.assertEqual(["b.zip"], self.processed)
+
+    def test_changed_mtime(self):
+        # same size, but different content and a new mtime
+        self.makezip("b.zip", [("HDO_T1-01_BYTUT_2010-03-17.doc", b"1c")])
+        st = os.stat(self.b)
+        os.utime(self.b, (st.st_atime, st.st_mtime + 10))
+        self.repo.process_all_zipfiles()
+        self.assertEqual(["b.zip"], self.processed)
+
+    def test_touched(self):
+        # a new mtime but identical members (eg. downloaded again)
+        # only makes us compare the member CRCs
+        st = os.stat(self.a)
+        os.utime(self.a, (st.st_atime, st.st_mtime + 10))
+        self.repo.process_all_zipfiles()
+        self.assertEqual([], self.processed)
+        # ...and the new mtime is recorded
+        self.assertEqual(os.stat(self.a).st_mtime,
+                         self.repo.load_zipmanifest()["HDO/a.zip"]["mtime"])
+
+    def test_force(self):
+        self.repo.config.force = True
+        self.repo.process_all_zipfiles()
+        self.assertEqual(["a.zip", "b.zip"], self.processed)
+
+    def test_mapping(self):
+        self.assertEqual(["HDO/T1-01", "HDO/T2-01"],
+                         self.repo.zipfile_basefiles(self.a))
+        self.assertEqual(["HDO/T1-01"], self.repo.zipfile_basefiles(self.b))
+        self.assertEqual(["HDO/a.zip", "HDO/b.zip"],
+                         self.repo.basefile_zipfiles("HDO/T1-01"))
+        self.assertEqual(["HDO/a.zip"],
+                         self.repo.basefile_zipfiles("HDO/T2-01"))
+        self.assertEqual([], self.repo.basefile_zipfiles("HDO/T3-01"))
+        # basefile_zipfiles and zipfile_basefiles are each other's
+        # inverse
+        manifest = self.repo.load_zipmanifest()
+        for zipname in manifest:
+            zipfilename = os.path.join(self.zips, *zipname.split("/"))
+            for basefile in self.repo.zipfile_basefiles(zipfilename, manifest):
+                self.assertIn(zipname,
+                              self.repo.basefile_zipfiles(basefile, manifest))
+
+
+class TestExtractNotis(unittest.TestCase):
+    # The expected notis files in files/dv/notis were created by the
+    # original (BeautifulSoup-based) implementation of extract_notis
+    # from the same source files.
+    filesdir = os.path.join(os.path.dirname(__file__), "files", "dv")
+
+    def setUp(self):
+        self.datadir = tempfile.mkdtemp()
+        self.workdir = tempfile.mkdtemp()
+        self.repo = dv.DV(datadir=self.datadir)
+
+    def tearDown(self):
+        shutil.rmtree(self.datadir)
+        shutil.rmtree(self.workdir)
+
+    def assertNotis(self, basefiles, want):
+        self.assertEqual(want, basefiles)
+        for basefile in basefiles:
+            with open(os.path.join(self.filesdir, "notis",
+                                   basefile + ".xml"), "rb") as fp:
+                expected = fp.read()
+            with open(self.repo.store.intermediate_path(basefile), "rb") as fp:
+                self.assertEqual(expected, fp.read(), basefile)
+
+    def test_doc(self):
+        # antiword isn't needed, since WordReader uses an already
+        # converted docbook file if it exists
+        shutil.copy(os.path.join(self.filesdir, "HDO_2009_notis.xml"),
+                    self.workdir)
+        docfile = os.path.join(self.workdir, "HDO_2009_notis.doc")
+        open(docfile, "w").close()
+        basefiles = []
+        self.assertEqual((3, 0), self.repo.extract_notis(docfile, "2009",
+                                                         basefiles=basefiles))
+        self.assertNotis(basefiles, ["HDO/2009_not_1", "HDO/2009_not_2",
+                                     "HDO/2009_not_3"])
+
+    def test_docx(self):
+        docfile = os.path.join(self.workdir, "HDO_2010_notis.docx")
+        with zipfile.ZipFile(docfile, "w") as zipf:
+            zipf.write(os.path.join(self.filesdir, "HDO_2010_notis_document.xml"),
+                       "word/document.xml")
+        basefiles = []
+        self.assertEqual((2, 0), self.repo.extract_notis(docfile, "2010",
+                                                         basefiles=basefiles))
+        self.assertNotis(basefiles, ["HDO/2010_not_4", "HDO/2010_not_5"])
+
+    def extract_doc(self, xml, year="2009"):
+        with open(os.path.join(self.workdir, "HDO_notis.xml"), "wb") as fp:
+            fp.write(xml)
+        docfile = os.path.join(self.workdir, "HDO_notis.doc")
+        open(docfile, "w").close()
+        basefiles = []
+        res = self.repo.extract_notis(docfile, year, basefiles=basefiles)
+        return res, basefiles
+
+    def notis(self, basefile):
+        with open(self.repo.store.intermediate_path(basefile), "rb") as fp:
+            return fp.read()
+
+    def test_malformed(self):
+        with open(os.path.join(self.filesdir, "HDO_2009_notis.xml"), "rb") as fp:
+            xml = fp.read()
+        # a stray ampersand and a control character in the last notis
+        xml = xml.replace("rättegångskostnader.".encode("utf-8"),
+                          "rättegångskostnader & \x01mer.".encode("utf-8"))
+        res, basefiles = self.extract_doc(xml)
+        self.assertEqual((3, 0), res)
+        self.assertNotis(basefiles[:2], ["HDO/2009_not_1", "HDO/2009_not_2"])
+        self.assertEqual(["HDO/2009_not_1", "HDO/2009_not_2",
+                          "HDO/2009_not_3"], basefiles)
+        self.assertIn("rättegångskostnader &amp; mer.".encode("utf-8"),
+                      self.notis("HDO/2009_not_3"))
+
+    def test_malformed_previous(self):
+        # the month is found in the notis before, which isn't well-formed
+        util.writefile(self.repo.store.intermediate_path("HDO/2009_not_3"),
+                       '<body>\n<para><emphasis role="bold">Mars'
+                       '</emphasis></para>\n<para>A & B</para>\n</body>\n')
+        res, basefiles = self.extract_doc(
+            '<article><para><emphasis role="bold">Den 2:a. 4. (T 4-09)'
+            '</emphasis> Text.</para></article>'.encode("utf-8"))
+        self.assertEqual(["HDO/2009_not_4"], basefiles)
+        self.assertIn(b"<para><emphasis role=\"bold\">Mars</emphasis></para>",
+                      self.notis("HDO/2009_not_4"))
+
+
+class TestParseDate(unittest.TestCase):
+    def setUp(self):
+        self.saved_max = dv._parsed_dates_max
+        dv._parsed_dates.clear()
+
+    def tearDown(self):
+        dv._parsed_dates_max = self.saved_max
+        dv._parsed_dates.clear()
+
+    def test_same_as_repo(self):
+        repo = dv.DV()
+        for datestr in ("3 februari 2010", "8 dec. 1997", "november 1999",
+                        "1999", "vid utgången av februari 2000"):
+            self.assertEqual(repo.parse_swedish_date(datestr),
+                             dv.parse_date(datestr))
+        self.assertEqual(repo.parse_iso_date("2010-02-03"),
+                         dv.parse_date("2010-02-03"))
+        self.assertEqual(date(2010, 2, 3), dv.parse_date("2010- 02-03"))
+        with self.assertRaises(ValueError):
+            dv.parse_date("3 foobar 2010")
+
+    def test_evicts_least_recently_used(self):
+        dv._parsed_dates_max = 2
+        dv.parse_date("2010-01-01")
+        dv.parse_date("2010-01-02")
+        dv.parse_date("2010-01-01")  # now more recently used than 01-02
+        dv.parse_date("2010-01-03")
+        self.assertEqual(["2010-01-01", "2010-01-03"],
+                         list(dv._parsed_dates.keys()))
+
+
+class TestParseWord(unittest.TestCase):
+    # The expected values are what the original (BeautifulSoup-based)
+    # parse_antiword_docbook and parse_ooxml returned for the same
+    # intermediate files.
+    maxDiff = None
+    filesdir = os.path.join(os.path.dirname(__file__), "files", "dv")
+    doc_head = {'Domstol': 'Högsta domstolen',
+                'Referat': 'NJA 2009 s. 95',
+                'Målnummer': 'T 1-09',
+                'Avgörandedatum': '2009-02-10',
+                'Rubrik': 'Fråga om resning i mål om\nansvar för brott.',
+                'Lagrum': ['58 kap. 1 § rättegångsbalken',
+                           '1 kap. 1 § brottsbalken'],
+                'Rättsfall': ['NJA 2001 s. 1'],
+                'Sökord': 'Resning',
+                'Litteratur': 'Ekelöf, Rättegång IV'}
+    doc_body = ['Första stycket i referatet.',
+                'Andra stycket, medbetoning& mer.']
+    docx_head = {'Domstol': 'Högsta domstolen',
+                 'Referat': 'NJA 2009 s. 695',
+                 'Målnummer': 'T 2-09',
+                 'Avgörandedatum': '2009-03-11',
+                 'Rubrik': 'Fråga om skadestånd.',
+                 'Lagrum': ['5 kap. 1 § skadeståndslagen',
+                            '2 kap. 1 § skadeståndslagen'],
+                 'Rättsfall': ['NJA 1990 s. 1'],
+                 'Sökord': 'Skadestånd',
+                 'Litteratur': 'Bengtsson, Skadestånd'}
+    docx_body = ['Första stycket.', 'Andra stycket & mer.']
+
+    def setUp(self):
+        self.datadir = tempfile.mkdtemp()
+        self.repo = dv.DV(datadir=self.datadir)
+
+    def tearDown(self):
+        shutil.rmtree(self.datadir)
+
+    def read(self, filename):
+        with codecs.open(os.path.join(self.filesdir, filename),
+                         encoding="utf-8") as fp:
+            return fp.read()
+
+    def parse_doc(self, text):
+        return self.repo.parse_word(text, "HDO/T1-09", "doc")
+
+    def parse_docx(self, text):
+        text = self.repo._merge_ooxml(text, "HDO/T2-09")
+        return self.repo.parse_word(text, "HDO/T2-09", "docx")
+
+    def test_doc(self):
+        self.assertEqual((self.doc_head, self.doc_body),
+                         self.parse_doc(self.read("HDO_T1-09.xml")))
+
+    def test_docx(self):
+        self.assertEqual((self.docx_head, self.docx_body),
+                         self.parse_docx(self.read("HDO_T2-09.xml")))
+
+    def test_doc_layout(self):
+        # court and referat in a table instead of a pipe separated
+        # paragraph, an empty value, a label surrounded by
+        # whitespace, values that aren't whitespace-separated from
+        # their labels (Sökord) or that follow some tail text
+        # (Litteratur)
+        self.assertEqual(({'Domstol': 'Högstadomstolen',
+                           'Referat': 'NJA 2009 s. 200',
+                           'Målnummer': 'T 3-09',
+                           'Domsnummer': 'DT 5-09',
+                           'Avgörandedatum': '2009-05-05',
+                           'Rubrik': 'Frågaom ansvar för\ngrovt bedrägeri.',
+                           'Lagrum': ['9 kap. 1 § brottsbalken',
+                                      '9 kap. 3 § brottsbalken'],
+                           'Sökord': 'Bedrägeri',
+                           'Litteratur': 'Holmqvist m.fl., Brottsbalken'},
+                          ['Första stycket.', 'Andra stycket.',
+                           'Tredje stycket.']),
+                         self.parse_doc(self.read("HDO_T3-09.xml")))
+
+    def test_labels(self):
+        # each label is found in the first text node that contains it
+        doc = dv.WordDocument(self.read("HDO_T3-09.xml"))
+        nodes = doc.find_labels(self.repo.re_word_labels)
+        self.assertEqual(['Avdelning', 'Avgörandedatum', 'Domsnummer',
+                          'Lagrum', 'Målnummer', 'Rubrik', 'Sökord'],
+                         sorted(nodes))
+        self.assertEqual("\nLagrum:\n", nodes['Lagrum'])
+        self.assertEqual("entry", doc.container(nodes['Lagrum']).tag)
+
+    def test_doc_malformed(self):
+        # a stray "&" is kept (as BeautifulSoup did), control
+        # characters are removed
+        text = self.read("HDO_T1-09.xml").replace(
+            "i mål om", "i mål & om").replace("Första", "\x0cFörsta")
+        want = dict(self.doc_head)
+        want['Rubrik'] = 'Fråga om resning i mål & om\nansvar för brott.'
+        self.assertEqual((want, self.doc_body), self.parse_doc(text))
+
+    def test_docx_malformed(self):
+        # a truncated file is parsed as far as it goes
+        text = self.read("HDO_T2-09.xml").replace("</w:document>", "")
+        self.assertEqual((self.docx_head, self.docx_body),
+                         self.parse_docx(text))
+
+    def test_unparseable(self):
+        with self.assertRaises(etree.XMLSyntaxError):
+            self.parse_doc("not xml at all")
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class TestWordcache(unittest.TestCase):
+    ooxml = ('<w:document xmlns:w="http://schemas.openxmlformats.org/'
+             'wordprocessingml/2006/main"><w:body><w:p><w:r><w:t>%s</w:t>'
+             '</w:r></w:p></w:body></w:document>')
+
+    def setUp(self):
+        self.datadir = tempfile.mkdtemp()
+        self.repo = dv.DV(datadir=self.datadir)
+        self.docfile = self.repo.store.path("HDO/T2-09", "downloaded",
+                                            ".docx")
+        self.intermediatefile = self.repo.store.intermediate_path("HDO/T2-09")
+        self.makedocx("Första stycket.")
+
+    def tearDown(self):
+        shutil.rmtree(self.datadir)
+
+    def makedocx(self, text):
+        util.ensure_dir(self.docfile)
+        with zipfile.ZipFile(self.docfile, "w") as zipf:
+            zipf.writestr("word/document.xml",
+                          (self.ooxml % text).encode("utf-8"))
+
+    def convert(self):
+        self.repo.convert_word(self.docfile, self.intermediatefile)
+        return util.readfile(self.intermediatefile, encoding="utf-8")
+
+    def cachefiles(self):
+        return util.list_dirs(self.repo.store.datadir + os.sep + "wordcache",
+                              ".xml")
+
+    def test_miss(self):
+        self.assertIn("Första stycket.", self.convert())
+        cachefiles = list(self.cachefiles())
+        self.assertEqual(1, len(cachefiles))
+        self.assertEqual(util.readfile(self.intermediatefile, "rb"),
+                         util.readfile(cachefiles[0], "rb"))
+
+    def test_hit(self):
+        self.convert()
+        # tamper with the cache entry, so that we can tell that it,
+        # and not the docx file, was used
+        cachefile = list(self.cachefiles())[0]
+        util.writefile(cachefile, self.ooxml % "Från cachen.")
+        self.assertIn("Från cachen.", self.convert())
+
+    def test_changed_document(self):
+        self.convert()
+        self.makedocx("Andra stycket.")
+        self.assertIn("Andra stycket.", self.convert())
+        self.assertEqual(2, len(list(self.cachefiles())))
+
+    def test_ferenda_version(self):
+        key = self.repo.wordcache_key(self.docfile)
+        oldversion = dv.ferenda.__version__
+        dv.ferenda.__version__ = "0.0.0"
+        try:
+            self.assertNotEqual(key, self.repo.wordcache_key(self.docfile))
+        finally:
+            dv.ferenda.__version__ = oldversion
+        self.assertEqual(key, self.repo.wordcache_key(self.docfile))
+
+    def test_antiword_version(self):
+        docfile = self.docfile.replace(".docx", ".doc")
+        shutil.copy2(self.docfile, docfile)
+        oldversion = dv._antiword_version
+        try:
+            dv._antiword_version = "0.37"
+            key = self.repo.wordcache_key(docfile)
+            dv._antiword_version = "0.38"
+            self.assertNotEqual(key, self.repo.wordcache_key(docfile))
+        finally:
+            dv._antiword_version = oldversion
+
+    def run_all(self, force=False):
+        handler = ListHandler()
+        log = logging.getLogger(self.repo.alias)
+        log.addHandler(handler)
+        oldlevel = log.level
+        log.setLevel(logging.INFO)
+        try:
+            self.repo.config.force = force
+            dv.DV.parse_all_setup(self.repo.config)
+            self.convert()
+            dv.DV.parse_all_teardown(self.repo.config)
+        finally:
+            log.removeHandler(handler)
+            log.setLevel(oldlevel)
+        return [r.getMessage() for r in handler.records
+                if r.levelno == logging.INFO]
+
+    def test_summary(self):
+        self.assertEqual(["Conversion cache: 0 hits, 1 misses, "
+                          "0 stale entries removed"], self.run_all())
+        self.assertEqual(["Conversion cache: 1 hits, 0 misses, "
+                          "0 stale entries removed"], self.run_all())
+        self.assertFalse(os.path.exists(
+            self.repo.store.datadir + os.sep + "wordcache/run.log"))
+
+    def test_evict(self):
+        self.convert()
+        self.makedocx("Andra stycket.")
+        # a regular run keeps the entry for the old document...
+        self.run_all()
+        self.assertEqual(2, len(list(self.cachefiles())))
+        # ...but a forced run, where every document is converted,
+        # removes it
+        self.assertEqual(["Conversion cache: 1 hits, 0 misses, "
+                          "1 stale entries removed"], self.run_all(force=True))
+        self.assertEqual(1, len(list(self.cachefiles())))
+        self.assertIn("Andra stycket.", self.convert())
+
+
+class TestTOC(unittest.TestCase):
+    nja = 'http://rinfo.lagrummet.se/ref/rff/nja'
+    ra = 'http://rinfo.lagrummet.se/ref/rff/ra'
+
+    def setUp(self):
+        self.datadir = tempfile.mkdtemp()
+        generated = self.generated = []
+
+        class TestableDV(dv.DV):
+            def toc_generate_page(self, binding, value, documentlist,
+                                  pagesets, effective_basefile=None,
+                                  otherrepos=[]):
+                generated.append("%s/%s" % (binding, value))
+                outfile = self.store.resourcepath("toc/%s/%s.html" %
+                                                  (binding, value))
+                with self.store._open(outfile, "w") as fp:
+                    fp.write("")
+                return outfile
+        self.repo = TestableDV(datadir=self.datadir)
+        self.data = [self.row(self.nja, "2009", "NJA 2009 s. 695", "1"),
+                     self.row(self.nja, "2009", "NJA 2009 s. 95", "2"),
+                     self.row(self.nja, "2010", "NJA 2010 s. 1", "3"),
+                     self.row(self.ra, "2009", "RÅ 2009 ref. 10", "4")]
+
+    def tearDown(self):
+        shutil.rmtree(self.datadir)
+
+    def row(self, pub, year, identifier, n):
+        return {'uri': 'http://example.org/dom/%s' % n,
+                'rpubl_rattsfallspublikation': pub,
+                'rpubl_arsutgava': year,
+                'dcterms_identifier': identifier,
+                'rpubl_referatrubrik': 'Rubrik %s' % n}
+
+    def toc(self):
+        del self.generated[:]
+        pagesets = [dv.TocPageset(label=label, predicate=pub, pages=[])
+                    for pub, label in ((self.nja, "NJA"), (self.ra, "RÅ"))]
+        pagecontent = self.repo.toc_select_for_pages(self.data, pagesets,
+                                                     self.repo.facets())
+        self.repo.toc_generate_pages(pagecontent, pagesets)
+        return pagecontent
+
+    def test_sortkey(self):
+        pagecontent = self.toc()
+        self.assertEqual(["NJA 2009 s. 95", "NJA 2009 s. 695"],
+                         [item[0][0] for item in pagecontent[('nja', '2009')]])
+
+    def test_unchanged(self):
+        self.toc()
+        self.assertEqual(["nja/2009", "nja/2010", "ra/2009"],
+                         sorted(self.generated))
+        self.toc()
+        self.assertEqual([], self.generated)
+
+    def test_changed_bucket(self):
+        self.toc()
+        self.data[2]['rpubl_referatrubrik'] = 'Ny rubrik'
+        self.toc()
+        self.assertEqual(["nja/2010"], self.generated)
+
+    def test_changed_pages(self):
+        self.toc()
+        self.data.append(self.row(self.ra, "2010", "RÅ 2010 ref. 1", "5"))
+        self.toc()
+        self.assertEqual(["nja/2009", "nja/2010", "ra/2009", "ra/2010"],
+                         sorted(self.generated))
+
+    def test_changed_stylesheets(self):
+        self.toc()
+        resources = os.sep.join([self.datadir, 'rsrc', 'resources.xml'])
+        os.makedirs(os.path.dirname(resources))
+        with open(resources, "w") as fp:
+            fp.write("<configuration/>")
+        self.toc()
+        self.assertEqual(["nja/2009", "nja/2010", "ra/2009"],
+                         sorted(self.generated))
+        self.toc()
+        self.assertEqual([], self.generated)
+
+    def test_digest_independent_of_cwd(self):
+        xsldir = os.path.join(os.path.dirname(os.path.abspath(dv.__file__)),
+                              "res", "xsl")
+        cwd = os.getcwd()
+        os.chdir(os.path.dirname(os.path.dirname(xsldir)))
+        try:
+            digest = self.repo.toc_stylesheet_digest()
+            os.chdir(self.datadir)
+            shutil.copytree(xsldir, os.path.join("res", "xsl"))
+            self.assertEqual(digest, self.repo.toc_stylesheet_digest())
+            # the Transformer would compile this changed stylesheet
+            with open(os.path.join("res", "xsl", "dv.xsl"), "a") as fp:
+                fp.write("<!-- changed -->")
+            self.assertNotEqual(digest, self.repo.toc_stylesheet_digest())
+        finally:
+            os.chdir(cwd)
@@ -0,0 +1,551 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from functools import cmp_to_key
+import logging
+import os
+import random
+import re
+import shutil
+import tempfile
+import unittest
+try:
+    from html import escape as html_escape
+
+    def escape(s):
+        return html_escape(s, quote=False)
+except ImportError:
+    from cgi import escape
+
+from lxml import etree
+from lxml.builder import ElementMaker
+from rdflib import Graph, URIRef
+from rdflib.namespace import DCTERMS
+
+from ferenda import util, DocumentStore
+
+# SUT
+import cachedtransform
+import sfs
+from sortkeys import numsortkey
+from storeselect import StoreSelectMixin
+
+
+class TestNumSortKey(unittest.TestCase):
+
+    def test_fragments(self):
+        self.assertEqual(['https://lagen.nu/1998:204',
+                          'https://lagen.nu/1998:204#K1P2',
+                          'https://lagen.nu/1998:204#K1P2a',
+                          'https://lagen.nu/1998:204#K1P10',
+                          'https://lagen.nu/1998:204#K2P1'],
+                         sorted(['https://lagen.nu/1998:204#K1P10',
+                                 'https://lagen.nu/1998:204#K2P1',
+                                 'https://lagen.nu/1998:204#K1P2a',
+                                 'https://lagen.nu/1998:204',
+                                 'https://lagen.nu/1998:204#K1P2'],
+                                key=numsortkey))
+
+    def test_same_order_as_numcmp(self):
+        rnd = random.Random(42)
+        uris = []
+        for i in range(2000):
+            uris.append("https://lagen.nu/1942:740#K%s%sP%s%sS%s" % (
+                rnd.randint(1, 60), rnd.choice(['', 'a', 'b']),
+                rnd.randint(1, 80), rnd.choice(['', 'a']),
+                rnd.randint(1, 6)))
+        uris.append("https://lagen.nu/1942:740")
+        self.assertEqual(sorted(uris, key=cmp_to_key(util.numcmp)),
+                         sorted(uris, key=numsortkey))
+
+
+class TestAggregateAnnotations(unittest.TestCase):
+    baseuri = "https://lagen.nu/1942:740"
+
+    def naive_rattsfall(self, rows):
+        # the original list-scanning implementation, kept here as
+        # the reference for the expected output
+        stuff = {self.baseuri: {'rattsfall': []}}
+        specifics = {}
+        for row in rows:
+            if 'lagrum' not in row:
+                lagrum = self.baseuri
+            else:
+                if "S" in row['lagrum']:
+                    lagrum = row['lagrum'][:row['lagrum'].index("S")]
+                else:
+                    lagrum = row['lagrum']
+                specifics[row['id']] = True
+            if lagrum not in stuff:
+                stuff[lagrum] = {}
+            if 'rattsfall' not in stuff[lagrum]:
+                stuff[lagrum]['rattsfall'] = []
+            record = {'id': row['id'],
+                      'desc': row['desc'],
+                      'uri': row['uri']}
+            if record not in stuff[lagrum]['rattsfall']:
+                stuff[lagrum]['rattsfall'].append(record)
+        stuff[self.baseuri]['rattsfall'] = [
+            r for r in stuff[self.baseuri]['rattsfall']
+            if r['id'] not in specifics]
+        return stuff
+
+    def test_rattsfall_10k(self):
+        rnd = random.Random(42)
+        rows = []
+        for i in range(10000):
+            case = rnd.randint(1, 500)
+            row = {'id': 'NJA 2001 s %s' % case,
+                   'desc': 'Referat %s' % case,
+                   'uri': 'https://lagen.nu/dom/nja/2001s%s' % case}
+            # most rows refer to a specific stycke in one of a few
+            # heavily cited sections, some to the law itself
+            if rnd.random() > 0.05:
+                row['lagrum'] = '%s#K%sP%sS%s' % (self.baseuri,
+                                                  rnd.randint(1, 3),
+                                                  rnd.randint(1, 5),
+                                                  rnd.randint(1, 4))
+            rows.append(row)
+        want = self.naive_rattsfall(rows)
+        got = sfs.SFS._aggregate_annotations(self.baseuri, rows, [], [], [])
+        del got[self.baseuri]['inboundlinks']
+        self.assertEqual(want, got)
+
+    def test_inbound_wiki_changes(self):
+        got = sfs.SFS._aggregate_annotations(
+            self.baseuri,
+            [],
+            [{'uri': 'https://lagen.nu/1998:204#P1', 'lagrum': self.baseuri + '#P2S1'},
+             {'uri': 'https://lagen.nu/1998:204#P1'},
+             {'uri': 'https://lagen.nu/1998:204#P3'}],
+            [{'desc': '<p>Lagen</p>'},
+             {'lagrum': self.baseuri + '#P2', 'desc': '<p>Paragrafen</p>'}],
+            [{'lagrum': self.baseuri + '#P2', 'change': 'https://lagen.nu/2001:1',
+              'id': '2001:1'}])
+        self.assertEqual({self.baseuri: {'rattsfall': [],
+                                         'inboundlinks': [{'uri': 'https://lagen.nu/1998:204#P3'}],
+                                         'desc': '<p>Lagen</p>'},
+                          self.baseuri + '#P2S1': {'inboundlinks': [{'uri': 'https://lagen.nu/1998:204#P1'}]},
+                          self.baseuri + '#P2': {'desc': '<p>Paragrafen</p>',
+                                                 'changes': [{'uri': 'https://lagen.nu/2001:1',
+                                                              'id': '2001:1'}]}},
+                         got)
+
+
+class AnnotatedRepo(StoreSelectMixin):
+    alias = "law"
+    log = logging.getLogger("test")
+
+    def __init__(self, datadir):
+        self.store = DocumentStore(datadir + "/law")
+
+    def annotation_basefile_from_uri(self, uri):
+        if uri.startswith("http://example.org/law/"):
+            return uri[len("http://example.org/law/"):].split("#")[0]
+
+
+class CaseRepo(object):
+    alias = "case"
+
+    def __init__(self, datadir):
+        self.store = DocumentStore(datadir + "/case")
+
+
+class TestAnnotationManifest(unittest.TestCase):
+    rows = {"res/sparql/sfs_rattsfallsref.rq":
+            [{'uri': 'http://example.org/case/1', 'id': 'NJA 2001 s 1',
+              'desc': 'Referat 1', 'lagrum': 'http://example.org/law/1#P1'},
+             {'uri': 'http://example.org/case/2', 'id': 'NJA 2001 s 2',
+              'desc': 'Referat 2', 'lagrum': 'http://example.org/law/1#P2'}]}
+
+    def setUp(self):
+        self.datadir = tempfile.mkdtemp()
+        self.repo = AnnotatedRepo(self.datadir)
+        self.cases = CaseRepo(self.datadir)
+        # law 1 is annotated with case 1 and 2, law 2 with nothing
+        for basefile in ("1", "2"):
+            util.writefile(self.repo.store.parsed_path(basefile), "<html/>")
+            util.writefile(self.repo.store.annotation_path(basefile), "")
+            self.set_mtime(self.repo.store.annotation_path(basefile), 2000)
+        self.repo.write_annotation_manifest("1", self.rows)
+        self.repo.write_annotation_manifest("2", {})
+        self.write_case("1", "http://example.org/law/1#P1", 1000)
+        self.write_case("2", "http://example.org/law/1#P2", 1000)
+
+    def tearDown(self):
+        shutil.rmtree(self.datadir)
+
+    def set_mtime(self, path, mtime):
+        os.utime(path, (mtime, mtime))
+
+    def write_case(self, basefile, lagrum, mtime):
+        g = Graph()
+        g.add((URIRef("http://example.org/case/" + basefile),
+               DCTERMS.references, URIRef(lagrum)))
+        path = self.cases.store.distilled_path(basefile)
+        util.ensure_dir(path)
+        with open(path, "wb") as fp:
+            fp.write(g.serialize(format="xml"))
+        self.set_mtime(path, mtime)
+
+    def test_roundtrip(self):
+        self.assertEqual({'sources': {'http://example.org/case/1': 'NJA 2001 s 1',
+                                      'http://example.org/case/2': 'NJA 2001 s 2'}},
+                         self.repo.read_annotation_manifest("1"))
+        self.assertEqual({'sources': {}}, self.repo.read_annotation_manifest("2"))
+        self.assertEqual(None, self.repo.read_annotation_manifest("3"))
+
+    def test_unchanged_source(self):
+        self.assertEqual(set(), self.repo.annotations_to_rebuild([self.cases]))
+
+    def test_changed_source(self):
+        self.set_mtime(self.cases.store.distilled_path("2"), 3000)
+        self.assertEqual(set(["1"]),
+                         self.repo.annotations_to_rebuild([self.cases]))
+
+    def test_moved_source(self):
+        # case 2 now refers to law 2 instead. Both need to be rebuilt.
+        self.write_case("2", "http://example.org/law/2#P1", 3000)
+        self.assertEqual(set(["1", "2"]),
+                         self.repo.annotations_to_rebuild([self.cases]))
+
+    def test_new_source(self):
+        self.write_case("3", "http://example.org/law/2", 3000)
+        self.assertEqual(set(["2"]),
+                         self.repo.annotations_to_rebuild([self.cases]))
+
+    def test_removed_source(self):
+        util.robust_remove(self.cases.store.distilled_path("2"))
+        self.assertEqual(set(["1"]),
+                         self.repo.annotations_to_rebuild([self.cases]))
+
+    def test_source_index(self):
+        self.repo.annotations_to_rebuild([self.cases])
+        sources = self.repo.read_annotation_source_index()['case']
+        self.assertEqual([1000, ['http://example.org/case/1']], sources['1'])
+        # unchanged distilled files aren't read again
+        util.writefile(self.cases.store.distilled_path("1"), "not rdf")
+        self.set_mtime(self.cases.store.distilled_path("1"), 1000)
+        self.assertEqual(set(), self.repo.annotations_to_rebuild([self.cases]))
+
+    def test_missing_manifest(self):
+        util.robust_remove(self.repo.annotation_manifest_path("2"))
+        self.assertEqual(set(["2"]),
+                         self.repo.annotations_to_rebuild([self.cases]))
+
+
+class Config(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class TestAnnotationBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.datadir = tempfile.mkdtemp()
+        self.repo = AnnotatedRepo(self.datadir)
+        self.repo.config = Config(annotationbatchsize=3, all=True,
+                                  processes=1)
+
+    def tearDown(self):
+        shutil.rmtree(self.datadir)
+
+    def test_batching(self):
+        self.assertTrue(self.repo.annotation_batching())
+        # generating a single basefile
+        del self.repo.config.all
+        self.assertFalse(self.repo.annotation_batching())
+        # every worker process generates only some of the basefiles
+        self.repo.config.all = True
+        self.repo.config.processes = 2
+        self.assertFalse(self.repo.annotation_batching())
+        self.repo.config.processes = 1
+        self.repo.config.annotationbatchsize = 1
+        self.assertFalse(self.repo.annotation_batching())
+
+    def test_batches(self):
+        self.repo.queue_annotation_batches(["1", "2", "3", "4", "5", "6"])
+        self.assertEqual(["1", "2", "3"], self.repo.annotation_batch("1"))
+        # generate skipped 4
+        self.assertEqual(["5", "6"], self.repo.annotation_batch("5"))
+        self.assertEqual(["4"], self.repo.annotation_batch("4"))
+        self.assertEqual(["7"], self.repo.annotation_batch("7"))
+
+    def test_no_batching(self):
+        self.repo.config.processes = 2
+        self.repo.prefetch_annotation_batch("1")
+        self.assertFalse(hasattr(self.repo, '_prefetched_rows'))
+        self.assertFalse(hasattr(self.repo, '_annotation_queue'))
+
+
+class TestCachedTransform(unittest.TestCase):
+    xsl = """<xsl:stylesheet version="1.0"
+    xmlns:xsl="http://www.w3.org/1999/XSL/Transform">
+  <xsl:template match="/"><p>%s</p></xsl:template>
+</xsl:stylesheet>"""
+
+    def setUp(self):
+        self.datadir = tempfile.mkdtemp()
+        self.template = os.path.join(self.datadir, "xsl", "test.xsl")
+        self.write_template("one", 1000)
+
+    def tearDown(self):
+        shutil.rmtree(self.datadir)
+
+    def write_template(self, text, mtime):
+        util.writefile(self.template, self.xsl % text)
+        os.utime(self.template, (mtime, mtime))
+
+    def transform(self):
+        transformer = cachedtransform.get_transformer(
+            self.template, [os.path.dirname(self.template)], None,
+            self.datadir)
+        return transformer, etree.tostring(
+            transformer.transform(etree.fromstring("<doc/>"), 0))
+
+    def test_cached(self):
+        first, res = self.transform()
+        self.assertEqual(b"<p>one</p>", res)
+        second, res = self.transform()
+        self.assertIs(first, second)
+
+    def test_changed_stylesheet(self):
+        first, res = self.transform()
+        self.write_template("two", 2000)
+        second, res = self.transform()
+        self.assertIsNot(first, second)
+        self.assertEqual(b"<p>two</p>", res)
+
+
+class TestNewsEntries(unittest.TestCase):
+    xhtml2 = "http://www.w3.org/2002/06/xhtml2/"
+    docs = {"1998:204": """<html xmlns="http://www.w3.org/2002/06/xhtml2/">
+<head><title>Personuppgiftslag (1998:204)</title></head>
+<body><p>...</p><div class="register"><h1>Ändringar</h1>
+<div class="registerpost" id="L1998:204"><dl>
+  <dt>Rubrik</dt><dd property="dcterms:title">Personuppgiftslag (1998:204)</dd>
+  <dt>Ikraft</dt><dd property="rpubl:ikrafttradandedatum">1998-10-24</dd>
+</dl></div>
+<div class="registerpost" id="L2003:104"><dl>
+  <dt>Rubrik</dt><dd property="dcterms:title">Lag (2003:104) om ändring i personuppgiftslagen (1998:204)</dd>
+  <dt rel="x">Omfattning</dt><dd property="rpubl:andrar" lang="sv">ändr. 2 &amp; 3 §§; ny 4 § &lt;&gt;</dd>
+  <dt class="a" title='he said "hi"'>Förarbeten</dt><dd>Prop. 2002/03:123</dd>
+</dl>tail</div>
+</div></body></html>""",
+            "2010:5": """<html xmlns="http://www.w3.org/2002/06/xhtml2/">
+<head><title>Förordning (2010:5) om statsbidrag</title></head>
+<body><div class="register"><h1>Ändringar</h1>
+<div class="registerpost" id="L2010:5"><dl>
+  <dt>Rubrik</dt><dd property="dcterms:title">Förordning (2010:5) om statsbidrag</dd>
+</dl></div>
+<div class="registerpost" id="L2011:7"><dl>
+  <dt>Rubrik</dt><dd property="dcterms:title">Förordning (2011:7) om ändring i förordningen (2010:5) om statsbidrag</dd>
+</dl></div>
+</div></body></html>"""}
+    messages = [("2011-01-02", "2003:104 [1998:204]"),
+                ("2011-01-02", "2011:7 [2010:5]"),
+                ("2011-01-01", "2003:104 [1998:204]"),
+                ("2011-01-01", "2010:5 [2010:5]"),
+                ("2011-01-01", "1998:204 [1998:204]")]
+
+    def old_entries(self, repo, trees):
+        # the original implementation, which read the parsed
+        # documents, kept here as the reference for the expected
+        # output
+        changes = {}
+        all_entries = []
+        lag_entries = []
+        ovr_entries = []
+        for (timestamp, message) in self.messages:
+            m = repo.re_message.match(message)
+            change = m.group(1)
+            if change in changes:
+                continue
+            changes[change] = True
+            bases = m.group(2).split(", ")
+            tree, ids = trees[bases[0]]
+            if change != bases[0]:
+                for e in ids['L' + change].findall(".//{%s}dd" % self.xhtml2):
+                    if 'property' in e.attrib and e.attrib['property'] == 'dcterms:title':
+                        title = e.text
+            else:
+                title = tree.find(".//{%s}title" % self.xhtml2).text
+            uri = '/%s' % bases[0]
+            for node in ids['L' + change]:
+                m = repo.re_qname.match(node.tag)
+                if m.group(2) == 'dl':
+                    content = repo._element_to_string(node)
+            entry = {'title': title,
+                     'timestamp': timestamp,
+                     'id': change,
+                     'uri': uri,
+                     'content': '<p><a href="%s">Författningstext</a></p>%s' % (uri, content)}
+            all_entries.append(entry)
+            basetitle = repo.re_sfsnr.sub('', title)
+            if (basetitle.startswith('Lag ') or
+                (basetitle.endswith('lag') and not basetitle.startswith('Förordning')) or
+                    basetitle.endswith('balk')):
+                lag_entries.append(entry)
+            else:
+                ovr_entries.append(entry)
+        return [all_entries, lag_entries, ovr_entries]
+
+    def setUp(self):
+        self.datadir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.datadir)
+
+    def test_entries(self):
+        repo = sfs.SFS(datadir=self.datadir)
+        trees = {}
+        for basefile, xhtml in self.docs.items():
+            tree, ids = etree.XMLID(xhtml.encode("utf-8"))
+            trees[basefile] = tree, ids
+            register = tree.find(".//{%s}div[@class='register']" % self.xhtml2)
+            repo._write_changes(basefile,
+                                tree.find(".//{%s}title" % self.xhtml2).text,
+                                register)
+        rendered = []
+
+        def render(htmlfile, atomfile, title, subtitle, entries):
+            rendered.append(entries)
+        repo._render_newspage = render
+        repo._build_newspages(self.messages)
+        self.assertEqual(self.old_entries(repo, trees), rendered)
+        self.assertEqual(2, len(rendered[1]))
+
+    def test_parsed_before_changes(self):
+        # laws parsed before changes files were written get them from
+        # their parsed document
+        repo = sfs.SFS(datadir=self.datadir)
+        trees = {}
+        for basefile, xhtml in self.docs.items():
+            trees[basefile] = etree.XMLID(xhtml.encode("utf-8"))
+            util.writefile(repo.store.parsed_path(basefile), xhtml)
+        rendered = []
+
+        def render(htmlfile, atomfile, title, subtitle, entries):
+            rendered.append(entries)
+        repo._render_newspage = render
+        repo._build_newspages(self.messages)
+        self.assertEqual(self.old_entries(repo, trees), rendered)
+        self.assertTrue(os.path.exists(repo.store.changes_path("1998:204")))
+
+
+class TestIndexPages(unittest.TestCase):
+    laws = {"https://lagen.nu/1998:204": ("1998:204", "Personuppgiftslag (1998:204)"),
+            "https://lagen.nu/1998:1000": ("1998:1000", "Lag (1998:1000) om arbetsmiljö"),
+            "https://lagen.nu/1998:99": ("1998:99", "Förordning (1998:99) om avgifter"),
+            "https://lagen.nu/2010:5": ("2010:5", "Förordning (2010:5) om statsbidrag")}
+
+    def setUp(self):
+        self.datadir = tempfile.mkdtemp()
+        util.ensure_dir(self.datadir + "/sfs/generated/notfound.shtml")
+        util.writefile(self.datadir + "/rsrc/resources.xml",
+                       "<configuration><sitename>lagen.nu</sitename></configuration>")
+
+    def tearDown(self):
+        shutil.rmtree(self.datadir)
+
+    def test_render(self):
+        repo = sfs.SFS(datadir=self.datadir, url="https://lagen.nu/",
+                       processes=2)
+        by_pred_obj = {util.ns['rdf'] + 'type':
+                       {sfs.RPUBL.KonsolideradGrundforfattning:
+                        sorted(self.laws)}}
+        by_subj_pred = {}
+        for uri, (fsnr, title) in self.laws.items():
+            by_subj_pred[uri] = {sfs.RPUBL.fsNummer: fsnr,
+                                 util.ns['dcterms'] + 'title': title}
+        repo._build_indexpages(by_pred_obj, by_subj_pred)
+
+        indexdir = self.datadir + "/sfs/generated/index/"
+        # titles are sorted without their "Lag (...) om" prefix
+        self.assertEqual(["1998.html", "2010.html", "a.html", "index.html",
+                          "p.html", "s.html"],
+                         sorted(os.listdir(indexdir)))
+        tree = etree.parse(indexdir + "1998.html", etree.HTMLParser())
+        self.assertEqual("Författningar utgivna 1998",
+                         tree.find(".//title").text)
+        links = [a.get("href") for a in tree.findall(".//ul[@role='main']/li/a")]
+        self.assertEqual(["https://lagen.nu/1998:99",
+                          "https://lagen.nu/1998:204",
+                          "https://lagen.nu/1998:1000"], links)
+        tree = etree.parse(indexdir + "a.html", etree.HTMLParser())
+        items = [etree.tostring(li, method="text", encoding="unicode")
+                 for li in tree.findall(".//ul[@role='main']/li")]
+        self.assertEqual(["Lag (1998:1000) om arbetsmiljö",
+                          "Förordning (1998:99) om avgifter"], items)
+        self.assertEqual(util.readfile(indexdir + "a.html"),
+                         util.readfile(indexdir + "index.html"))
+
+
+class TestElementToString(unittest.TestCase):
+    re_qname = re.compile(r'(\{.*\})(\w+)')
+
+    def old_element_to_string(self, e):
+        # the original recursive implementation, kept here as the
+        # reference for the expected output
+        m = self.re_qname.match(e.tag)
+        tag = m.group(2)
+
+        if list(e.attrib.keys()):
+            attributestr = " " + \
+                " ".join([x + '="' + e.attrib[x].replace('"', '&quot;') +
+                         '"' for x in list(e.attrib.keys()) if x not in ['rel', 'property']])
+        else:
+            attributestr = ""
+
+        childstr = ''
+        for child in e:
+            childstr += self.old_element_to_string(child)
+
+        text = ''
+        tail = ''
+        if e.text:
+            text = escape(e.text)
+        if e.tail:
+            tail = escape(e.tail)
+        return "<%s%s>%s%s%s</%s>" % (tag, attributestr, text, childstr, tail, tag)
+
+    def test_register(self):
+        xhtml = """<div xmlns="http://www.w3.org/1999/xhtml" class="registerpost" id="L2003:104">
+  <dl property="rpubl:andrar">
+    <dt rel="x">Omfattning</dt>
+    <dd property="rpubl:andrar" lang="sv">ändr. 2 &amp; 3 §§; ny 4 § &lt;&gt;</dd>
+    <dt class="a" title='he said "hi"'>Förarbeten</dt><dd>Prop. 2002/03:123</dd>
+  </dl>tail text</div>"""
+        tree = etree.fromstring(xhtml)
+        self.assertEqual(self.old_element_to_string(tree),
+                         sfs.SFS._element_to_string(tree))
+
+    def test_large_random(self):
+        rnd = random.Random(42)
+        E = ElementMaker(namespace="http://www.w3.org/1999/xhtml")
+        texts = ["", "a & b", "<x>", "plain", 'q"q', "Förarbeten"]
+        root = E.div({'class': 'register'})
+        nodes = [root]
+        for i in range(5000):
+            parent = rnd.choice(nodes)
+            attrs = {}
+            for attr in rnd.sample(['class', 'rel', 'property', 'id', 'about'],
+                                   rnd.randint(0, 3)):
+                attrs[attr] = rnd.choice(texts)
+            child = etree.SubElement(parent, "{http://www.w3.org/1999/xhtml}%s" %
+                                     rnd.choice(['dl', 'dt', 'dd', 'p', 'span']),
+                                     attrs)
+            child.text = rnd.choice(texts) or None
+            child.tail = rnd.choice(texts) or None
+            nodes.append(child)
+        self.assertEqual(self.old_element_to_string(root),
+                         sfs.SFS._element_to_string(root))
+
+    def test_deep(self):
+        root = node = etree.Element("{http://www.w3.org/1999/xhtml}div")
+        for i in range(5000):
+            node = etree.SubElement(node, "{http://www.w3.org/1999/xhtml}span")
+            node.text = "%s" % i
+        res = sfs.SFS._element_to_string(root)
+        self.assertTrue(res.startswith("<div><span>0<span>1<span>2"))
+        self.assertTrue(res.endswith("4999</span>" + "</span>" * 4999 + "</div>"))
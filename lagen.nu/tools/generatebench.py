@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+"""Forces generation of all documents in the given repos (default
+sfs, dv and keyword) and reports docs/second for each.
+
+Usage (from the directory containing ferenda.ini)::
+
+    python tools/generatebench.py sfs dv --processes=4
+
+Any --options are passed on to ferenda.
+
+"""
+from __future__ import unicode_literals, print_function
+
+# system libraries
+import os
+import sys
+from time import time
+
+# the repo classes in ferenda.ini are imported from the current
+# directory
+sys.path.insert(0, os.getcwd())
+
+# my libs
+from ferenda import manager
+
+
+if __name__ == '__main__':
+    aliases = [x for x in sys.argv[1:] if not x.startswith("--")]
+    options = [x for x in sys.argv[1:] if x.startswith("--")]
+    for alias in aliases or ("sfs", "dv", "keyword"):
+        start = time()
+        res = manager.run([alias, "generate", "--all", "--force"] + options)
+        elapsed = time() - start
+        docs = len(res) if res else 0
+        print("%s: generated %s docs in %.3f sec (%.2f docs/sec)" %
+              (alias, docs, elapsed, docs / elapsed if elapsed else 0))
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""Renders a set of documents with two versions of a stylesheet and
+compares the output and the transform time of each.
+
+Usage (from the directory containing ferenda.ini)::
+
+    git show HEAD~1:lagen.nu/res/xsl/sfs.xsl > res/xsl/sfs-old.xsl
+    python xslregression.py sfs res/xsl/sfs-old.xsl 1942:740 1962:700 1998:204
+
+The old stylesheet must not have the same file name as the repo's
+current stylesheet, since all stylesheets are copied into a common
+directory before compilation. The documents must already be parsed
+and have annotation files (ie. have been generated once).
+
+"""
+from __future__ import unicode_literals, print_function
+
+# system libraries
+import os
+import sys
+from time import time
+
+# my libs
+from ferenda import manager, util
+from cachedtransform import get_transformer
+
+
+def render(repo, template, basefile, outfile):
+    conffile = os.path.abspath(
+        os.sep.join([repo.config.datadir, 'rsrc', 'resources.xml']))
+    transformer = get_transformer(template, ["res/xsl"], conffile,
+                                  repo.config.datadir)
+    params = {'annotationfile': repo.store.annotation_path(basefile)}
+    start = time()
+    transformer.transform_file(repo.store.parsed_path(basefile), outfile,
+                               params)
+    return time() - start
+
+
+def compare(repo, oldtemplate, basefiles, rounds=3):
+    """Returns True if all basefiles render identically with
+    oldtemplate and with the repo's current stylesheet."""
+    identical = True
+    oldtotal = newtotal = 0
+    for basefile in basefiles:
+        generated = repo.store.generated_path(basefile)
+        oldfile = generated.replace(".html", ".regress-old.html")
+        newfile = generated.replace(".html", ".regress-new.html")
+        # the first round compiles the stylesheets, so report the best
+        # of the remaining ones
+        oldtime = min([render(repo, oldtemplate, basefile, oldfile)
+                       for i in range(rounds + 1)][1:])
+        newtime = min([render(repo, repo.xslt_template, basefile, newfile)
+                       for i in range(rounds + 1)][1:])
+        with open(oldfile, "rb") as fp:
+            olddata = fp.read()
+        with open(newfile, "rb") as fp:
+            newdata = fp.read()
+        if olddata == newdata:
+            status = "identical"
+            util.robust_remove(oldfile)
+            util.robust_remove(newfile)
+        else:
+            status = "DIFFERS (see %s and %s)" % (oldfile, newfile)
+            identical = False
+        print("%s: old %.3f sec, new %.3f sec, %s" %
+              (basefile, oldtime, newtime, status))
+        oldtotal += oldtime
+        newtotal += newtime
+    print("total: old %.3f sec, new %.3f sec" % (oldtotal, newtotal))
+    return identical
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 4:
+        print(__doc__)
+        sys.exit(1)
+    alias, oldtemplate = sys.argv[1:3]
+    enabled = manager._enabled_classes()
+    repo = manager._instantiate_class(manager._load_class(enabled[alias]))
+    if not compare(repo, oldtemplate, sys.argv[3:]):
+        sys.exit(1)